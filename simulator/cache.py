@@ -0,0 +1,162 @@
+"""
+Caching solved circuits
+
+A circuit gets a canonical form that doesn't depend on the order of its nodes, resistors and voltage sources,
+nor on the names of its nodes, which are only numbers handed out while walking the pipes.
+Solutions are kept in that canonical order under a hash of the canonical form, so a circuit that was solved before
+only has to be looked up, however it was put together this time
+"""
+
+from hashlib import sha1
+
+import numpy as np
+
+from simulator.circuit import Circuit
+
+
+class CanonicalForm:
+    """
+    The canonical form of a circuit, and the permutations between its blueprint order and the canonical order.
+
+    Nodes are named after the elements attached to them, resistors are taken in the order of their names,
+    as are voltage sources. A resistor's current is signed from its canonically first node to the other one
+    """
+
+    def __init__(self, circuit: Circuit):
+        store = circuit.store
+
+        # Every node is identified by what is attached to it. Resistors work both ways, voltage sources don't
+        attached = [[] for _ in store.node_names]
+        for name, (a, b) in zip(store.resistor_names, store.resistor_ends.tolist()):
+            attached[a].append(name)
+            attached[b].append(name)
+        for name, (_from, _to) in zip(store.source_names, store.source_ends.tolist()):
+            attached[_from].append(name + ":from")
+            attached[_to].append(name + ":to")
+        labels = np.array(["|".join(sorted(names)) for names in attached], dtype=str)
+
+        self.node_order = np.argsort(labels, kind="stable")
+        rank = np.empty(len(labels), dtype=np.int64)
+        rank[self.node_order] = np.arange(len(labels))
+
+        # Two nodes with the same attachments can't be told apart, then this circuit isn't cached.
+        # Neither are circuits with macros, what is inside them isn't part of the form
+        self.unique = len(np.unique(labels)) == len(labels) and not circuit.macros
+
+        resistor_names = np.array(store.resistor_names, dtype=str)
+        self.resistor_order = np.argsort(resistor_names, kind="stable")
+        ends = rank[store.resistor_ends[self.resistor_order]].reshape(-1, 2)
+        self.resistor_signs = np.where(ends[:, 0] > ends[:, 1], -1.0, 1.0)
+
+        source_names = np.array(store.source_names, dtype=str)
+        self.source_order = np.argsort(source_names, kind="stable")
+
+        exponents = np.ones(len(resistor_names))
+        for name, n in circuit.exponents.items():
+            exponents[store.resistor_index[name]] = n
+        checks = np.zeros(len(resistor_names), dtype=bool)
+        checks[circuit.check_index] = True
+
+        # Everything but the names goes in as numbers, nodes by their position in the canonical order
+        digest = sha1()
+        for names in (labels[self.node_order], resistor_names[self.resistor_order], source_names[self.source_order]):
+            digest.update("\n".join(names.tolist()).encode() + b"\0")
+        for array in (
+            np.sort(ends, axis=1), store.resistances[self.resistor_order], exponents[self.resistor_order],
+            rank[store.source_ends[self.source_order]], store.voltages[self.source_order],
+            ends[checks[self.resistor_order]]
+        ):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        self.key = digest.hexdigest()
+
+    def to_canonical(self, voltages: np.ndarray, resistor_currents: np.ndarray, source_currents: np.ndarray
+                     ) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Reorder a solution from blueprint order to canonical order
+        """
+        return (
+            voltages[self.node_order],
+            resistor_currents[self.resistor_order] * self.resistor_signs,
+            source_currents[self.source_order]
+        )
+
+    def from_canonical(self, voltages: np.ndarray, resistor_currents: np.ndarray, source_currents: np.ndarray
+                       ) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Reorder a solution from canonical order back to blueprint order
+        """
+        node_voltages = np.empty_like(voltages)
+        node_voltages[self.node_order] = voltages
+        currents = np.empty_like(resistor_currents)
+        currents[self.resistor_order] = resistor_currents * self.resistor_signs
+        sources = np.empty_like(source_currents)
+        sources[self.source_order] = source_currents
+        return node_voltages, currents, sources
+
+
+class SolutionCache:
+    """
+    The solutions of the most recently used circuits, dropping the least recently used ones
+    once there are more than max_entries or they take up more than max_bytes
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 2 ** 26):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.solutions: {str: (np.ndarray, np.ndarray, np.ndarray, np.ndarray)} = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, circuit: Circuit) -> bool:
+        """
+        Apply the cached solution to the circuit if there is one, returning whether there was
+        """
+        form = CanonicalForm(circuit)
+        solution = self.solutions.pop(form.key, None) if form.unique else None
+        if solution is None:
+            self.misses += 1
+            return False
+
+        # Reinsert as the most recently used
+        self.solutions[form.key] = solution
+        self.hits += 1
+        *solution, blocked = solution
+        circuit.apply_solution(*form.from_canonical(*solution))
+        names = np.array(circuit.store.resistor_names, dtype=str)[form.resistor_order]
+        circuit.blocked = set(names[blocked].tolist())
+        return True
+
+    def store(self, circuit: Circuit):
+        """
+        Keep the solution of a solved circuit
+        """
+        form = CanonicalForm(circuit)
+        if not form.unique:
+            return
+
+        store = circuit.store
+        # The check valves that are blocked come along, the next solve of the circuit starts from them
+        blocked = np.isin(np.array(store.resistor_names, dtype=str)[form.resistor_order], list(circuit.blocked))
+        solution = (*form.to_canonical(store.node_voltages, store.resistor_currents, store.source_currents), blocked)
+        size = sum(array.nbytes for array in solution)
+        if size > self.max_bytes:
+            return
+
+        if form.key in self.solutions:
+            self.bytes -= sum(array.nbytes for array in self.solutions.pop(form.key))
+        self.solutions[form.key] = solution
+        self.bytes += size
+
+        while len(self.solutions) > self.max_entries or self.bytes > self.max_bytes:
+            self.bytes -= sum(array.nbytes for array in self.solutions.pop(next(iter(self.solutions))))
+
+    def stats(self) -> {str: int}:
+        """
+        Return the hits, misses, and the number and size of the cached solutions
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.solutions), "bytes": self.bytes}
+
+    def clear(self):
+        self.solutions = {}
+        self.bytes = 0
@@ -1,17 +1,19 @@
+import copy
+import threading
 from collections import Counter
+from itertools import count
 
+import numpy as np
 
-Blueprint = {str: tuple}
-
+from simulator.macro import Macro
+from simulator.mna import MNASystem, Backend, get_backend
+from simulator.nonlinear import NonlinearSolver
+from simulator.patterns import PatternReduction
+from simulator.pruning import Pruning
+from simulator.store import CircuitStore, Current
 
-class Current:
-    def __init__(self, amps: float, source: "Node", target: "Node"):
-        self.amps = amps
-        self.source = source
-        self.target = target
 
-    def __repr__(self):
-        return f"({self.amps}A {self.source.name} -> {self.target.name})"
+Blueprint = {str: tuple}
 
 
 """
@@ -20,6 +22,8 @@ Circuit components
 
 
 class CircuitComponent:
+    __slots__ = ("name",)
+
     def __init__(self, name: str):
         self.name = name
 
@@ -34,6 +38,8 @@ class CircuitComponent:
 
 
 class Node(CircuitComponent):
+    __slots__ = ("voltage",)
+
     def __init__(self, name: str):
         CircuitComponent.__init__(self, name)
 
@@ -45,6 +51,8 @@ class Node(CircuitComponent):
 
 
 class Resistor(CircuitComponent):
+    __slots__ = ("resistance", "nodes", "current", "voltage_drop", "replacements", "origin")
+
     def __init__(self, name: str, resistance: float, nodes: (Node, Node)):
         CircuitComponent.__init__(self, name)
 
@@ -57,11 +65,30 @@ class Resistor(CircuitComponent):
 
         self.replacements = {}
 
+        # The transformation this resistor resulted from, None for the resistors of the original circuit
+        self.origin = None
+
+    def originals(self) -> ["Resistor"]:
+        """
+        Return the resistors of the original circuit this resistor was reduced from, by walking down its origin tree
+        """
+        originals, stack, seen = [], [self], set()
+        while stack:
+            resistor = stack.pop()
+            if resistor.origin is None:
+                originals.append(resistor)
+            elif id(resistor.origin) not in seen:
+                seen.add(id(resistor.origin))
+                stack += resistor.origin.source
+        return originals
+
     def __repr__(self):
         return f"Resistor<{self.name}, {self.resistance}Ω, ({', '.join(n.name for n in self.nodes)})>"
 
 
 class VoltageSource(CircuitComponent):
+    __slots__ = ("voltage", "pos_node", "neg_node", "current")
+
     def __init__(self, name: str, voltage: float, neg_node: Node, pos_node: Node):
         CircuitComponent.__init__(self, name)
 
@@ -81,9 +108,20 @@ Transformations
 
 
 class Transformation:
+    # Numbers the resulting resistors, whose names only have to be unique. Where they came from is kept in their origin
+    numbers = count()
+
     def __init__(self):
         pass
 
+    def new_resistor(self, resistance: float, nodes: (Node, Node)) -> Resistor:
+        """
+        Create a resistor resulting from this transformation
+        """
+        resistor = Resistor(f"{self}#{next(Transformation.numbers)}", resistance, nodes)
+        resistor.origin = self
+        return resistor
+
     def __repr__(self):
         return self.__class__.__name__
 
@@ -115,7 +153,7 @@ class Series(Transformation):
         self.source = source
         resistance = self.get_resistance()
         end_nodes = self.get_end_nodes()
-        self.result = Resistor("".join([resistor.name for resistor in self.source]), resistance, end_nodes)
+        self.result = self.new_resistor(resistance, end_nodes)
 
     def get_end_nodes(self) -> (Node, Node):
         """
@@ -139,7 +177,7 @@ class Parallel(Transformation):
 
         self.source = source
         resistance = self.get_resistance()
-        self.result = Resistor("".join([resistor.name for resistor in self.source]), resistance, self.source[0].nodes)
+        self.result = self.new_resistor(resistance, self.source[0].nodes)
 
     def get_resistance(self) -> float:
         """
@@ -179,7 +217,7 @@ class WyeDelta(Transformation):
             _b.nodes[0] if _b.nodes[0] != center else _b.nodes[1]
         )
         r = _a.resistance + _b.resistance + ((_a.resistance * _b.resistance) / other.resistance)
-        return Resistor(_a.name + _b.name, r, nodes)
+        return self.new_resistor(r, nodes)
 
 
 """
@@ -187,265 +225,933 @@ Circuit stuff
 """
 
 
-class SingleVoltCircuit:
+class Reducer:
     """
-    A circuit that includes only a single voltage source
+    Reduces a network of resistors one transformation at a time.
+    Node degrees and the resistors between every pair of nodes are kept up to date as resistors come and go,
+    so finding the next applicable rule only looks at what the previous transformation touched
     """
 
-    def __init__(self, nodes: [str], resistors: {str: (float, str, str)}, voltage_source: (str, float, str, str)):
-        self.nodes = {name: Node(name) for name in nodes}
-
-        self.resistors = {
-            name: Resistor(name, ohm, (self.nodes[node1], self.nodes[node2]))
-            for name, (ohm, node1, node2) in resistors.items()
-        }
+    def __init__(self, resistors: [Resistor], terminals: {Node}, wye_delta: bool = True):
+        # Integer ids for the nodes, the terminals never get reduced away
+        self.node_ids = {}
+        self.nodes = []
+        self.terminals = set()
+        self.wye_delta = wye_delta
+
+        # Active resistors by id, their end node ids, and the indexes over them
+        self.resistors = {}
+        self.ends = {}
+        self.incident = []  # Node id -> ids of the resistors attached to it
+        self.degree = []  # Node id -> number of resistor ends attached to it
+        self.pairs = {}  # (node id, node id) -> ids of the resistors between the two
+        self.ids = count()
+
+        self.transformations = []
+
+        # Candidates for every rule, checked again when taken, as later transformations may have invalidated them
+        self.shorts = []
+        self.dead_ends = []
+        self.series = []
+        self.parallels = []
+        self.wyes = []
+
+        for terminal in terminals:
+            self.terminals.add(self.node_id(terminal))
+        for resistor in resistors:
+            self.add(resistor)
+
+    def node_id(self, node: Node) -> int:
+        """
+        Return the id of a node, handing out a new one for unknown nodes
+        """
+        if node not in self.node_ids:
+            self.node_ids[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.incident.append(set())
+            self.degree.append(0)
+        return self.node_ids[node]
+
+    def add(self, resistor: Resistor):
+        """
+        Add a resistor to the network
+        """
+        rid = next(self.ids)
+        a, b = sorted((self.node_id(resistor.nodes[0]), self.node_id(resistor.nodes[1])))
+        self.resistors[rid] = resistor
+        self.ends[rid] = (a, b)
+
+        self.incident[a].add(rid)
+        self.incident[b].add(rid)
+        self.degree[a] += 1
+        self.degree[b] += 1
+        pair = self.pairs.setdefault((a, b), set())
+        pair.add(rid)
+
+        if a == b:
+            self.shorts.append(rid)
+        elif len(pair) > 1:
+            self.parallels.append((a, b))
+        self.touch(a)
+        self.touch(b)
+
+    def remove(self, rid: int) -> Resistor:
+        """
+        Remove a resistor from the network
+        """
+        a, b = self.ends.pop(rid)
+        resistor = self.resistors.pop(rid)
+
+        self.incident[a].discard(rid)
+        self.incident[b].discard(rid)
+        self.degree[a] -= 1
+        self.degree[b] -= 1
+        self.pairs[(a, b)].discard(rid)
+        if not self.pairs[(a, b)]:
+            del self.pairs[(a, b)]
+
+        self.touch(a)
+        self.touch(b)
+        return resistor
+
+    def touch(self, node: int):
+        """
+        Mark a node whose degree changed as a candidate for the rule matching its new degree
+        """
+        if node in self.terminals:
+            return
+
+        match self.degree[node]:
+            case 1:
+                self.dead_ends.append(node)
+            case 2:
+                self.series.append(node)
+            case 3:
+                self.wyes.append(node)
+
+    def far_end(self, rid: int, node: int) -> int:
+        """
+        Return the node on the other side of a resistor
+        """
+        a, b = self.ends[rid]
+        return b if a == node else a
 
-        name, volt, _from, _to = voltage_source
-        self.voltage_source = VoltageSource(name, volt, self.nodes[_from], self.nodes[_to])
-
-    def simplify(self) -> (Resistor, [Transformation]):
-        """
-        Simplify this circuit down to a single resistor,
-        returning the resistor and list of transformations it took to simplify
-        """
-
-        active_resistors = self.resistors.copy()
-        transformations = []
-
-        while len(active_resistors) > 1:
-            count = Counter(list(sum([r.nodes for r in active_resistors.values()], ())))
-            combi_count = Counter([r.nodes for r in active_resistors.values()])
-
-            count[self.voltage_source.pos_node] += 1j
-            count[self.voltage_source.neg_node] += 1j
-
-            # Rule 0a. Short-Circuit
-            if short_circuited := [r for r in active_resistors.values() if r.nodes[0] is r.nodes[1]]:
-                for resistor in short_circuited:
-                    short_circuit = ShortCircuit(resistor)
-                    transformations.append(short_circuit)
-                    del active_resistors[resistor.name]
-
-            # Rule 0b. Dead End
-            elif dead_nodes := [n for n in count if count[n] == 1]:
-                for dead_node in dead_nodes:
-                    resistor = [r for r in active_resistors.values() if dead_node in r.nodes][0]
-                    dead_end = DeadEnd(resistor, dead_node)
-                    transformations.append(dead_end)
-                    del active_resistors[resistor.name]
-
-            # Rule 1. Series
-            elif series_nodes := [n for n in count if count[n] == 2]:
-                node = series_nodes[0]
-                resistors = [r for r in active_resistors.values() if node in r.nodes]
-                series = Series(resistors)
-                transformations.append(series)
-                for r in resistors:
-                    del active_resistors[r.name]
-                active_resistors[series.result.name] = series.result
-
-            # Rule 2. Parallel
-            elif parallel_pairs := [combi for combi in combi_count if combi_count[combi] > 1]:
-                pair = parallel_pairs[0]
-                resistors = [r for r in active_resistors.values() if pair == r.nodes]
-                parallel = Parallel(resistors)
-                transformations.append(parallel)
-                for r in resistors:
-                    del active_resistors[r.name]
-                active_resistors[parallel.result.name] = parallel.result
-
-            # Rule 3. Wye-Delta
-            elif wye_nodes := [n for n in count if count[n] == 3]:
-                node = wye_nodes[0]
-                resistors = [r for r in active_resistors.values() if node in r.nodes]
-                wye_delta = WyeDelta(resistors)
-                transformations.append(wye_delta)
-                for r in resistors:
-                    del active_resistors[r.name]
-                for r in wye_delta.result:
-                    active_resistors[r.name] = r
+    def step(self) -> bool:
+        """
+        Apply a single transformation, trying the rules in order of preference.
+        Returns False when none of the rules apply anymore
+        """
+        # Rule 0a. Short-Circuit
+        while self.shorts:
+            rid = self.shorts.pop()
+            if rid in self.ends:
+                self.transformations.append(ShortCircuit(self.remove(rid)))
+                return True
+
+        # Rule 0b. Dead End
+        while self.dead_ends:
+            node = self.dead_ends.pop()
+            if self.degree[node] == 1:
+                rid = next(iter(self.incident[node]))
+                self.transformations.append(DeadEnd(self.remove(rid), self.nodes[node]))
+                return True
+
+        # Rule 1. Series, leaving nodes with both resistors going to the same node to the parallel rule
+        while self.series:
+            node = self.series.pop()
+            if self.degree[node] == 2 and len(self.incident[node]) == 2:
+                rids = list(self.incident[node])
+                if self.far_end(rids[0], node) != self.far_end(rids[1], node):
+                    series = Series([self.remove(rid) for rid in rids])
+                    self.transformations.append(series)
+                    self.add(series.result)
+                    return True
+
+        # Rule 2. Parallel
+        while self.parallels:
+            pair = self.parallels.pop()
+            if len(self.pairs.get(pair, ())) > 1:
+                parallel = Parallel([self.remove(rid) for rid in list(self.pairs[pair])])
+                self.transformations.append(parallel)
+                self.add(parallel.result)
+                return True
+
+        # Rule 3. Wye-Delta, only once nothing else applies, so the three resistors all lead somewhere else
+        while self.wye_delta and self.wyes:
+            node = self.wyes.pop()
+            if self.degree[node] == 3 and len(self.incident[node]) == 3:
+                rids = list(self.incident[node])
+                if len({self.far_end(rid, node) for rid in rids}) == 3:
+                    wye_delta = WyeDelta([self.remove(rid) for rid in rids])
+                    self.transformations.append(wye_delta)
+                    for resistor in wye_delta.result:
+                        self.add(resistor)
+                    return True
+
+        return False
+
+
+class ReductionPlan:
+    """
+    The transformations that reduce a circuit, compiled to plain resistor slots and node ids.
+    Which transformations apply only depends on the topology, so a plan can be replayed for any resistances
+    without searching for rules again, see PreReduction
+    """
 
-            else:
-                # Uncertain whether these rules are enough, but at the moment it seems to be
-                raise Exception("No rule applicable on the current circuit")
+    SERIES, PARALLEL, WYE_DELTA, DEAD_END = range(4)
 
-        return list(active_resistors.values())[0], transformations
+    def slot(self, resistor: Resistor) -> int:
+        """
+        Return the slot of a resistor, the first slots belong to the original resistors,
+        every resulting resistor gets the next free slot
+        """
+        if id(resistor) not in self.slots:
+            self.slots[id(resistor)] = len(self.slots)
+        return self.slots[id(resistor)]
 
-    def solve(self):
+    def compile(self, node_names: [str], resistors: [Resistor], transformations: [Transformation]):
         """
-        Solve the circuit, calculating the current and voltage everywhere in the circuit
+        Compile the transformations that reduced the given resistors into steps on slots and node ids
         """
-        # Get the equivalent resistor and the steps it took to get it
-        eq_resistor, transformations = self.simplify()
+        self.node_names = node_names
+        self.resistor_names = [resistor.name for resistor in resistors]
+        node_ids = self.node_ids = {name: i for i, name in enumerate(self.node_names)}
+
+        self.slots = {id(resistor): i for i, resistor in enumerate(resistors)}
+        slot = self.slot
 
-        # Set the initial voltages and currents
-        self.voltage_source.pos_node.voltage = self.voltage_source.voltage
-        self.voltage_source.neg_node.voltage = 0
-        current = self.voltage_source.voltage / eq_resistor.resistance
-        self.voltage_source.current = Current(current, self.voltage_source.neg_node, self.voltage_source.pos_node)
-        eq_resistor.current = Current(current, *sorted(eq_resistor.nodes, key=lambda n: n.voltage, reverse=True))
-        eq_resistor.voltage_drop = self.voltage_source.voltage
+        def far_end(resistor: Resistor, node: Node) -> int:
+            return node_ids[(resistor.nodes[1] if resistor.nodes[0] == node else resistor.nodes[0]).name]
 
-        # Work backwards through the steps, solving currents and voltages along the way
-        for step in reversed(transformations):
+        self.steps = []
+        for step in transformations:
             match step:
                 case Series(source=[a, b], result=c):
-                    # Determine the order in which a and b occur,
-                    # stronger being the resistor bordering the higher voltage node
-                    weaker, stronger = (a, b) if c.current.target in a.nodes else (b, a)
-
-                    # Both have the same amps in their current. Weaker has the same target node as c,
-                    # while stronger targets the node that disappeared during the transformation
-                    source_target = sorted(stronger.nodes, key=lambda n: 1 if n.voltage is None else 0)
-                    stronger.current = Current(c.current.amps, *source_target)
-                    weaker.current = Current(c.current.amps, stronger.current.target, c.current.target)
-
-                    # Calculate the voltage drops
-                    stronger.voltage_drop = stronger.current.amps * stronger.resistance
-                    weaker.voltage_drop = weaker.current.amps * weaker.resistance
-                    stronger.current.target.voltage = stronger.current.source.voltage - stronger.voltage_drop
+                    middle = next(n for n in a.nodes if n not in c.nodes)
+                    self.steps.append((
+                        self.SERIES, slot(a), slot(b), slot(c), node_ids[middle.name], far_end(a, middle), far_end(b, middle)
+                    ))
 
                 case Parallel(source=resistors, result=eq):
-                    for resistor in resistors:
-                        # No fuss, voltage drop is the same, as are source/target nodes. Only current is calculated with I=V/R
-                        resistor.voltage_drop = eq.voltage_drop
-                        resistor.current = Current(resistor.voltage_drop / resistor.resistance, eq.current.source, eq.current.target)
+                    self.steps.append((self.PARALLEL, [slot(r) for r in resistors], slot(eq)))
 
                 case WyeDelta(source=[a, b, c], result=[d, e, f]):
-                    # Get the center node, which disappears during the Wye-Delta transformation
-                    center = next(n for n in a.nodes if n.voltage is None)
-
-                    # a gets d and e's currents combined, b gets d and f, c gets e and f
-                    for original, first, second in [(a, d, e), (b, d, f), (c, e, f)]:
-                        # Whichever node isn't the center node
-                        non_center = next(n for n in original.nodes if n is not center)
-
-                        # If both currents go in the same direction, add them together
-                        if first.current.source == non_center and second.current.source == non_center:
-                            original.current = Current(first.current.amps + second.current.amps, non_center, center)
-                        elif first.current.target == non_center and second.current.target == non_center:
-                            original.current = Current(first.current.amps + second.current.amps, center, non_center)
-                        # Otherwise take the positive difference in amps between the two
-                        else:
-                            weak, strong = sorted((first.current, second.current), key=lambda cur: cur.amps)
-                            source_target = (center, strong.target) if strong.target is non_center else (strong.source, center)
-                            original.current = Current(strong.amps - weak.amps, *source_target)
-
-                        # Calculate voltage drop of the resistor and voltage of the new node
-                        original.voltage_drop = original.current.amps * original.resistance
-                        if original.current.target.voltage is None:
-                            original.current.target.voltage = original.current.source.voltage - original.voltage_drop
-
-                case ShortCircuit(source=resistor):
-                    resistor.current = Current(0, *resistor.nodes)
-                    resistor.voltage_drop = 0
+                    center = next(n for n in a.nodes if n in b.nodes and n in c.nodes)
+                    self.steps.append((
+                        self.WYE_DELTA, slot(a), slot(b), slot(c), slot(d), slot(e), slot(f),
+                        node_ids[center.name], far_end(a, center), far_end(b, center), far_end(c, center)
+                    ))
 
                 case DeadEnd(source=resistor, dead_node=dead_node):
-                    resistor.current = Current(0, *resistor.nodes)
-                    resistor.voltage_drop = 0
-                    dead_node.voltage = 0
+                    self.steps.append((self.DEAD_END, node_ids[dead_node.name], far_end(resistor, dead_node)))
+
+                # Short circuits carry no current and eliminate no node, so there's nothing to replay
+
+        self.slot_count = len(self.slots)
+
+    def reduce(self, resistances: [float]) -> [float]:
+        """
+        Replay the transformations on the given resistances of the original resistors,
+        returning the resistances of all slots
+        """
+        r = list(resistances) + [0.0] * (self.slot_count - len(resistances))
+        for step in self.steps:
+            match step[0]:
+                case self.SERIES:
+                    _, a, b, c, *_ = step
+                    r[c] = r[a] + r[b]
+                case self.PARALLEL:
+                    _, sources, eq = step
+                    r[eq] = 1 / sum(1 / r[i] for i in sources)
+                case self.WYE_DELTA:
+                    _, a, b, c, d, e, f, *_ = step
+                    r[d] = r[a] + r[b] + r[a] * r[b] / r[c]
+                    r[e] = r[a] + r[c] + r[a] * r[c] / r[b]
+                    r[f] = r[b] + r[c] + r[b] * r[c] / r[a]
+        return r
+
+
+class PreReduction(ReductionPlan):
+    """
+    Chains of resistors in series and banks of resistors in parallel, collapsed before the MNA matrix is assembled.
+    Only nodes attached to something else than a linear resistor have to stay, the matrix is built from the resistors
+    that remain between them. Afterwards the eliminated nodes get their voltages by replaying the plan backwards
+    """
+
+    def __init__(self,
+                 nodes: [str],
+                 resistors: {str: (float, str, str)},
+                 voltage_sources: {str: (float, str, str)},
+                 exponents: {str: float}
+                 ):
+        # Resistors of zero ohm and nonlinear resistors are left as they are, and so are the nodes they connect
+        node_objects = {name: Node(name) for name in nodes}
+        reducible = [
+            Resistor(name, ohm, (node_objects[a], node_objects[b]))
+            for name, (ohm, a, b) in resistors.items() if ohm != 0 and exponents.get(name, 1) == 1
+        ]
+        reducible_names = {resistor.name for resistor in reducible}
+        self.kept = [name for name in resistors if name not in reducible_names]
+        terminals = {
+            node_objects[node]
+            for _, a, b in [*voltage_sources.values(), *(resistors[name] for name in self.kept)]
+            for node in (a, b)
+        }
+
+        reducer = Reducer(reducible, terminals, wye_delta=False)
+        while reducer.step():
+            pass
+        self.compile(list(nodes), reducible, reducer.transformations)
+
+        # What the matrix gets built from, in the order of the original nodes
+        remaining = list(reducer.resistors.values())
+        self.remaining_slots = [self.slot(resistor) for resistor in remaining]
+        self.remaining = {resistor.name: (resistor.nodes[0].name, resistor.nodes[1].name) for resistor in remaining}
+        kept_nodes = {node.name for node in terminals} | {n for ends in self.remaining.values() for n in ends}
+        self.nodes = [name for name in nodes if name in kept_nodes]
+        self.kept_node_ids = np.array([self.node_ids[name] for name in self.nodes], dtype=np.int64)
+
+        self.reducible_index = np.array([i for i, name in enumerate(resistors) if name in reducible_names], dtype=np.int64)
+        self.kept_index = np.array([i for i, name in enumerate(resistors) if name not in reducible_names], dtype=np.int64)
+        # Resistor objects sort their nodes, currents are signed from node1 to node2 of the blueprint
+        self.reducible_ends = np.array(
+            [[self.node_ids[a], self.node_ids[b]] for name, (_, a, b) in resistors.items() if name in reducible_names],
+            dtype=np.int64
+        ).reshape(-1, 2)
+        self.resistances = None
+
+    def useful(self) -> bool:
+        """
+        Return whether the reduction removed anything at all
+        """
+        return len(self.nodes) < len(self.node_names)
+
+    def reduced_resistors(self, resistors: {str: (float, str, str)}) -> {str: (float, str, str)}:
+        """
+        Return the blueprint of the resistors that remain for the given resistances of the original resistors,
+        the resistors that were left as they are come last
+        """
+        resistances = [ohm for ohm, _, _ in resistors.values()]
+        self.resistances = self.reduce([resistances[i] for i in self.reducible_index.tolist()])
+
+        reduced = {
+            name: (self.resistances[slot], a, b)
+            for (name, (a, b)), slot in zip(self.remaining.items(), self.remaining_slots)
+        }
+        for name in self.kept:
+            reduced[name] = resistors[name]
+        return reduced
+
+    def changed_resistances(self, resistors: {str: (float, str, str)}, changed: {str: float}) -> {str: float}:
+        """
+        Reduce the resistances of the original resistors again after the given ones changed,
+        returning the remaining and kept resistors whose resistance changed with them
+        """
+        previous = self.resistances
+        reduced = self.reduced_resistors(resistors)
+        return {
+            **{
+                name: reduced[name][0]
+                for name, slot in zip(self.remaining, self.remaining_slots) if self.resistances[slot] != previous[slot]
+            },
+            **{name: changed[name] for name in self.kept if name in changed}
+        }
+
+    def expand(self, voltages: np.ndarray, resistor_currents: np.ndarray, source_currents: np.ndarray
+               ) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Expand the solution of the reduced circuit to the voltages of all nodes and currents of all original resistors.
+        Takes a solution per column as well, like MNASystem.unpack
+        """
+        columns = voltages.shape[1:]
+        r = self.resistances
+        v = np.zeros((len(self.node_names),) + columns)
+        v[self.kept_node_ids] = voltages
+
+        for step in reversed(self.steps):
+            match step[0]:
+                case self.SERIES:
+                    _, a, b, _, middle, p, q = step
+                    v[middle] = v[p] - (v[p] - v[q]) * (r[a] / (r[a] + r[b]))
+                case self.DEAD_END:
+                    _, dead, other = step
+                    v[dead] = v[other]
+
+        currents = np.zeros((len(self.reducible_index) + len(self.kept_index),) + columns)
+        ends = self.reducible_ends
+        resistances = np.array(r[:len(self.reducible_index)]).reshape((-1,) + (1,) * len(columns))
+        currents[self.reducible_index] = (v[ends[:, 0]] - v[ends[:, 1]]) / resistances
+        currents[self.kept_index] = resistor_currents[len(self.remaining):]
+
+        # Flush numerical noise to an exact zero, like MNASystem.unpack does
+        tolerance = 1e-12 * max(np.abs(currents).max(initial=0), np.abs(source_currents).max(initial=0))
+        currents[np.abs(currents) < tolerance] = 0
+
+        return v, currents, source_currents
 
 
 class Circuit:
     """
-    A circuit of resistors and voltage sources connected by nodes
+    A circuit of resistors and voltage sources connected by nodes.
+    Macros are placed as {instance name: (macro, {port: node})}, see simulator.macro
     """
 
-    def __init__(self, nodes: [str], resistors: {str: (float, str, str)}, voltage_sources: {str: (float, str, str)}):
+    # Factorized systems of the most recently solved topologies with their prunings, memoized pieces and pre-reductions,
+    # shared by all circuits. Solving a circuit of a known topology only has to apply the values that changed.
+    # A circuit takes the system out and puts a copy back, so it keeps one of its own to update,
+    # and circuits are solved on other threads too, so the cache is only touched with its lock held
+    systems: {tuple: (Pruning | None, PatternReduction | None, PreReduction | None, MNASystem)} = {}
+    systems_size = 16
+    systems_lock = threading.Lock()
+
+    # A blocked check valve still leaks, with this fraction of its open conductance.
+    # That keeps whatever is behind it connected, so the matrix stays regular
+    check_valve_leak = 1e-9
+
+    def __init__(self,
+                 nodes: [str],
+                 resistors: {str: (float, str, str)},
+                 voltage_sources: {str: (float, str, str)},
+                 backend: "str | Backend" = "sparse",
+                 exponents: {str: float} = None,
+                 prune: bool = True,
+                 prereduce: bool = True,
+                 macros: {str: (Macro, {str: str})} = None,
+                 check_valves: [str] = None,
+                 memoize: bool = True,
+                 cache: bool = True
+                 ):
         self.nodes_blueprint = nodes
         self.resistors_blueprint = resistors
         self.voltage_sources_blueprint = voltage_sources
 
-        self.nodes = {name: Node(name) for name in self.nodes_blueprint}
-        self.resistors = {
-            name: Resistor(name, ohm, (self.nodes[node1], self.nodes[node2]))
-            for name, (ohm, node1, node2) in resistors.items()
-        }
-        self.voltage_sources = {
-            name: VoltageSource(name, volt, self.nodes[_from], self.nodes[_to])
-            for name, (volt, _from, _to) in voltage_sources.items()
-        }
+        # Every placed macro stands in as resistors between its ports, which come after the circuit's own resistors,
+        # and currents injected into its ports
+        self.macros = macros or {}
+        self.macro_resistors = {}
+        self.injections = {}
+        for instance, (macro, port_nodes) in self.macros.items():
+            macro_resistors, injections = macro.place(instance, port_nodes)
+            self.macro_resistors |= macro_resistors
+            for node, amps in injections.items():
+                self.injections[node] = self.injections.get(node, 0) + amps
+        if any(name in resistors for name in self.macro_resistors):
+            raise Exception("Names of resistors can't be the same as the names of macro instances and their ports")
+
+        # Everything is kept in arrays, nodes, resistors and voltage sources are views on them made on first access
+        self.store = CircuitStore(nodes, resistors, voltage_sources)
+        self.nodes = self.store.nodes
+        self.resistors = self.store.resistors
+        self.voltage_sources = self.store.voltage_sources
+
+        # How the MNA matrix gets factorized, see simulator.mna for the options
+        self.backend = get_backend(backend)
+        self.system = None
+        self.factorization = None
+
+        # The whole network, unpruned and unreduced, factorized for questions about any of its nodes
+        self.network = None
+
+        # Parts of the circuit that can't carry flow are left out, see simulator.pruning,
+        # and series and parallel resistors are collapsed before building the matrix, see PreReduction
+        self.prune = prune
+        self.pruning = None
+        self.prereduce = prereduce
+        self.reduction = None
+
+        # Pieces of the circuit that repeat are reduced to their ports once, and placed as that for every copy,
+        # see simulator.patterns
+        self.memoize = memoize
+        self.patterns = None
+
+        # Whether the system is shared through Circuit.systems, or kept to this circuit alone with the topology it has
+        self.cache = cache
+        self.system_topology = None
+
+        # Resistors whose voltage drop follows a power of their current, resistor name -> exponent
+        self.exponents = {name: n for name, n in (exponents or {}).items() if n != 1}
+        self.nonlinear = None
+
+        # Resistors that only let current through from their node1 to their node2, and which of them are blocked.
+        # The blocked ones are kept from one solve to the next, the next solve starts from them
+        self.check_valves = [name for name in (check_valves or []) if name in resistors]
+        self.check_index = np.array([self.store.resistor_index[name] for name in self.check_valves], dtype=np.int64)
+        self.blocked = set()
+        self.flips = 0
 
     def solve(self):
         """
-        Split the circuit up into single voltage-source circuits, solve each individually, and merge them
+        Solve the circuit with Modified Nodal Analysis, all voltage sources at once in a single linear solve,
+        or a few of them when check valves have to be opened or blocked
         """
-        circuits = []
+        self.build_system()
+        self.apply_solution(*self.settle())
 
-        # For every voltage source
-        for vs in self.voltage_sources_blueprint:
-            # Get the almost-zero resistors that replace the other
-            vs_resistors = self.create_vs_resistors(vs)
+    def build_system(self):
+        """
+        Build and factorize the MNA system of the circuit, or bring the cached system of its topology up to date
+        """
+        topology = self.topology()
+        if self.cache:
+            with Circuit.systems_lock:
+                pruning, patterns, reduction, system = Circuit.systems.pop(topology, (None, None, None, None))
+        elif topology == self.system_topology:
+            pruning, patterns, reduction, system = self.pruning, self.patterns, self.reduction, self.system
+        else:
+            pruning, patterns, reduction, system = None, None, None, None
+
+        # Macros drive flow between their ports like pumps do, so pruning and reduction see them as links between them
+        links = {
+            f"{instance}:{port}": (0, port_nodes[macro.ports[0]], port_nodes[port])
+            for instance, (macro, port_nodes) in self.macros.items() if np.any(macro.injections) for port in macro.ports[1:]
+        }
 
-            # Create and solve the single voltage-source circuit
-            voltage_source = (vs, *self.voltage_sources_blueprint[vs])
-            sv_circuit = SingleVoltCircuit(self.nodes_blueprint, self.resistors_blueprint | vs_resistors, voltage_source)
-            sv_circuit.solve()
+        if system is None and self.prune:
+            pruning = Pruning(self.nodes_blueprint, self.all_resistors(), self.voltage_sources_blueprint | links)
+            pruning = pruning if pruning.useful() else None
+
+        nodes, voltage_sources, injections = self.nodes_blueprint, self.voltage_sources_blueprint, self.injections
+        if pruning is not None:
+            nodes, voltage_sources = pruning.nodes, pruning.pruned_voltage_sources(voltage_sources)
+            links = pruning.pruned_voltage_sources(links)
+            injections = {}
+            for node, amps in self.injections.items():
+                injections[pruning.representative[node]] = injections.get(pruning.representative[node], 0) + amps
+        resistors = self.pruned_resistors(pruning)
+
+        # Repeated pieces are found by their values as well, so they're looked for again once those changed
+        if patterns is not None and not patterns.matches(resistors, voltage_sources):
+            patterns, reduction, system = None, None, None
+        if system is None and self.memoize:
+            check_valves = set(self.check_valves)
+            fixed = [name for name in resistors if name in self.exponents or name in check_valves]
+            patterns = PatternReduction(nodes, resistors, voltage_sources, fixed, injections)
+            patterns = patterns if patterns.useful() else None
+
+        if patterns is not None:
+            nodes, links = patterns.nodes, links | patterns.links
+            resistors = patterns.reduced_resistors(resistors)
+            voltage_sources = patterns.reduced_voltage_sources(voltage_sources)
+            injections = dict(injections)
+            for node, amps in patterns.injections.items():
+                injections[node] = injections.get(node, 0) + amps
+
+        if system is None and self.prereduce:
+            reduction = PreReduction(nodes, resistors, voltage_sources | links, self.exponents)
+            reduction = reduction if reduction.useful() else None
+
+        if reduction is not None:
+            nodes, resistors = reduction.nodes, reduction.reduced_resistors(resistors)
+        if system is None or not system.update_values(resistors, voltage_sources, injections):
+            system = MNASystem(nodes, resistors, voltage_sources, injections)
+            system.factorize(self.backend)
+
+        # (Re)insert a copy as the most recently used system, dropping the least recently used ones
+        if self.cache:
+            cached = (pruning, patterns, copy.copy(reduction), system.copy())
+            with Circuit.systems_lock:
+                Circuit.systems[topology] = cached
+                while len(Circuit.systems) > Circuit.systems_size:
+                    del Circuit.systems[next(iter(Circuit.systems))]
+
+        self.system_topology = topology
+
+        self.pruning = pruning
+        self.patterns = patterns
+        self.reduction = reduction
+        self.system = system
+        self.factorization = self.system.factorization
+
+    def settle(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Solve the system, then open the blocked check valves that have pressure forwards across them and block
+        the open ones with current backwards through them, until none of them has to change. That is an active set
+        iteration, every flip changes a single resistance, which is a low-rank update of the factorization.
+        All valves that are wrong flip at once, unless that comes back to blocked valves that were tried before,
+        then only the one that is the most wrong flips. Returns the solution like solve_system
+        """
+        solution = self.solve_system()
+        if not self.check_valves:
+            return solution
+
+        seen = {frozenset(self.blocked)}
+        single = False
+        for _ in range(max(50, 4 * len(self.check_valves))):
+            voltages, resistor_currents, _ = solution
+            a, b = self.store.resistor_ends[self.check_index].T
+            drops = voltages[a] - voltages[b]
+            flows = resistor_currents[self.check_index]
+            blocked = np.array([name in self.blocked for name in self.check_valves], dtype=bool)
+
+            # How wrong every valve is, relative to the largest current and voltage drop around
+            backwards = -flows / max(np.abs(resistor_currents).max(initial=0), 1e-300)
+            forwards = drops / max(np.abs(drops).max(initial=0), 1e-300)
+            wrong = np.where(blocked, forwards, backwards)
+            flips = np.flatnonzero(wrong > 1e-9)
+            if len(flips) == 0:
+                return solution
+            if single:
+                flips = flips[[np.argmax(wrong[flips])]]
+
+            for i in flips.tolist():
+                self.blocked ^= {self.check_valves[i]}
+            self.flips += len(flips)
+            if frozenset(self.blocked) in seen:
+                single = True
+            seen.add(frozenset(self.blocked))
+
+            resistances = {
+                self.check_valves[i]: self.valve_resistance(self.check_valves[i]) for i in flips.tolist()
+            }
+            if not self.update_system(resistances):
+                self.build_system()
+            solution = self.solve_system()
+
+        raise Exception("Check valves didn't settle, they keep opening and blocking")
+
+    def valve_resistance(self, name: str) -> float:
+        """
+        Return the resistance a resistor has in the system, which is far larger than its own for a blocked check valve
+        """
+        ohm = self.resistors_blueprint[name][0]
+        if name in self.blocked:
+            return (ohm if ohm else 1) / Circuit.check_valve_leak
+        return ohm
 
-            # Store the resulting solved circuit and the replacements that took place (needed for current merging)
-            circuits.append(sv_circuit)
+    def solve_system(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Solve the MNA system, iterating with Newton-Raphson when some resistors are nonlinear.
+        Returns the node voltages, resistor currents and voltage source currents of the whole circuit
+        """
+        if not self.exponents:
+            solution = self.system.solve()
+        else:
+            # A copy of the same system keeps the solver, which starts from the last solution
+            if self.nonlinear is None or self.nonlinear.system.structure != self.system.structure:
+                exponents = [self.exponents.get(name, 1) for name in self.system.resistor_names]
+                self.nonlinear = NonlinearSolver(self.system, exponents, self.backend)
+            self.nonlinear.system = self.system
+            solution = self.nonlinear.solve()
+
+        return self.expand(*solution)
+
+    def all_resistors(self) -> {str: (float, str, str)}:
+        """
+        Return the blueprint of the circuit's own resistors followed by those standing in for the macros,
+        with the resistance blocked check valves have in the system
+        """
+        resistors = self.resistors_blueprint
+        if self.blocked:
+            resistors = resistors | {
+                name: (self.valve_resistance(name), *self.resistors_blueprint[name][1:]) for name in self.blocked
+            }
+        return resistors | self.macro_resistors if self.macro_resistors else resistors
+
+    def pruned_resistors(self, pruning: Pruning | None) -> {str: (float, str, str)}:
+        """
+        Return the blueprint of the resistors that are left after the given pruning
+        """
+        return self.all_resistors() if pruning is None else pruning.pruned_resistors(self.all_resistors())
 
-        # Merge all single voltage-source circuits into one
-        self.merge_circuits(circuits)
+    def expand(self, voltages: np.ndarray, resistor_currents: np.ndarray, source_currents: np.ndarray
+               ) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Expand a solution of the MNA system, which may have been pruned, memoized and reduced, to the whole circuit
+        """
+        solution = voltages, resistor_currents, source_currents
+        if self.reduction is not None:
+            solution = self.reduction.expand(*solution)
+        if self.patterns is not None:
+            solution = self.patterns.expand(*solution)
+        if self.pruning is not None:
+            solution = self.pruning.expand(*solution)
+        if self.macro_resistors:
+            voltages, resistor_currents, source_currents = solution
+            solution = voltages, resistor_currents[:len(self.resistors_blueprint)], source_currents
+        return solution
+
+    def macro_solution(self, instance: str) -> ({str: float}, {str: float}, {str: float}):
+        """
+        Return the voltages of the nodes, the currents through the resistors and the currents through the voltage sources
+        inside a placed macro, by their names within the macro. Recovered from its port voltages when asked for
+        """
+        if self.system is None:
+            raise Exception("Circuit has not been solved yet")
+
+        macro, port_nodes = self.macros[instance]
+        port_voltages = self.store.node_voltages[[self.store.node_index[port_nodes[port]] for port in macro.ports]]
+        voltages, resistor_currents, source_currents = macro.internal(port_voltages)
+        return (
+            dict(zip(macro.system.node_names, voltages.tolist())),
+            dict(zip(macro.system.resistor_names, resistor_currents.tolist())),
+            dict(zip(macro.system.source_names, source_currents.tolist()))
+        )
 
-    def create_vs_resistors(self, voltage_source: str) -> [(str, str)]:
+    def topology(self) -> tuple:
         """
-        Create resistors out of all voltage sources except the given voltage source
+        Return what identifies this circuit's topology, everything but the resistances and voltages
         """
-        vs_resistors = {}
-        for vs, (_, _from, _to) in self.voltage_sources_blueprint.items():
-            if vs != voltage_source:
-                vs_resistors[vs] = (0.00000000001, _from, _to)
-        return vs_resistors
+        return (
+            self.backend.name,
+            self.prune,
+            self.prereduce,
+            self.memoize,
+            tuple(sorted(self.exponents.items())),
+            tuple(name for name, (ohm, _, _) in self.resistors_blueprint.items() if ohm == 0),
+            tuple(instance for instance, (macro, _) in self.macros.items() if np.any(macro.injections)),
+            tuple(self.nodes_blueprint),
+            tuple((name, a, b) for name, (_, a, b) in self.all_resistors().items()),
+            tuple((name, a, b) for name, (_, a, b) in self.voltage_sources_blueprint.items())
+        )
 
-    def merge_circuits(self, circuits: [SingleVoltCircuit]):
+    def update_resistances(self, resistances: {str: float}):
+        """
+        Change the resistance of some resistors and re-solve,
+        keeping the factorization of the previous solve where possible
         """
-        Merge all Single Volt Circuits into one circuit
+        for name, ohm in resistances.items():
+            _, node1, node2 = self.resistors_blueprint[name]
+            self.resistors_blueprint[name] = (ohm, node1, node2)
+            self.resistors[name].resistance = ohm
+
+        resistances = {name: self.valve_resistance(name) for name in resistances}
+        if self.system is None or not self.update_system(resistances):
+            self.solve()
+        else:
+            self.apply_solution(*self.settle())
+
+    def update_system(self, resistances: {str: float}) -> bool:
         """
-        # Merge all nodes, simply by adding their voltages together across the circuits
-        for node in self.nodes:
-            self.nodes[node].voltage = sum([c.nodes[node].voltage for c in circuits])
+        Change the resistance of some resistors in the system, as low-rank updates of its factorization.
+        Returns False if the system has to be built again instead
+        """
+        # Pruned resistors don't take part in the system, changing the inside of a memoized copy makes it another piece.
+        # Resistances of a reduced system have to be reduced again, only the collapsed resistors they end up in change
+        if self.pruning is not None:
+            resistances = {name: ohm for name, ohm in resistances.items() if name not in self.pruning.pruned}
+        if self.patterns is not None and any(name in self.patterns.inside for name in resistances):
+            return False
+        if self.reduction is not None:
+            # Resistors of zero ohm are left as they are, so one that becomes zero changes what is collapsed
+            if any(ohm == 0 for ohm in resistances.values()):
+                return False
+            resistors = self.pruned_resistors(self.pruning)
+            if self.patterns is not None:
+                resistors = self.patterns.reduced_resistors(resistors)
+            resistances = self.reduction.changed_resistances(resistors, resistances)
+        if not self.system.update_resistances(resistances):
+            return False
+        self.factorization = self.system.factorization
+        return True
+
+    def update_voltages(self, voltages: {str: float}):
+        """
+        Change the voltage of some voltage sources and re-solve, which reuses the factorization as is
+        """
+        for name, volt in voltages.items():
+            _, _from, _to = self.voltage_sources_blueprint[name]
+            self.voltage_sources_blueprint[name] = (volt, _from, _to)
+            self.voltage_sources[name].voltage = volt
+
+        # A pump inside a memoized copy makes it another piece
+        inside = self.patterns is not None and any(name in self.patterns.inside for name in voltages)
+        if self.system is None or inside:
+            self.solve()
+        else:
+            self.system.update_voltages(voltages)
+            self.apply_solution(*self.settle())
+
+    def solve_batch(self, resistances: np.ndarray, voltages: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Solve many variations of this circuit at once, without touching its nodes, resistors and voltage sources.
+        Takes arrays of scenarios x resistors and scenarios x voltage sources, with the columns in blueprint order.
+        Returns the node voltages, resistor currents and voltage source currents as arrays of scenarios x elements,
+        signed from node1 to node2 and from from-node to to-node
+        """
+        if self.exponents or self.check_valves:
+            raise Exception("Batches can only be solved for linear circuits without check valves")
+        if self.macro_resistors:
+            # The resistors standing in for the macros are the same in every scenario
+            resistances = np.atleast_2d(np.asarray(resistances, dtype=float))
+            fixed = np.array([ohm for ohm, _, _ in self.macro_resistors.values()])
+            resistances = np.hstack([resistances, np.tile(fixed, (len(resistances), 1))])
+
+        system = self.system if self.system is not None and self.whole_system() else \
+            MNASystem(self.nodes_blueprint, self.all_resistors(), self.voltage_sources_blueprint, self.injections)
+        voltages, resistor_currents, source_currents = system.solve_batch(resistances, voltages)
+        return voltages, resistor_currents[:, :len(self.resistors_blueprint)], source_currents
+
+    def whole_system(self) -> bool:
+        """
+        Return whether the system is built from the whole circuit, with nothing pruned, memoized or reduced
+        """
+        return self.pruning is None and self.patterns is None and self.reduction is None
 
-        for resistor in self.resistors:
-            # Take the first circuit as the default
-            current: Current = circuits[0].resistors[resistor].current
+    def network_system(self) -> MNASystem:
+        """
+        Return a factorized system of the whole network with the current resistances.
+        That is the solved system itself when nothing was pruned or reduced, otherwise it is kept up to date separately
+        """
+        if self.system is not None and self.whole_system():
+            return self.system
 
-            # For every other circuit
-            for circuit in circuits[1:]:
-                other: Current = circuit.resistors[resistor].current
+        resistors = self.all_resistors()
+        if self.network is None or not self.network.update_values(resistors, self.voltage_sources_blueprint):
+            self.network = MNASystem(self.nodes_blueprint, resistors, self.voltage_sources_blueprint)
+            self.network.factorize(self.backend)
+        return self.network
 
-                if current.source == other.source:
-                    current.amps += other.amps
-                else:
-                    if current.amps > other.amps:
-                        current.amps -= other.amps
-                    else:
-                        current.source, current.target = other.source, other.target
-                        current.amps = other.amps - current.amps
+    def effective_resistances(self, pairs: [(str, str)]) -> np.ndarray:
+        """
+        Return the effective (Thevenin) resistance between every given pair of nodes, with every pump shorted.
+        All pairs are answered by the same factorization, infinite for nodes that aren't connected
+        """
+        if self.exponents:
+            raise Exception("Effective resistances are only defined for linear circuits")
 
-            self.resistors[resistor].current = current
-            self.resistors[resistor].voltage_drop = self.resistors[resistor].current.amps * self.resistors[resistor].resistance
+        system = self.network_system()
+        firsts = np.fromiter((system.node_index[a] for a, _ in pairs), dtype=np.int64, count=len(pairs))
+        seconds = np.fromiter((system.node_index[b] for _, b in pairs), dtype=np.int64, count=len(pairs))
+        return system.effective_resistances(firsts, seconds)
 
-        for voltage_source in self.voltage_sources:
-            original = [c.voltage_source for c in circuits if c.voltage_source.name == voltage_source][0]
-            replacements = [c.resistors[voltage_source] for c in circuits if voltage_source in c.resistors]
+    def sensitivities(self, weights: {str: float}, flow_floor: float = 1e-6) -> {str: float}:
+        """
+        Return the derivative of a weighted sum of currents with respect to the resistance of every resistor,
+        as {resistor: derivative}. Weights are given by resistor and voltage source name, for their currents signed
+        like the solution. All derivatives come from one extra solve, see MNASystem.sensitivities.
+        Nonlinear resistors are differentiated by the coefficient of their power law, against a factorization
+        of the circuit linearized at its solution, flows below flow_floor times the largest flow taken as that large
+        """
+        store = self.store
+        if np.isnan(store.node_voltages).any():
+            raise Exception("Circuit has not been solved yet")
+
+        resistors = self.all_resistors()
+        resistor_weights = np.zeros(len(resistors))
+        source_weights = np.zeros(len(store.source_names))
+        for name, weight in weights.items():
+            if name in store.resistor_index:
+                resistor_weights[store.resistor_index[name]] += weight
+            else:
+                source_weights[store.source_index[name]] += weight
 
-            current = original.current
-            for replacement in replacements:
-                other: Current = replacement.current
+        # The resistors standing in for macros are linear, but their own derivatives aren't asked for
+        currents = np.zeros(len(resistors))
+        currents[:len(store.resistor_names)] = store.resistor_currents
+        system = self.linear_system(currents, flow_floor)
 
-                if current.source == other.source:
-                    current.amps += other.amps
-                else:
-                    if current.amps > other.amps:
-                        current.amps -= other.amps
-                    else:
-                        current.source, current.target = other.source, other.target
-                        current.amps = other.amps - current.amps
+        # How fast the head loss r * q * |q|^(n - 1) grows with its coefficient r
+        exponents = np.array([self.exponents.get(name, 1) for name in resistors])
+        rates = currents * np.abs(currents) ** (exponents - 1)
+        return dict(zip(store.resistor_names, system.sensitivities(resistor_weights, source_weights, rates).tolist()))
 
-            self.voltage_sources[voltage_source].current = current
+    def linear_system(self, currents: np.ndarray, flow_floor: float) -> MNASystem:
+        """
+        Return a factorized system of the whole network that responds to small changes like the circuit does
+        at the given resistor currents. That is the network itself for a linear circuit, nonlinear resistors get
+        the slope of their head loss instead, flows below flow_floor times the largest flow taken as that large
+        """
+        if not self.exponents:
+            return self.network_system()
+
+        # The slope of the head loss r * q * |q|^(n - 1) is the resistance the flows see for small changes
+        resistors = self.all_resistors()
+        exponents = np.array([self.exponents.get(name, 1) for name in resistors])
+        flows = np.maximum(np.abs(currents), flow_floor * max(np.abs(currents).max(initial=0), 1e-300))
+        slopes = {
+            name: (exponents[i] * ohm * flows[i] ** (exponents[i] - 1), a, b)
+            for i, (name, (ohm, a, b)) in enumerate(resistors.items())
+        }
+        system = MNASystem(self.nodes_blueprint, slopes, self.voltage_sources_blueprint)
+        system.factorize(self.backend)
+        return system
+
+    def contingencies(self, chunk: int = 256, flow_floor: float = 1e-6) -> {str: (str, float, float)}:
+        """
+        Return what blocking every resistor and voltage source on its own does to the rest of the circuit,
+        as {blocked element: (the element whose current changes the most, its current before, its current after)},
+        the outages with the largest change first. Every outage is a rank-1 downdate of the same factorization,
+        see MNASystem.outages, a chunk of them solved at a time. Nonlinear resistors are linearized at the solution
+        and check valves stay open or blocked, so for those circuits the changes are first-order estimates.
+        An outage that leaves the circuit without a solution has NaN for the current after
+        """
+        store = self.store
+        if np.isnan(store.node_voltages).any():
+            raise Exception("Circuit has not been solved yet")
+
+        currents = np.zeros(len(self.all_resistors()))
+        currents[:len(store.resistor_names)] = store.resistor_currents
+        system = self.linear_system(currents, flow_floor)
+
+        # The circuit's own resistors and voltage sources, the macros' resistors aren't blocked or reported
+        names = [*store.resistor_names, *store.source_names]
+        own = len(store.resistor_names)
+        before = np.concatenate([store.resistor_currents, store.source_currents])
+
+        impacts = {}
+        for start in range(0, len(names), chunk):
+            outages = np.arange(start, min(start + chunk, len(names)))
+            resistor_changes, source_changes = system.outages(
+                outages[outages < own], outages[outages >= own] - own, currents, store.source_currents
+            )
+            changes = np.vstack([resistor_changes[:own], source_changes])
+
+            # The blocked element itself doesn't count, it simply stops. NaN wins, an unsolvable outage is the worst
+            changes[outages, np.arange(len(outages))] = 0
+            worst = np.argmax(np.abs(changes), axis=0)
+            for column, (outage, element) in enumerate(zip(outages.tolist(), worst.tolist())):
+                after = before[element] + changes[element, column]
+                impacts[names[outage]] = (names[element], float(before[element]), float(after))
+
+        return dict(sorted(impacts.items(), key=lambda item: -np.nan_to_num(abs(item[1][2] - item[1][1]), nan=np.inf)))
+
+    def contributions(self) -> {str: {str: float}}:
+        """
+        Return the current every voltage source contributes to every resistor and voltage source on its own,
+        as {voltage source: {element: amps}}. The amps are signed along the element's total current,
+        so a voltage source working against it contributes negative amps
+        """
+        if self.system is None:
+            raise Exception("Circuit has not been solved yet")
+        if self.exponents or self.check_valves:
+            raise Exception("Contributions of the voltage sources only add up in linear circuits without check valves")
+        if any(self.injections.values()) or (self.patterns is not None and any(self.patterns.injections.values())):
+            raise Exception(
+                "Contributions of the voltage sources don't add up when macros or repeated pieces have pumps inside"
+            )
+
+        _, resistor_currents, source_currents = self.expand(*self.system.contributions())
+
+        # Signs that turn the node1 -> node2 and from -> to currents into currents along the total current
+        resistor_currents = resistor_currents * np.where(self.store.resistor_currents >= 0, 1, -1)[:, None]
+        source_currents = source_currents * np.where(self.store.source_currents >= 0, 1, -1)[:, None]
+
+        return {
+            source: {
+                **dict(zip(self.resistors_blueprint, resistor_currents[:, k].tolist())),
+                **dict(zip(self.voltage_sources_blueprint, source_currents[:, k].tolist()))
+            }
+            for k, source in enumerate(self.voltage_sources_blueprint)
+        }
+
+    def apply_solution(self, voltages: np.ndarray, resistor_currents: np.ndarray, source_currents: np.ndarray):
+        """
+        Store the solved voltages and currents, which are given in blueprint order.
+        The arrays are kept as they are, the nodes, resistors and voltage sources read straight from them
+        """
+        self.store.set_results(voltages, resistor_currents, source_currents)
+
+    def solver_stats(self) -> {str: float}:
+        """
+        Return the size, fill-in and timing of the last factorization, to keep an eye on the solver's memory use
+        """
+        if self.factorization is None:
+            raise Exception("Circuit has not been solved yet")
+        return self.factorization.stats()
 
 
+# An example, run it from the root of the repository with python -m simulator.circuit, as the imports above
+# need the simulator package. Running the file itself (python simulator/circuit.py) can't find that package
 if __name__ == '__main__':
     # List of node names
     N = ["alpha", "beta", "gamma", "delta", "epsilon"]
@@ -2,3 +2,4 @@ from simulator.components.gate_valve import GateValve
 from simulator.components.threeway_valve import ThreewayValve
 from simulator.components.pump import Pump
 from simulator.components.fitting import Fitting
+from simulator.components.check_valve import CheckValve
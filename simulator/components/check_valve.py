@@ -0,0 +1,29 @@
+from simulator import Connection
+from simulator.components.gate_valve import GateValve
+from simulator.component import Component
+
+
+class CheckValve(GateValve):
+    """
+    A gate valve that only lets water through in one direction, from its inlet to the side it points at
+    """
+
+    def __init__(self, pos: (int, int) = (0, 0)):
+        GateValve.__init__(self, pos)
+        self.title = "Check Valve"
+        self.load_image("images/checkvalve.png")
+
+        self.direction = "S"
+        self.opposite_direction = "N"
+
+    def rotate(self, clockwise=True):
+        Component.rotate(self, clockwise)
+
+        cw = 1 if clockwise else -1
+        self.direction = "NESW"[("NESW".index(self.direction) + cw) % 4]
+        self.opposite_direction = "NESW"[("NESW".index(self.opposite_direction) + cw) % 4]
+
+    def get_from_to(self) -> (Connection, Connection):
+        _from = next(c for c in self.connections if c.direction == self.opposite_direction)
+        _to = next(c for c in self.connections if c.direction == self.direction)
+        return _from, _to
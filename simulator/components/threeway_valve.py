@@ -1,7 +1,7 @@
 import pygame
 from pygame import Surface, Rect
 
-from engine import text, colors, maths
+from engine import text, colors, maths, director
 
 from simulator import Connection, Inspectable
 from simulator.component import Component
@@ -61,10 +61,14 @@ class ThreewayValve(Component, Inspectable):
                 # Open side selection
                 sides = {conn.direction for conn in self.connections}
                 for side, triangle in self.triangles.items():
-                    if side in sides:
+                    if side in sides and side != self.open_side:
                         if maths.point_in_triangle(mouse, triangle):
                             self.open_side = side
 
+                            # The valve's sides changed, so the whole circuit has to be parsed again
+                            if director.scene.simulating:
+                                director.scene.parse_circuit()
+
                 # Slider
                 if self.slider_rect.collidepoint(*mouse):
                     self.slider_dragging = True
@@ -80,7 +84,12 @@ class ThreewayValve(Component, Inspectable):
             d1 = self.slider_rect.right - self.slider_rect.left
             d2 = x - self.slider_rect.left
             # clamp to prevent division by zero errors
-            self.blue_part = maths.clamp(d2 / d1, 0.01, 0.99)
+            blue_part = maths.clamp(d2 / d1, 0.01, 0.99)
+
+            if blue_part != self.blue_part:
+                self.blue_part = blue_part
+                if director.scene.simulating:
+                    director.scene.retune(self)
 
     def render(self, surface: Surface):
         Inspectable.render(self, surface)
@@ -11,7 +11,7 @@ So for that reason, all inspectable components have a numeric input box with var
 import pygame
 from pygame import Surface, Rect
 
-from engine import colors, text, ui, maths, debug
+from engine import colors, text, ui, maths, debug, director
 
 
 class Inspectable:
@@ -75,3 +75,7 @@ class Inspectable:
     def input_change(self):
         if maths.is_numeric(self.input.text) and self.input.text:
             self.text_value = float(self.input.text)
+
+            # Keep a running simulation up to date with the new value
+            if director.scene.simulating:
+                director.scene.retune(self)
@@ -0,0 +1,97 @@
+"""
+Macros, sub-assemblies drawn many times over, like pump skids and manifolds
+
+A macro is a small circuit of its own that only connects to the rest through its ports. Its internal nodes are
+eliminated once by Kron reduction: the conductance matrix of the ports is the Schur complement of the internal part
+of its MNA matrix, and its pumps become currents injected into the ports (a Norton equivalent).
+Every placed copy adds a resistor between every pair of ports and those injections to the circuit, however many
+elements the macro has inside. Its internal voltages and currents are recovered from the port voltages when asked for
+"""
+
+import numpy as np
+from scipy.sparse.linalg import splu
+
+from simulator.mna import MNASystem
+
+
+class Macro:
+    """
+    A reusable group of resistors and voltage sources with the given nodes as its ports.
+    Every part of it needs resistance to at least one of its ports, and it has to be linear
+    """
+
+    def __init__(self,
+                 nodes: [str],
+                 resistors: {str: (float, str, str)},
+                 voltage_sources: {str: (float, str, str)},
+                 ports: [str]
+                 ):
+        if len(set(ports)) != len(ports) or any(port not in nodes for port in ports):
+            raise Exception("Ports of a macro have to be different nodes of it")
+
+        self.ports = list(ports)
+        self.system = MNASystem(nodes, resistors, voltage_sources, grounded=False)
+
+        # Port voltages first, then the internal node voltages and branch currents
+        matrix = self.system.sparse_matrix()
+        self.port_rows = self.system.rows[[self.system.node_index[port] for port in self.ports]]
+        interior = np.ones(self.system.size, dtype=bool)
+        interior[self.port_rows] = False
+        self.interior_rows = np.flatnonzero(interior)
+
+        interior_matrix = matrix[self.interior_rows][:, self.interior_rows].tocsc()
+        self.coupling = matrix[self.interior_rows][:, self.port_rows].toarray()
+        port_coupling = matrix[self.port_rows][:, self.interior_rows].toarray()
+        try:
+            self.lu = splu(interior_matrix) if len(self.interior_rows) else None
+        except RuntimeError:
+            raise Exception("Macro can't be reduced, every part of it needs resistance to one of its ports")
+
+        # Kron reduction, the current flowing into the ports is conductance @ port voltages - injections
+        rhs = self.system.rhs()[self.interior_rows]
+        port_matrix = matrix[self.port_rows][:, self.port_rows].toarray()
+        if self.lu is None:
+            self.conductance = port_matrix
+            self.injections = np.zeros(len(self.ports))
+        else:
+            self.conductance = port_matrix - port_coupling @ self.lu.solve(self.coupling)
+            self.injections = -port_coupling @ self.lu.solve(rhs)
+
+        # What goes into the ports comes out of them again, so a single port gets nothing but rounding errors
+        if len(self.ports) == 1:
+            self.injections[:] = 0
+
+    def place(self, instance: str, port_nodes: {str: str}) -> ({str: (float, str, str)}, {str: float}):
+        """
+        Return the resistors and injected currents that stand in for a copy of this macro,
+        with its ports connected to the given nodes. The resistors are named after the instance and their ports
+        """
+        nodes = [port_nodes[port] for port in self.ports]
+        tolerance = 1e-12 * np.abs(self.conductance).max(initial=0)
+
+        resistors = {}
+        for i in range(len(self.ports)):
+            for j in range(i + 1, len(self.ports)):
+                g = -self.conductance[i, j]
+                if g > tolerance:
+                    resistors[f"{instance}.{self.ports[i]}-{self.ports[j]}"] = (1 / g, nodes[i], nodes[j])
+
+        # Only nodes that get something injected, without pumps the port nodes can be reduced like any other
+        injections = {}
+        for node, amps in zip(nodes, self.injections.tolist()):
+            if amps:
+                injections[node] = injections.get(node, 0) + amps
+        return resistors, injections
+
+    def internal(self, port_voltages: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Return the node voltages, resistor currents and voltage source currents inside a copy of this macro,
+        given the voltages of its ports, in the order of the macro's blueprints.
+        Takes the port voltages of many copies as columns as well, which are all solved for at once
+        """
+        x = np.empty((self.system.size,) + port_voltages.shape[1:])
+        x[self.port_rows] = port_voltages
+        if self.lu is not None:
+            rhs = self.system.rhs()[self.interior_rows].reshape((-1,) + (1,) * (port_voltages.ndim - 1))
+            x[self.interior_rows] = self.lu.solve(rhs - self.coupling @ port_voltages)
+        return self.system.unpack(x)
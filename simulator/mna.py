@@ -0,0 +1,1245 @@
+"""
+Modified Nodal Analysis (MNA), solving a whole circuit in a single linear solve
+
+The unknowns are the voltages of all nodes and the currents through all voltage sources.
+Every pump takes part in the same system, so no superposition of single-source circuits is needed.
+"""
+
+import copy
+import os
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import count
+
+import numpy as np
+from scipy import sparse
+from scipy.linalg import lu_factor, lu_solve, cho_factor, cho_solve
+from scipy.sparse.csgraph import reverse_cuthill_mckee, connected_components
+from scipy.sparse.linalg import splu, cg, LinearOperator
+
+from time import perf_counter
+
+
+class MNASystem:
+    """
+    A circuit indexed for Modified Nodal Analysis.
+
+    Every connected part of the circuit gets one grounded node, which is kept at 0V and left out of the matrix.
+    Resistors with a resistance of zero can't be stamped as a conductance,
+    so they get a branch current of their own, just like a voltage source of 0V.
+    Currents can be injected into nodes from outside the circuit, as node name -> amps.
+    An ungrounded system keeps every node in the matrix, which makes it singular, for eliminating nodes from it
+    """
+
+    # Numbers the structures of the systems, a copy keeps the number of the system it was copied from
+    structures = count()
+
+    def __init__(self,
+                 nodes: [str],
+                 resistors: {str: (float, str, str)},
+                 voltage_sources: {str: (float, str, str)},
+                 injections: {str: float} = None,
+                 grounded: bool = True
+                 ):
+        self.node_names = list(nodes)
+        self.node_index = {name: i for i, name in enumerate(self.node_names)}
+        self.resistor_names = list(resistors)
+        self.resistor_index = {name: i for i, name in enumerate(self.resistor_names)}
+        self.source_names = list(voltage_sources)
+        self.source_index = {name: i for i, name in enumerate(self.source_names)}
+
+        # Endpoints of every resistor (node1, node2) and voltage source (from, to) as node indices
+        self.resistor_ends = self.index_ends(resistors)
+        self.source_ends = self.index_ends(voltage_sources)
+
+        self.resistances = np.array([r for r, _, _ in resistors.values()], dtype=float)
+        self.voltages = np.array([v for v, _, _ in voltage_sources.values()], dtype=float)
+        self.injections = self.index_injections(injections or {})
+
+        # Zero resistors are treated as branches, like the voltage sources, unless both their ends are the same node
+        a, b = self.resistor_ends.T
+        self.shorts = np.flatnonzero((self.resistances == 0) & (a != b))
+        self.branch_ends = np.concatenate([self.source_ends[:, ::-1], self.resistor_ends[self.shorts]])
+
+        if self.has_branch_loop():
+            raise Exception("Circuit can't be solved, are there pumps connected in a loop without any valves?")
+
+        # The matrix row of every node, -1 for the grounded nodes
+        self.grounds = self.find_grounds() if grounded else np.empty(0, dtype=np.int64)
+        self.rows = np.full(len(self.node_names), -1, dtype=np.int64)
+        free = np.setdiff1d(np.arange(len(self.node_names)), self.grounds)
+        self.rows[free] = np.arange(len(free))
+
+        self.node_count = len(free)
+        self.size = self.node_count + len(self.branch_ends)
+        self.structure = next(MNASystem.structures)
+
+        # The factorization of the last solve, kept around for inspecting its cost and for re-solving
+        self.factorization = None
+        self.solution = None
+
+        # Resistors changed since the factorization, as resistor index -> the factorized resistance
+        self.updated = {}
+        self.update_columns = {}
+
+    def copy(self) -> "MNASystem":
+        """
+        Return a copy with values and updates of its own, so updating it leaves this system alone.
+        The structure and the factorization are shared, they're never changed in place
+        """
+        system = copy.copy(self)
+        system.resistances = self.resistances.copy()
+        system.voltages = self.voltages.copy()
+        system.injections = self.injections.copy()
+        system.updated = dict(self.updated)
+        system.update_columns = dict(self.update_columns)
+        return system
+
+    def index_ends(self, elements: {str: (float, str, str)}) -> np.ndarray:
+        """
+        Return the two end nodes of every element as an array of node indices
+        """
+        ends = [(self.node_index[a], self.node_index[b]) for _, a, b in elements.values()]
+        return np.array(ends, dtype=np.int64).reshape(-1, 2)
+
+    def index_injections(self, injections: {str: float}) -> np.ndarray:
+        """
+        Return the currents injected into every node, by node index
+        """
+        currents = np.zeros(len(self.node_names))
+        for name, amps in injections.items():
+            currents[self.node_index[name]] += amps
+        return currents
+
+    def has_branch_loop(self) -> bool:
+        """
+        Return whether the voltage sources and zero resistors form a loop, which leaves the circuit unsolvable
+        """
+        parent = list(range(len(self.node_names)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for a, b in self.branch_ends.tolist():
+            if find(a) == find(b):
+                return True
+            parent[find(a)] = find(b)
+        return False
+
+    def find_grounds(self) -> np.ndarray:
+        """
+        Pick one node to ground in every connected part of the circuit.
+        The negative node of a voltage source is preferred, otherwise the first node will do
+        """
+        parent = list(range(len(self.node_names)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for a, b in np.concatenate([self.resistor_ends, self.source_ends]).tolist():
+            parent[find(a)] = find(b)
+
+        grounds = {}
+        for neg, _ in self.source_ends.tolist():
+            grounds.setdefault(find(neg), neg)
+        for i in range(len(self.node_names)):
+            grounds.setdefault(find(i), i)
+
+        return np.array(sorted(grounds.values()), dtype=np.int64)
+
+    def components(self) -> np.ndarray:
+        """
+        Return the connected part of the circuit every node belongs to, numbered from 0
+        """
+        ends = np.concatenate([self.resistor_ends, self.source_ends])
+        count = len(self.node_names)
+        graph = sparse.csr_matrix((np.ones(len(ends)), (ends[:, 0], ends[:, 1])), shape=(count, count))
+        return connected_components(graph, directed=False)[1]
+
+    def conductance_stamps(self) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        """
+        Return where the conductance of every non-zero resistor goes in the MNA matrix,
+        as (row, column, resistor index, sign) quadruplets
+        """
+        conducting = np.flatnonzero(self.resistances != 0)
+        a, b = self.rows[self.resistor_ends[conducting]].T
+        rows = np.concatenate([a, b, a, b])
+        columns = np.concatenate([a, b, b, a])
+        resistors = np.tile(conducting, 4)
+        signs = np.repeat([1.0, 1.0, -1.0, -1.0], len(conducting))
+
+        keep = (rows >= 0) & (columns >= 0)
+        return rows[keep], columns[keep], resistors[keep], signs[keep]
+
+    def branch_stamps(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Return the incidence of the branches in the MNA matrix as (row, column, value) triplets,
+        +1 on the side the branch current leaves from
+        """
+        branch_columns = self.node_count + np.arange(len(self.branch_ends))
+        p, q = self.rows[self.branch_ends].T if len(self.branch_ends) else np.empty((2, 0), dtype=np.int64)
+        ones = np.ones(len(self.branch_ends))
+        rows = np.concatenate([p, branch_columns, q, branch_columns])
+        columns = np.concatenate([branch_columns, p, branch_columns, q])
+        values = np.concatenate([ones, ones, -ones, -ones])
+
+        keep = (rows >= 0) & (columns >= 0)
+        return rows[keep], columns[keep], values[keep]
+
+    def triplets(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Return the MNA matrix as (row, column, value) triplets, duplicates are meant to be summed
+        """
+        rows, columns, resistors, signs = self.conductance_stamps()
+        branch_rows, branch_columns, branch_values = self.branch_stamps()
+
+        return (
+            np.concatenate([rows, branch_rows]),
+            np.concatenate([columns, branch_columns]),
+            np.concatenate([signs / self.resistances[resistors], branch_values])
+        )
+
+    def matrix(self) -> np.ndarray:
+        """
+        Assemble the MNA matrix as a dense array
+        """
+        matrix = np.zeros((self.size, self.size))
+        rows, columns, values = self.triplets()
+        np.add.at(matrix, (rows, columns), values)
+        return matrix
+
+    def sparse_matrix(self) -> sparse.csc_matrix:
+        """
+        Assemble the MNA matrix in compressed sparse column form
+        """
+        rows, columns, values = self.triplets()
+        return sparse.csc_matrix((values, (rows, columns)), shape=(self.size, self.size))
+
+    def rhs(self) -> np.ndarray:
+        """
+        Assemble the right-hand side, the currents injected into the nodes and the voltages of the voltage sources
+        """
+        rhs = np.zeros(self.size)
+        free = self.rows >= 0
+        rhs[self.rows[free]] = self.injections[free]
+        rhs[self.node_count:self.node_count + len(self.voltages)] = self.voltages
+        return rhs
+
+    def factorize(self, backend: "Backend"):
+        """
+        Factorize the MNA matrix with the given backend, folding in all resistance updates
+        """
+        self.factorization = backend.factorize(self)
+        self.solution = None
+        self.updated = {}
+        self.update_columns = {}
+
+    def solve(self, backend: "Backend" = None) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Solve the circuit, returning the node voltages, resistor currents and voltage source currents.
+        Resistor currents flow from node1 to node2, voltage source currents flow from their from- to their to-node.
+        The factorization is reused when no backend is given
+        """
+        if backend is not None or self.factorization is None:
+            self.factorize(backend or DenseBackend())
+
+        if self.solution is None:
+            self.solution = self.factorization.solve(self.rhs())
+
+        return self.unpack(self.apply_updates(self.solution))
+
+    def update_resistances(self, resistances: {str: float}, max_rank: int = 16) -> bool:
+        """
+        Change the resistance of some resistors without refactorizing.
+        Every changed conductance is a rank-1 update of the matrix, applied with the Woodbury identity on the next solve.
+        Returns False when the change can't be applied like that, as zero resistors change the shape of the system
+        """
+        indices = [self.resistor_index[name] for name in resistances]
+        if any(self.resistances[i] == 0 or resistances[name] == 0 for i, name in zip(indices, resistances)):
+            return False
+
+        for i, name in zip(indices, resistances):
+            self.updated.setdefault(i, self.resistances[i])
+            self.resistances[i] = resistances[name]
+
+        # Too many updates make the Woodbury correction more expensive than starting over,
+        # and iterative backends are cheaper to set up again than to correct
+        if len(self.updated) > max_rank or not self.factorization.backend.low_rank:
+            self.factorize(self.factorization.backend)
+
+        return True
+
+    def update_voltages(self, voltages: {str: float}):
+        """
+        Change the voltage of some voltage sources. Only the right-hand side depends on them,
+        so the next solve reuses the factorization as is
+        """
+        for name, volt in voltages.items():
+            self.voltages[self.source_index[name]] = volt
+        self.solution = None
+
+    def update_injections(self, injections: {str: float}):
+        """
+        Change the currents injected into the nodes, which like voltages only changes the right-hand side
+        """
+        currents = self.index_injections(injections)
+        if np.any(currents != self.injections):
+            self.injections = currents
+            self.solution = None
+
+    def update_values(self,
+                      resistors: {str: (float, str, str)},
+                      voltage_sources: {str: (float, str, str)},
+                      injections: {str: float} = None
+                      ) -> bool:
+        """
+        Bring all resistances, voltages and injected currents up to date with the given blueprints of the same topology.
+        Returns False if the system has to be rebuilt instead
+        """
+        resistances = {
+            name: ohm for name, (ohm, _, _) in resistors.items() if ohm != self.resistances[self.resistor_index[name]]
+        }
+        if resistances and not self.update_resistances(resistances):
+            return False
+
+        voltages = {
+            name: volt for (name, (volt, _, _)), old in zip(voltage_sources.items(), self.voltages.tolist()) if volt != old
+        }
+        if voltages:
+            self.update_voltages(voltages)
+        self.update_injections(injections or {})
+        return True
+
+    def contributions(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Solve for every voltage source on its own, with all other voltage sources at 0V and nothing injected.
+        Returns the node voltages, resistor currents and voltage source currents like solve does,
+        but with one column per voltage source. Summing the columns gives the full solution
+        """
+        rhs = np.zeros((self.size, len(self.source_names)))
+        sources = np.arange(len(self.source_names))
+        rhs[self.node_count + sources, sources] = self.voltages
+
+        return self.unpack(self.apply_updates(self.factorization.solve(rhs)))
+
+    def effective_resistances(self, firsts: np.ndarray, seconds: np.ndarray, chunk: int = 256) -> np.ndarray:
+        """
+        Return the effective resistance between every pair of nodes, given as two arrays of node indices.
+        That is the voltage across a pair when 1A flows in at its first node and out at its second, with every voltage
+        source shorted. The matrix does just that with the voltages left out of the right-hand side, so all pairs are
+        solved against its factorization, a chunk of them at a time. Unconnected nodes have infinite resistance
+        """
+        firsts, seconds = np.asarray(firsts, dtype=np.int64), np.asarray(seconds, dtype=np.int64)
+        resistances = np.full(len(firsts), np.inf)
+        resistances[firsts == seconds] = 0
+
+        components = self.components()
+        pending = np.flatnonzero((components[firsts] == components[seconds]) & (firsts != seconds))
+        for start in range(0, len(pending), chunk):
+            pairs = pending[start:start + chunk]
+            columns = np.arange(len(pairs))
+            a, b = self.rows[firsts[pairs]], self.rows[seconds[pairs]]
+
+            # Grounded nodes have no row, the current flows in or out through the ground
+            rhs = np.zeros((self.size, len(pairs)))
+            rhs[a[a >= 0], columns[a >= 0]] = 1
+            rhs[b[b >= 0], columns[b >= 0]] = -1
+            x = self.apply_updates(self.factorization.solve(rhs))
+
+            # Row -1 reads the zero voltage of the ground
+            x = np.vstack([x, np.zeros(len(pairs))])
+            resistances[pairs] = x[a, columns] - x[b, columns]
+
+        return resistances
+
+    def sensitivities(self, resistor_weights: np.ndarray, source_weights: np.ndarray, rates: np.ndarray) -> np.ndarray:
+        """
+        Return the derivative of a weighted sum of the resistor and voltage source currents with respect to every resistor.
+        The adjoint method gets them all from a single solve: the matrix is symmetric, so the adjoint of the sum is
+        solved against the same factorization, and every resistor's derivative only needs the adjoint across its ends.
+
+        Rates give how fast every resistor's head loss grows with what the derivative is taken to, at its present flow.
+        That is its current for a linear resistor. For a nonlinear one the system has to be factorized with
+        the incremental resistances at the solution, so the derivative is the one of its power law coefficient
+        """
+        resistor_weights = np.asarray(resistor_weights, dtype=float)
+        source_weights = np.asarray(source_weights, dtype=float)
+        conducting = (self.resistances != 0) & ~np.isin(np.arange(len(self.resistor_names)), self.shorts)
+
+        # A resistor's current reads the voltages across it, a zero resistor's and a voltage source's read their branch
+        target = np.zeros(self.size + 1)
+        with np.errstate(divide="ignore"):
+            conductances = np.where(conducting, 1 / self.resistances, 0)
+        a, b = self.rows[self.resistor_ends].T
+        np.add.at(target, a, resistor_weights * conductances)
+        np.add.at(target, b, -resistor_weights * conductances)
+        target[self.node_count + len(self.source_names) + np.arange(len(self.shorts))] += resistor_weights[self.shorts]
+        target[self.node_count:self.node_count + len(self.source_names)] -= source_weights
+
+        # Row -1 collects the grounded ends, it reads the zero voltage of the ground afterwards
+        adjoint = np.append(self.apply_updates(self.factorization.solve(target[:-1])), 0)
+
+        # A resistor changes every current through the voltages it moves, and its own current directly as well
+        gradients = conductances * rates * (adjoint[a] - adjoint[b] - resistor_weights)
+        gradients[self.shorts] = adjoint[self.node_count + len(self.source_names) + np.arange(len(self.shorts))] * \
+            rates[self.shorts]
+        return gradients
+
+    def outages(self, resistors: np.ndarray, sources: np.ndarray, resistor_currents: np.ndarray,
+                source_currents: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        Return how every current changes when one of the given resistors or voltage sources (by index) is blocked,
+        with a column per outage, the resistors first. The currents are those of the solution the changes are from.
+
+        Blocking a conducting resistor takes its conductance g out of the matrix, a rank-1 downdate. By Sherman-Morrison
+        the solution moves by w * i / (1 - g u'w), with u its incidence, w = M^-1 u and i its current.
+        A branch, a voltage source or a zero resistor, is blocked by changing its voltage until no current flows
+        through it, which is no different from leaving it out. Either way every outage takes one solve against
+        the same factorization. An outage that cuts off part of the circuit only changes anything when current
+        still has to flow across the cut, that leaves the circuit without a solution and its column NaN
+        """
+        resistors, sources = np.asarray(resistors, dtype=np.int64), np.asarray(sources, dtype=np.int64)
+        with np.errstate(divide="ignore"):
+            conductances = np.where(self.resistances != 0, 1 / self.resistances, 0)
+        conductances[self.shorts] = 0
+
+        # A unit change across every blocked element: its incidence, or the voltage of its branch
+        conducting = ~np.isin(resistors, self.shorts)
+        shorts = np.searchsorted(self.shorts, resistors[~conducting])
+        branches = np.concatenate([self.node_count + sources, self.node_count + len(self.source_names) + shorts])
+        branch_outages = np.concatenate([np.flatnonzero(~conducting), len(resistors) + np.arange(len(sources))])
+        columns = np.zeros((self.size, len(resistors) + len(sources)))
+        columns[:, np.flatnonzero(conducting)] = self.incidence(resistors[conducting].tolist())
+        columns[branches, branch_outages] = 1
+        w = self.apply_updates(self.factorization.solve(columns))
+
+        # What the blocked element carries now, and how much of it the rest of the circuit takes over per unit of it.
+        # Row -1 reads the zero voltage of the ground
+        padded = np.vstack([w, np.zeros(len(resistors) + len(sources))])
+        a, b = self.rows[self.resistor_ends].T
+        own = np.arange(len(resistors))
+        currents = np.concatenate([resistor_currents[resistors], -source_currents[sources]])
+        through = np.ones(len(currents))
+        through[own] = 1 - conductances[resistors] * (padded[a[resistors], own] - padded[b[resistors], own])
+        through[branch_outages] = -w[branches, branch_outages]
+
+        # A branch takes over through the conductance the circuit has across it, a resistor through the fraction left
+        tolerance = np.full(len(currents), 1e-12)
+        tolerance[branch_outages] *= conductances.max(initial=1)
+        scale = np.abs(np.concatenate([resistor_currents, source_currents])).max(initial=0)
+        cut = np.abs(through) <= tolerance
+        unsolvable = cut & (np.abs(currents) > 1e-12 * scale)
+        factors = np.zeros(len(currents))
+        factors[~cut] = currents[~cut] / through[~cut]
+
+        # Like unpack, but the voltages only ever matter across the resistors
+        resistor_changes = (padded[a] - padded[b]) * conductances[:, None] * factors
+        resistor_changes[self.shorts] = w[self.node_count + len(self.source_names):] * factors
+        source_changes = -w[self.node_count:self.node_count + len(self.source_names)] * factors
+        resistor_changes[:, unsolvable] = np.nan
+        source_changes[:, unsolvable] = np.nan
+
+        # The blocked element itself carries nothing at all afterwards
+        resistor_changes[resistors, own] = -resistor_currents[resistors]
+        source_changes[sources, len(resistors) + np.arange(len(sources))] = -source_currents[sources]
+        return resistor_changes, source_changes
+
+    def solve_batch(self, resistances: np.ndarray, voltages: np.ndarray, memory: int = 2 ** 28
+                    ) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Solve many scenarios of this topology at once, with a row of resistances and voltages per scenario.
+        Returns the node voltages, resistor currents and voltage source currents with a row per scenario.
+        Scenarios are solved in chunks of stacked dense matrices taking up to the given number of bytes,
+        larger circuits get a sparse factorization per scenario instead
+        """
+        resistances = np.atleast_2d(np.asarray(resistances, dtype=float))
+        voltages = np.atleast_2d(np.asarray(voltages, dtype=float))
+        if resistances.shape[1] != len(self.resistor_names) or voltages.shape[1] != len(self.source_names):
+            raise Exception("Batch needs a column for every resistor and every voltage source")
+        if len(resistances) != len(voltages):
+            raise Exception("Batch needs as many rows of resistances as rows of voltages")
+        if np.any((resistances == 0) != (self.resistances == 0)):
+            raise Exception("Resistors of zero ohm in a batch have to be the same as in the circuit")
+
+        scenarios = len(resistances)
+        rhs = np.zeros((scenarios, self.size))
+        rhs[:, :self.node_count + len(self.source_names)] = self.rhs()[:self.node_count + len(self.source_names)]
+        rhs[:, self.node_count:self.node_count + len(self.source_names)] = voltages
+
+        x = np.empty((scenarios, self.size))
+        chunk = memory // (8 * self.size ** 2)
+        if chunk >= 1:
+            # The matrix is linear in the conductances, so all scenarios are assembled with one sparse product
+            rows, columns, resistors, signs = self.conductance_stamps()
+            stamp = sparse.csr_matrix(
+                (signs, (rows * self.size + columns, resistors)), shape=(self.size ** 2, len(self.resistor_names))
+            )
+            constant = np.zeros(self.size ** 2)
+            branch_rows, branch_columns, branch_values = self.branch_stamps()
+            np.add.at(constant, branch_rows * self.size + branch_columns, branch_values)
+
+            with np.errstate(divide="ignore"):
+                conductances = np.where(resistances != 0, 1 / resistances, 0)
+
+            for start in range(0, scenarios, chunk):
+                end = min(start + chunk, scenarios)
+                matrices = ((stamp @ conductances[start:end].T).T + constant).reshape(-1, self.size, self.size)
+                try:
+                    x[start:end] = np.linalg.solve(matrices, rhs[start:end, :, None])[..., 0]
+                except np.linalg.LinAlgError:
+                    raise Exception("Circuit can't be solved for every scenario in the batch")
+        else:
+            backend = SparseBackend()
+            original = self.resistances
+            try:
+                for scenario in range(scenarios):
+                    self.resistances = resistances[scenario]
+                    x[scenario] = backend.factorize(self).solve(rhs[scenario])
+            finally:
+                self.resistances = original
+
+        # Split the solutions, like unpack but with the resistances of each scenario
+        node_voltages = np.zeros((scenarios, len(self.node_names)))
+        free = self.rows >= 0
+        node_voltages[:, free] = x[:, self.rows[free]]
+
+        a, b = self.resistor_ends.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            resistor_currents = (node_voltages[:, a] - node_voltages[:, b]) / resistances
+        branch_currents = x[:, self.node_count:]
+        resistor_currents[:, self.shorts] = branch_currents[:, len(self.source_names):]
+        resistor_currents[:, a == b] = 0
+        source_currents = -branch_currents[:, :len(self.source_names)]
+
+        return node_voltages, resistor_currents, source_currents
+
+    def incidence(self, indices: [int]) -> np.ndarray:
+        """
+        Return the columns of the matrix's incidence of the given resistors, +1 on node1 and -1 on node2
+        """
+        columns = np.zeros((self.size, len(indices)))
+        for k, (a, b) in enumerate(self.rows[self.resistor_ends[indices]].tolist()):
+            if a >= 0:
+                columns[a, k] += 1
+            if b >= 0:
+                columns[b, k] -= 1
+        return columns
+
+    def apply_updates(self, x: np.ndarray) -> np.ndarray:
+        """
+        Correct a solution of the factorized matrix for the resistors updated since, using the Woodbury identity:
+        (M + U C U')^-1 b = x - W (I + C U' W)^-1 C U' x, with x = M^-1 b and W = M^-1 U
+        """
+        if not self.updated:
+            return x
+
+        indices = list(self.updated)
+        u = self.incidence(indices)
+
+        # Solving for a resistor's incidence column is the expensive part, so those are kept for the next updates
+        missing = [i for i in indices if i not in self.update_columns]
+        if missing:
+            solved = self.factorization.solve(u[:, [indices.index(i) for i in missing]])
+            for k, i in enumerate(missing):
+                self.update_columns[i] = solved[:, k]
+        w = np.column_stack([self.update_columns[i] for i in indices])
+
+        factorized = np.array([self.updated[i] for i in indices])
+        dg = 1 / self.resistances[indices] - 1 / factorized
+
+        small = np.eye(len(indices)) + dg[:, None] * (u.T @ w)
+        return x - w @ np.linalg.solve(small, dg.reshape((-1,) + (1,) * (x.ndim - 1)) * (u.T @ x))
+
+    def unpack(self, x: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Split a solution vector into the node voltages, resistor currents and voltage source currents.
+        A matrix of solutions gets split column by column
+        """
+        voltages = np.zeros((len(self.node_names),) + x.shape[1:])
+        free = self.rows >= 0
+        voltages[free] = x[self.rows[free]]
+
+        # A branch current leaves the positive side of its branch, a voltage source pushes it out of the other side
+        branch_currents = x[self.node_count:]
+        source_currents = -branch_currents[:len(self.source_names)]
+
+        a, b = self.resistor_ends.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            resistor_currents = (voltages[a] - voltages[b]) / self.resistances.reshape((-1,) + (1,) * (x.ndim - 1))
+        resistor_currents[self.shorts] = branch_currents[len(self.source_names):]
+        resistor_currents[a == b] = 0
+
+        # Flush numerical noise to an exact zero, dead ends and the like should carry no current at all
+        currents = np.concatenate([resistor_currents, source_currents])
+        tolerance = 1e-12 * np.abs(currents).max(initial=0)
+        resistor_currents[np.abs(resistor_currents) < tolerance] = 0
+        source_currents[np.abs(source_currents) < tolerance] = 0
+
+        return voltages, resistor_currents, source_currents
+
+
+"""
+Backends
+"""
+
+
+class Factorization:
+    """
+    A factorized MNA matrix, ready to solve for any right-hand side
+    """
+
+    def __init__(self, backend: "Backend", size: int, matrix_nnz: int, nnz: int, time: float):
+        self.backend = backend
+        self.size = size
+        self.matrix_nnz = matrix_nnz
+        self.nnz = nnz  # Stored entries in the factors, including fill-in
+        self.time = time  # Seconds spent factorizing
+
+    def solve(self, rhs: np.ndarray) -> np.ndarray:
+        """
+        Solve for a right-hand side vector, or for every column of a right-hand side matrix
+        """
+        raise NotImplementedError()
+
+    def stats(self) -> {str: float}:
+        """
+        Return the numbers describing the cost of this factorization
+        """
+        return {
+            "backend": self.backend.name,
+            "size": self.size,
+            "matrix_nnz": self.matrix_nnz,
+            "factor_nnz": self.nnz,
+            "factor_time": self.time
+        }
+
+    def __repr__(self):
+        return f"Factorization<{self.backend.name}, {self.size}x{self.size}, {self.nnz} nnz, {self.time * 1000:.2f}ms>"
+
+
+class DenseFactorization(Factorization):
+    def __init__(self, backend: "Backend", matrix: np.ndarray):
+        start = perf_counter()
+        self.lu = lu_factor(matrix, check_finite=False)
+        Factorization.__init__(self, backend, len(matrix), np.count_nonzero(matrix), matrix.size, perf_counter() - start)
+
+    def solve(self, rhs: np.ndarray) -> np.ndarray:
+        return lu_solve(self.lu, rhs, check_finite=False)
+
+
+class SparseFactorization(Factorization):
+    def __init__(self, backend: "Backend", matrix: sparse.csc_matrix, ordering: "str | np.ndarray"):
+        start = perf_counter()
+
+        # Reverse Cuthill-McKee is applied symmetrically beforehand, the minimum degree orderings are left to SuperLU.
+        # A column order from an earlier factorization of the same pattern skips searching for an ordering
+        self.permutation = None
+        self.column_order = None
+        if isinstance(ordering, np.ndarray):
+            self.column_order = ordering
+            self.lu = splu(matrix[:, ordering], permc_spec="NATURAL")
+        elif ordering == "rcm":
+            self.permutation = reverse_cuthill_mckee(matrix, symmetric_mode=True)
+            matrix = matrix[self.permutation][:, self.permutation].tocsc()
+            self.lu = splu(matrix, permc_spec="NATURAL")
+        else:
+            self.lu = splu(matrix, permc_spec=ordering)
+
+        Factorization.__init__(
+            self, backend, matrix.shape[0], matrix.nnz, self.lu.L.nnz + self.lu.U.nnz, perf_counter() - start
+        )
+
+    def ordering(self) -> np.ndarray:
+        """
+        Return the column order this factorization ended up with, to factorize matrices of the same pattern with
+        """
+        if self.column_order is not None:
+            return self.column_order
+        if self.permutation is not None:
+            return self.permutation
+        return np.argsort(self.lu.perm_c)
+
+    def solve(self, rhs: np.ndarray) -> np.ndarray:
+        if self.column_order is not None:
+            x = np.empty_like(rhs, dtype=float)
+            x[self.column_order] = self.lu.solve(rhs)
+            return x
+
+        if self.permutation is None:
+            return self.lu.solve(rhs)
+
+        x = np.empty_like(rhs, dtype=float)
+        x[self.permutation] = self.lu.solve(rhs[self.permutation])
+        return x
+
+
+class SupernodeReduction:
+    """
+    The nodal matrix reduced to one unknown per supernode, which is symmetric positive definite.
+
+    The ends of every voltage source and zero resistor are merged into a supernode, whose nodes only differ by the
+    voltages of those branches. Right-hand sides of the MNA matrix are reduced along, and the solution of the reduced
+    matrix expands back to a solution of the MNA matrix
+    """
+
+    def __init__(self, system: MNASystem):
+        self.node_count = system.node_count
+        self.branch_count = len(system.branch_ends)
+        self.rows = system.rows
+        count = len(system.node_names)
+
+        # Supernodes, as trees of branches rooted at the grounded nodes where there is one
+        neighbours = [[] for _ in range(count)]
+        for k, (p, q) in enumerate(system.branch_ends.tolist()):
+            neighbours[p].append((q, k, 1.0))
+            neighbours[q].append((p, k, -1.0))
+
+        supernode = np.full(count, -1, dtype=np.int64)
+        parent, branch, sign, depth = np.full(count, -1), np.full(count, -1), np.zeros(count), np.zeros(count, dtype=np.int64)
+        supernodes = 0
+        for root in [*system.grounds.tolist(), *range(count)]:
+            if supernode[root] >= 0:
+                continue
+            supernode[root] = supernodes
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                for other, k, s in neighbours[node]:
+                    if supernode[other] < 0:
+                        # Sign of the branch current on the child's side, +1 when the branch current leaves the child
+                        supernode[other], parent[other], branch[other], sign[other] = supernodes, node, k, -s
+                        depth[other] = depth[node] + 1
+                        stack.append(other)
+            supernodes += 1
+
+        # Tree nodes grouped by depth, to walk the trees a level at a time
+        children = np.flatnonzero(parent >= 0)
+        levels = depth[children]
+        order = np.argsort(levels, kind="stable")
+        bounds = np.searchsorted(levels[order], np.arange(1, levels.max(initial=0) + 2))
+        self.levels = [children[order[start:end]] for start, end in zip(bounds[:-1], bounds[1:])]
+        self.parent, self.branch, self.sign = parent, branch, sign
+
+        # Grounded supernodes keep their voltages, every other supernode gets a column
+        grounded = np.zeros(supernodes, dtype=bool)
+        grounded[supernode[system.grounds]] = True
+        columns = np.full(supernodes, -1, dtype=np.int64)
+        columns[~grounded] = np.arange(np.count_nonzero(~grounded))
+        node_columns = columns[supernode]
+        kept = node_columns >= 0
+        self.supernodes = sparse.csr_matrix(
+            (np.ones(np.count_nonzero(kept)), (np.flatnonzero(kept), node_columns[kept])),
+            shape=(count, np.count_nonzero(~grounded))
+        )
+
+        # Conductances between all nodes, grounded ones included, and reduced to the supernodes
+        conducting = np.flatnonzero(system.resistances != 0)
+        a, b = system.resistor_ends[conducting].T
+        g = 1 / system.resistances[conducting]
+        self.conductance = sparse.csr_matrix(
+            (np.concatenate([g, g, -g, -g]), (np.concatenate([a, b, a, b]), np.concatenate([a, b, b, a]))),
+            shape=(count, count)
+        )
+        self.reduced = (self.supernodes.T @ self.conductance @ self.supernodes).tocsr()
+
+        if np.any(self.reduced.diagonal() <= 0):
+            raise Exception("Circuit can't be solved, there are nodes without any resistance to the rest")
+
+    def reduce(self, rhs: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Reduce a right-hand side of the MNA matrix, or a matrix of them column by column.
+        Returns the reduced right-hand side, and the node injections and offsets to expand its solution with
+        """
+        # Node voltages within the supernodes, relative to their roots
+        injections = np.zeros((len(self.rows),) + rhs.shape[1:])
+        free = self.rows >= 0
+        injections[free] = rhs[self.rows[free]]
+        branch_voltages = rhs[self.node_count:]
+        sign = self.sign.reshape((-1,) + (1,) * (rhs.ndim - 1))
+        offsets = np.zeros_like(injections)
+        for level in self.levels:
+            offsets[level] = offsets[self.parent[level]] + sign[level] * branch_voltages[self.branch[level]]
+
+        return self.supernodes.T @ (injections - self.conductance @ offsets), injections, offsets
+
+    def expand(self, u: np.ndarray, injections: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        """
+        Expand supernode voltages to a solution of the MNA matrix
+        """
+        voltages = self.supernodes @ u + offsets
+
+        # Branch currents follow from the current every node leaves unaccounted for, collected from the leaves up
+        remaining = injections - self.conductance @ voltages
+        sign = self.sign.reshape((-1,) + (1,) * (u.ndim - 1))
+        currents = np.zeros((self.branch_count,) + u.shape[1:])
+        for level in reversed(self.levels):
+            currents[self.branch[level]] = sign[level] * remaining[level]
+            np.add.at(remaining, self.parent[level], remaining[level])
+
+        free = self.rows >= 0
+        x = np.empty((self.node_count + len(currents),) + u.shape[1:])
+        x[self.rows[free]] = voltages[free]
+        x[self.node_count:] = currents
+        return x
+
+
+class IterativeFactorization(Factorization):
+    """
+    Not a factorization, but the reduced nodal matrix (see SupernodeReduction) solved with preconditioned conjugate
+    gradients. Only its nonzeros and those of a cheap preconditioner are stored. Every solve starts from the previous solution
+    """
+
+    def __init__(self, backend: "IterativeBackend", system: MNASystem):
+        start = perf_counter()
+        self.tolerance = backend.tolerance
+        self.max_iterations = backend.max_iterations
+        self.iterations = 0
+        self.nodal = SupernodeReduction(system)
+        self.reduced = self.nodal.reduced
+
+        # The incomplete Cholesky factor only approximates the matrix anyway, so the previous one stays good enough
+        # for a system whose resistances changed. The diagonal is taken again every time
+        previous = system.factorization
+        same = isinstance(previous, IterativeFactorization) and previous.reduced.shape == self.reduced.shape
+        if backend.preconditioner == "jacobi":
+            self.factor = None
+            self.preconditioner = sparse.diags(1 / self.reduced.diagonal()).tocsr()
+            preconditioner_nnz = self.reduced.shape[0]
+        else:
+            self.factor = previous.factor if same and previous.factor is not None else incomplete_cholesky(self.reduced)
+            self.preconditioner = LinearOperator(
+                self.reduced.shape, lambda r: self.factor.solve(self.factor.solve(r), trans="T")
+            )
+            preconditioner_nnz = self.factor.L.nnz + self.factor.U.nnz
+
+        # Start from the previous solution of the same system
+        self.guess = previous.guess if same else None
+
+        Factorization.__init__(
+            self, backend, self.reduced.shape[0], self.reduced.nnz, self.reduced.nnz + preconditioner_nnz,
+            perf_counter() - start
+        )
+
+    def solve(self, rhs: np.ndarray) -> np.ndarray:
+        # Columns of a matrix have nothing to do with the previous solution, so they are solved from scratch
+        if rhs.ndim == 2:
+            return np.column_stack([self.solve_vector(column, None)[0] for column in rhs.T])
+
+        x, self.guess = self.solve_vector(rhs, self.guess)
+        return x
+
+    def solve_vector(self, rhs: np.ndarray, guess: np.ndarray | None) -> (np.ndarray, np.ndarray):
+        """
+        Solve for a single right-hand side starting from the given supernode voltages,
+        returning the solution and the supernode voltages to continue from
+        """
+        reduced_rhs, injections, offsets = self.nodal.reduce(rhs)
+        count = [0]
+
+        def iteration(_):
+            count[0] += 1
+
+        u, info = cg(
+            self.reduced, reduced_rhs, x0=guess, rtol=self.tolerance, atol=0,
+            maxiter=self.max_iterations, M=self.preconditioner, callback=iteration
+        )
+        if info > 0:
+            raise Exception(f"Conjugate gradients didn't converge within {info} iterations")
+        self.iterations = count[0]
+
+        return self.nodal.expand(u, injections, offsets), u
+
+
+class DecomposedFactorization(Factorization):
+    """
+    The reduced nodal matrix (see SupernodeReduction) split into subdomains, each factorized in a worker of its own.
+
+    Removing a small separator of nodes cuts the circuit into subdomains whose interiors don't touch each other.
+    Every worker eliminates the interior of its subdomain, leaving its share of the Schur complement on the separator.
+    The separator is solved on its own, after which every worker back-substitutes the voltages of its interior.
+    The workers keep their factorizations until this factorization is released or garbage collected,
+    a solve only sends them right-hand sides. A worker that lost them factorizes its subdomain again
+    """
+
+    keys = count()
+
+    def __init__(self, backend: "DecompositionBackend", system: MNASystem):
+        start = perf_counter()
+        self.backend = backend
+        self.nodal = SupernodeReduction(system)
+        reduced = self.nodal.reduced
+        self.key = next(DecomposedFactorization.keys)
+
+        # An unknown goes to the separator when it is coupled to a subdomain numbered higher than its own,
+        # every coupling between two subdomains then goes through the separator
+        labels = bisect(reduced, backend.parts)
+        coupling = reduced.tocoo()
+        separating = np.zeros(reduced.shape[0], dtype=bool)
+        separating[coupling.row[labels[coupling.row] < labels[coupling.col]]] = True
+        self.separator = np.flatnonzero(separating)
+
+        # Every subdomain only couples to part of the separator, only that part goes to its worker
+        self.interiors, self.boundaries = [], []
+        calls = []
+        rows = reduced[:, self.separator].tocsr()
+        for part in range(labels.max(initial=0) + 1):
+            interior = np.flatnonzero((labels == part) & ~separating)
+            if not len(interior):
+                continue
+            boundary = np.unique(rows[interior].indices)
+            self.interiors.append(interior)
+            self.boundaries.append(boundary)
+            calls.append((factorize_subdomain, (self.key, reduced[interior][:, interior].tocsc(), rows[interior][:, boundary].tocsc())))
+
+        # The subdomains are kept to factorize them again, and the workers' factorizations released along with this
+        self.calls = calls
+        self.finalizer = weakref.finalize(self, release_subdomains, self.key, len(calls), backend.mode)
+        self.finalizer.atexit = False
+
+        schur = reduced[self.separator][:, self.separator].toarray()
+        nnz = 0
+        for boundary, (contribution, factor_nnz) in zip(self.boundaries, self.run(calls)):
+            schur[np.ix_(boundary, boundary)] -= contribution
+            nnz += factor_nnz
+        try:
+            self.schur = cho_factor(schur, check_finite=False) if len(self.separator) else None
+        except np.linalg.LinAlgError:
+            raise Exception("Circuit can't be solved, the nodal matrix is singular")
+
+        Factorization.__init__(
+            self, backend, reduced.shape[0], reduced.nnz, nnz + schur.size, perf_counter() - start
+        )
+
+    def run(self, calls: [(callable, tuple)]) -> list:
+        """
+        Make a call for every subdomain in its own worker, returning the results in the order of the subdomains
+        """
+        if self.backend.mode == "serial":
+            return [call(part, *arguments) for part, (call, arguments) in enumerate(calls)]
+        futures = [
+            get_domain_worker(part, self.backend.mode).submit(call, part, *arguments)
+            for part, (call, arguments) in enumerate(calls)
+        ]
+        return [future.result() for future in futures]
+
+    def run_factorized(self, calls: [(callable, tuple)]) -> list:
+        """
+        Make calls that need the factorizations of the subdomains like run does.
+        When a worker doesn't have its factorization anymore, the subdomains are factorized again first
+        """
+        results = self.run(calls)
+        if any(result is None for result in results):
+            self.run(self.calls)
+            results = self.run(calls)
+        return results
+
+    def release(self):
+        """
+        Drop the factorizations of the subdomains from the workers, a later solve factorizes them again
+        """
+        release_subdomains(self.key, len(self.calls), self.backend.mode)
+
+    def solve(self, rhs: np.ndarray) -> np.ndarray:
+        reduced_rhs, injections, offsets = self.nodal.reduce(rhs)
+
+        # Eliminate the interiors from the right-hand side, solve the separator, then back-substitute the interiors
+        separator_rhs = reduced_rhs[self.separator]
+        condensed = self.run_factorized([
+            (condense_subdomain, (self.key, reduced_rhs[interior])) for interior in self.interiors
+        ])
+        for boundary, contribution in zip(self.boundaries, condensed):
+            separator_rhs[boundary] -= contribution
+        separator = cho_solve(self.schur, separator_rhs, check_finite=False) if self.schur is not None else separator_rhs
+
+        u = np.empty_like(reduced_rhs)
+        u[self.separator] = separator
+        interiors = self.run_factorized([
+            (back_substitute_subdomain, (self.key, reduced_rhs[interior], separator[boundary]))
+            for interior, boundary in zip(self.interiors, self.boundaries)
+        ])
+        for interior, values in zip(self.interiors, interiors):
+            u[interior] = values
+
+        return self.nodal.expand(u, injections, offsets)
+
+
+def bisect(matrix: sparse.csr_matrix, parts: int) -> np.ndarray:
+    """
+    Label the unknowns of a symmetric matrix with the part they belong to, in parts of about the same size.
+    Every part is halved along its reverse Cuthill-McKee order, which runs through it a level of neighbours at a time,
+    so the halves only touch where the levels do. There are never more parts than unknowns
+    """
+    labels = np.zeros(matrix.shape[0], dtype=np.int64)
+
+    def split(indices: np.ndarray, first: int, number: int):
+        if number == 1 or len(indices) <= 1:
+            labels[indices] = first
+            return
+        order = indices[reverse_cuthill_mckee(matrix[indices][:, indices].tocsr(), symmetric_mode=True)]
+        left = number // 2
+        cut = len(order) * left // number
+        split(order[:cut], first, left)
+        split(order[cut:], first + left, number - left)
+
+    split(np.arange(matrix.shape[0]), 0, max(min(parts, matrix.shape[0]), 1))
+    return labels
+
+
+def incomplete_cholesky(matrix: sparse.csr_matrix):
+    """
+    Return the incomplete Cholesky factor L of a symmetric positive definite matrix, with L L' close to the matrix.
+    L only has nonzeros where the matrix has them, and is returned factorized to solve with L (and L' with trans="T").
+    Nodal matrices are M-matrices, for which this never breaks down
+    """
+    lower = sparse.tril(matrix, format="csr")
+    lower.sort_indices()
+    indptr, indices, data = lower.indptr.tolist(), lower.indices.tolist(), lower.data.tolist()
+
+    # Row by row, every entry only needs the rows before it
+    rows = []
+    for i in range(matrix.shape[0]):
+        start, end = indptr[i], indptr[i + 1]
+        row = {}
+        for p in range(start, end - 1):
+            k = indices[p]
+            other = rows[k]
+            row[k] = (data[p] - sum(value * other[j] for j, value in row.items() if j in other)) / other[k]
+        row[i] = (data[end - 1] - sum(value * value for value in row.values())) ** 0.5
+        rows.append(row)
+
+    entries = sum(len(row) for row in rows)
+    factor = sparse.csc_matrix((
+        np.fromiter((value for row in rows for value in row.values()), dtype=float, count=entries),
+        (
+            np.repeat(np.arange(len(rows)), [len(row) for row in rows]),
+            np.fromiter((j for row in rows for j in row), dtype=np.int64, count=entries)
+        )
+    ), shape=matrix.shape)
+
+    # A triangular matrix factorizes without any fill-in, which gives fast triangular solves
+    return splu(factor, permc_spec="NATURAL", diag_pivot_thresh=0, options={"SymmetricMode": True})
+
+
+class Backend:
+    """
+    A way of factorizing the MNA matrix
+    """
+    name = ""
+
+    # Whether changed resistances are better applied as low-rank updates than by factorizing again
+    low_rank = True
+
+    def factorize(self, system: MNASystem) -> Factorization:
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}<{self.name}>"
+
+
+class DenseBackend(Backend):
+    """
+    Dense LU factorization, the quickest for small circuits
+    """
+    name = "dense"
+
+    def factorize(self, system: MNASystem) -> Factorization:
+        try:
+            return DenseFactorization(self, system.matrix())
+        except (np.linalg.LinAlgError, ValueError):
+            raise Exception("Circuit can't be solved, the MNA matrix is singular")
+
+
+class SparseBackend(Backend):
+    """
+    Sparse LU factorization of the matrix in CSC form.
+    The nodes are reordered first to keep the fill-in low, with either reverse Cuthill-McKee ("rcm"),
+    or one of SuperLU's approximate minimum degree orderings ("COLAMD", "MMD_AT_PLUS_A", "MMD_ATA")
+    """
+    name = "sparse"
+
+    def __init__(self, ordering: str = "COLAMD"):
+        if ordering not in ("rcm", "COLAMD", "MMD_AT_PLUS_A", "MMD_ATA"):
+            raise Exception(f"Unknown node ordering \"{ordering}\"")
+        self.ordering = ordering
+
+    def factorize(self, system: MNASystem) -> Factorization:
+        try:
+            return SparseFactorization(self, system.sparse_matrix(), self.ordering)
+        except RuntimeError:
+            raise Exception("Circuit can't be solved, the MNA matrix is singular")
+
+
+class IterativeBackend(Backend):
+    """
+    Preconditioned conjugate gradients on the reduced nodal matrix, stopping at a relative residual of the tolerance.
+    Takes a few iterations when the previous solution is close, and memory in the order of the matrix's nonzeros.
+    Preconditioned with the matrix's diagonal ("jacobi") or its incomplete Cholesky factorization ("ic"),
+    which takes fewer but more expensive iterations
+    """
+    name = "pcg"
+    low_rank = False
+
+    def __init__(self,
+                 preconditioner: str = "jacobi",
+                 tolerance: float = 1e-8,
+                 max_iterations: int = None
+                 ):
+        if preconditioner not in ("jacobi", "ic"):
+            raise Exception(f"Unknown preconditioner \"{preconditioner}\", choose jacobi or ic")
+        self.preconditioner = preconditioner
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+    def factorize(self, system: MNASystem) -> Factorization:
+        try:
+            return IterativeFactorization(self, system)
+        except RuntimeError:
+            raise Exception("Circuit can't be solved, the nodal matrix is singular")
+
+
+class DecompositionBackend(Backend):
+    """
+    The reduced nodal matrix decomposed into as many subdomains as there are parts, factorized side by side by
+    worker processes ("process"), threads ("thread") or one after the other in this process ("serial").
+    Pays off for large connected circuits, whose separators stay small compared to their subdomains.
+    Systems with fewer unknowns than the minimum size are factorized directly, like SparseBackend does
+    """
+    name = "schur"
+
+    def __init__(self, parts: int = None, mode: str = "process", min_size: int = 1000):
+        if mode not in ("process", "thread", "serial"):
+            raise Exception(f"Unknown worker mode \"{mode}\", choose process, thread or serial")
+        self.parts = parts or max(os.cpu_count() or 1, 2)
+        self.mode = mode
+        self.min_size = min_size
+
+    def factorize(self, system: MNASystem) -> Factorization:
+        if system.size < max(self.min_size, 1):
+            return SparseBackend().factorize(system)
+        try:
+            return DecomposedFactorization(self, system)
+        except RuntimeError:
+            raise Exception("Circuit can't be solved, the nodal matrix is singular")
+
+
+backends = {
+    "dense": DenseBackend,
+    "sparse": SparseBackend,
+    "pcg": IterativeBackend,
+    "schur": DecompositionBackend
+}
+
+
+def get_backend(backend: "str | Backend") -> Backend:
+    """
+    Return the backend with the given name, or the given backend itself
+    """
+    if isinstance(backend, Backend):
+        return backend
+    if backend not in backends:
+        raise Exception(f"Unknown solver backend \"{backend}\", choose from {', '.join(backends)}")
+    return backends[backend]()
+
+
+"""
+Subdomain workers
+"""
+
+# Workers keep the factorizations of the subdomains they were given, until the factorization they belong to
+# releases them
+subdomains: {(int, int): (object, sparse.csc_matrix)} = {}
+
+# One worker per subdomain, so the same worker always gets the same subdomain. They are started on first use
+domain_workers: {str: [Executor]} = {}
+
+
+def get_domain_worker(part: int, mode: str) -> Executor:
+    """
+    Return the worker of the given subdomain, starting it if necessary
+    """
+    workers = domain_workers.setdefault(mode, [])
+    while len(workers) <= part:
+        if mode == "process":
+            workers.append(ProcessPoolExecutor(max_workers=1))
+        elif mode == "thread":
+            workers.append(ThreadPoolExecutor(max_workers=1))
+        else:
+            raise Exception(f"Unknown worker mode \"{mode}\", choose process, thread or serial")
+    return workers[part]
+
+
+def factorize_subdomain(part: int, key: int, interior: sparse.csc_matrix, coupling: sparse.csc_matrix,
+                        chunk: int = 256) -> (np.ndarray, int):
+    """
+    Factorize the interior of a subdomain and keep it, returning its share of the Schur complement,
+    coupling' interior^-1 coupling, and the number of stored entries in its factors
+    """
+    if interior.shape[0] == 0:
+        subdomains[(key, part)] = (None, coupling)
+        return np.zeros((coupling.shape[1], coupling.shape[1])), 0
+
+    # Symmetric positive definite, so the diagonal is pivoted on as it is
+    lu = splu(interior, permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0, options={"SymmetricMode": True})
+    subdomains[(key, part)] = (lu, coupling)
+
+    # A chunk of the separator at a time, all of them at once would be a dense interior x separator matrix
+    contribution = np.empty((coupling.shape[1], coupling.shape[1]))
+    for start in range(0, coupling.shape[1], chunk):
+        columns = coupling[:, start:start + chunk]
+        contribution[:, start:start + chunk] = coupling.T @ lu.solve(columns.toarray())
+
+    return contribution, lu.L.nnz + lu.U.nnz
+
+
+def release_subdomain(part: int, key: int):
+    """
+    Drop the factorization and coupling of a subdomain kept by this worker, if it still has them
+    """
+    subdomains.pop((key, part), None)
+
+
+def release_subdomains(key: int, parts: int, mode: str):
+    """
+    Have the workers of all subdomains of a factorization drop them, without starting any workers for it
+    """
+    for part in range(parts):
+        if mode == "serial":
+            release_subdomain(part, key)
+        elif part < len(domain_workers.get(mode, [])):
+            try:
+                domain_workers[mode][part].submit(release_subdomain, part, key)
+            except RuntimeError:
+                # The worker has been shut down, and what it kept is gone with it
+                pass
+
+
+def condense_subdomain(part: int, key: int, rhs: np.ndarray) -> "np.ndarray | None":
+    """
+    Return what the interior's part of the right-hand side adds to the separator's, coupling' interior^-1 rhs,
+    or None when this worker doesn't have the subdomain's factorization
+    """
+    if (key, part) not in subdomains:
+        return None
+    lu, coupling = subdomains[(key, part)]
+    if lu is None:
+        return np.zeros((coupling.shape[1],) + rhs.shape[1:])
+    return coupling.T @ lu.solve(rhs)
+
+
+def back_substitute_subdomain(part: int, key: int, rhs: np.ndarray, separator: np.ndarray) -> "np.ndarray | None":
+    """
+    Return the solution of the interior, given the solution of its part of the separator,
+    or None when this worker doesn't have the subdomain's factorization
+    """
+    if (key, part) not in subdomains:
+        return None
+    lu, coupling = subdomains[(key, part)]
+    if lu is None:
+        return rhs
+    return lu.solve(rhs - coupling @ separator)
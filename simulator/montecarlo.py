@@ -0,0 +1,225 @@
+"""
+Monte Carlo tolerance analysis
+
+Valves and pumps are never exactly what their label says. Their resistances and voltages are sampled uniformly within
+a tolerance around their nominal values, and every sample is solved as a row of Circuit.solve_batch. The samples are
+split into tasks with seeds of their own, which are solved by the worker processes of simulator.parallel.
+A task doesn't return its samples, only a summary of the pipe currents: their mean and variance (Welford),
+their extremes and a histogram over bins fixed by a small pilot run. Summaries are merged as the tasks complete,
+so the memory taken doesn't grow with the number of samples. Percentiles are read from the merged histograms
+"""
+
+from concurrent.futures import as_completed
+
+import numpy as np
+
+from simulator.circuit import Circuit
+from simulator import parallel
+
+
+# How far the values may stray from their nominal values, as a fraction of them, and how many samples are solved
+tolerance = 0.05
+samples = 4096
+
+
+class FlowSummary:
+    """
+    Running statistics of a number of flows, without keeping the samples.
+    Every flow has a histogram of equal bins from low to high, samples outside of it are counted in an extra bin
+    below and above
+    """
+
+    def __init__(self, low: np.ndarray, high: np.ndarray, bins: int):
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+        self.bins = bins
+
+        self.count = 0
+        self.mean = np.zeros(len(self.low))
+        self.m2 = np.zeros(len(self.low))
+        self.minimum = np.full(len(self.low), np.inf)
+        self.maximum = np.full(len(self.low), -np.inf)
+        self.histogram = np.zeros((len(self.low), bins + 2), dtype=np.int64)
+
+    def add(self, flows: np.ndarray):
+        """
+        Add samples of the flows, as an array of samples x flows
+        """
+        if len(flows) == 0:
+            return
+        batch = FlowSummary(self.low, self.high, self.bins)
+        batch.count = len(flows)
+        batch.mean = flows.mean(axis=0)
+        batch.m2 = ((flows - batch.mean) ** 2).sum(axis=0)
+        batch.minimum = flows.min(axis=0)
+        batch.maximum = flows.max(axis=0)
+
+        # Bin 0 and the last bin take what falls outside of the histogram
+        width = (self.high - self.low) / self.bins
+        bins = np.clip(np.floor((flows - self.low) / width).astype(np.int64) + 1, 0, self.bins + 1)
+        flat = bins + np.arange(len(self.low)) * (self.bins + 2)
+        batch.histogram = np.bincount(flat.ravel(), minlength=batch.histogram.size).reshape(batch.histogram.shape)
+
+        self.merge(batch)
+
+    def merge(self, other: "FlowSummary"):
+        """
+        Merge the statistics of other samples of the same flows into these, with Chan's update of the variance
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        self.histogram = self.histogram + other.histogram
+
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.m2 / max(self.count - 1, 1))
+
+    def percentiles(self, percentages: [float]) -> np.ndarray:
+        """
+        Return the given percentiles of every flow, as an array of flows x percentiles.
+        They are interpolated within the bin they fall in, the extremes stand in for the bins outside the histogram
+        """
+        percentages = np.asarray(percentages, dtype=float)
+        if self.count == 0:
+            return np.full((len(self.low), len(percentages)), np.nan)
+        cumulative = np.cumsum(self.histogram, axis=1)
+        width = (self.high - self.low) / self.bins
+
+        percentiles = np.empty((len(self.low), len(percentages)))
+        for i in range(len(self.low)):
+            ranks = percentages / 100 * self.count
+            bins = np.minimum(np.searchsorted(cumulative[i], ranks, side="left"), self.bins + 1)
+            before = np.where(bins > 0, cumulative[i][np.maximum(bins - 1, 0)], 0)
+            inside = np.maximum(self.histogram[i][bins], 1)
+            position = self.low[i] + (bins - 1 + (ranks - before) / inside) * width[i]
+            position = np.where(bins == 0, self.minimum[i], np.where(bins == self.bins + 1, self.maximum[i], position))
+            percentiles[i] = np.clip(position, self.minimum[i], self.maximum[i])
+        return percentiles
+
+
+def sample_flows(nodes: [str],
+                 resistors: {str: (float, str, str)},
+                 voltage_sources: {str: (float, str, str)},
+                 exponents: {str: float},
+                 check_valves: [str],
+                 varied: [int],
+                 spread: float,
+                 weights: np.ndarray,
+                 count: int,
+                 seed: np.random.SeedSequence
+                 ) -> np.ndarray:
+    """
+    Solve the circuit for the given number of samples of the varied resistors (by index) and all voltage sources,
+    returning the flows as samples x flows. Every flow is a weighted sum of resistor and voltage source currents.
+    Linear circuits are solved as a single batch, nonlinear ones and those with check valves one sample after the other
+    """
+    rng = np.random.default_rng(seed)
+    resistances = np.tile(np.array([ohm for ohm, _, _ in resistors.values()]), (count, 1))
+    resistances[:, varied] *= 1 + spread * rng.uniform(-1, 1, (count, len(varied)))
+    voltages = np.array([volt for volt, _, _ in voltage_sources.values()])
+    voltages = voltages * (1 + spread * rng.uniform(-1, 1, (count, len(voltages))))
+
+    # Memoized pieces would have to be found again for every sample that varies them. The system is kept out of
+    # Circuit.systems, the samples may be solved on a thread of the scene's process next to the scene's own circuits
+    circuit = Circuit(
+        nodes, dict(resistors), dict(voltage_sources), exponents=exponents, check_valves=check_valves, memoize=False,
+        cache=False
+    )
+    if not circuit.exponents and not circuit.check_valves:
+        _, resistor_currents, source_currents = circuit.solve_batch(resistances, voltages)
+    else:
+        circuit.solve()
+        names = [circuit.store.resistor_names[i] for i in varied]
+        resistor_currents = np.empty((count, len(resistors)))
+        source_currents = np.empty((count, len(voltage_sources)))
+        for sample in range(count):
+            circuit.update_voltages(dict(zip(voltage_sources, voltages[sample].tolist())))
+            circuit.update_resistances(dict(zip(names, resistances[sample, varied].tolist())))
+            resistor_currents[sample] = circuit.store.resistor_currents
+            source_currents[sample] = circuit.store.source_currents
+
+    return np.hstack([resistor_currents, source_currents]) @ weights.T
+
+
+def summarize_flows(low: np.ndarray, high: np.ndarray, bins: int, *args) -> FlowSummary:
+    """
+    Solve samples like sample_flows, but only return their summary. Runs in the workers
+    """
+    summary = FlowSummary(low, high, bins)
+    summary.add(sample_flows(*args))
+    return summary
+
+
+class MonteCarlo:
+    """
+    The distribution of flows in a circuit when the varied resistors and all voltage sources are off by up to
+    spread times their value. Every flow is a weighted sum of resistor and voltage source currents,
+    as {element name: weight}, see PipeCurrent.elements
+    """
+
+    def __init__(self,
+                 circuit: Circuit,
+                 flows: [{str: float}],
+                 varied: [str],
+                 spread: float = None,
+                 bins: int = 64,
+                 pilot: int = 256,
+                 seed: int = None
+                 ):
+        self.blueprint = (
+            circuit.nodes_blueprint, dict(circuit.resistors_blueprint), dict(circuit.voltage_sources_blueprint),
+            circuit.exponents, circuit.check_valves
+        )
+        self.spread = tolerance if spread is None else spread
+        self.varied = [circuit.store.resistor_index[name] for name in varied]
+        self.bins = bins
+        self.seeds = np.random.SeedSequence(seed)
+
+        # A row of weights per flow, over the resistor currents followed by the voltage source currents
+        store = circuit.store
+        self.weights = np.zeros((len(flows), len(store.resistor_names) + len(store.source_names)))
+        for row, weights in enumerate(flows):
+            for name, weight in weights.items():
+                if name in store.resistor_index:
+                    self.weights[row, store.resistor_index[name]] += weight
+                else:
+                    self.weights[row, len(store.resistor_names) + store.source_index[name]] += weight
+
+        # The pilot run sets the range of the histograms, with some room on either side
+        pilot_flows = self.sample(pilot, self.seeds.spawn(1)[0])
+        low, high = pilot_flows.min(axis=0, initial=np.inf), pilot_flows.max(axis=0, initial=-np.inf)
+        margin = np.maximum((high - low) / 4, 1e-9 * np.maximum(np.abs(high), 1))
+        self.low, self.high = low - margin, high + margin
+
+    def sample(self, count: int, seed: np.random.SeedSequence) -> np.ndarray:
+        return sample_flows(*self.blueprint, self.varied, self.spread, self.weights, count, seed)
+
+    def run(self, count: int = None, task_size: int = 1024, pool_mode: str = None):
+        """
+        Solve the given number of samples, in tasks of task_size samples that are sent to the worker processes when
+        there is more than one worker. Yields the summary of all tasks completed so far every time another completes
+        """
+        count = samples if count is None else count
+        sizes = [min(task_size, count - start) for start in range(0, count, task_size)]
+        tasks = [
+            (self.low, self.high, self.bins, *self.blueprint, self.varied, self.spread, self.weights, size, seed)
+            for size, seed in zip(sizes, self.seeds.spawn(len(sizes)))
+        ]
+
+        summary = FlowSummary(self.low, self.high, self.bins)
+        if parallel.workers < 2 or len(tasks) < 2:
+            for task in tasks:
+                summary.merge(summarize_flows(*task))
+                yield summary
+            return
+
+        pool = parallel.get_pool(pool_mode or parallel.mode)
+        for future in as_completed([pool.submit(summarize_flows, *task) for task in tasks]):
+            summary.merge(future.result())
+            yield summary
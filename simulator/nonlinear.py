@@ -0,0 +1,141 @@
+"""
+Nonlinear resistors, whose voltage drop grows with a power of their current
+
+Valves lose head roughly with the square of the flow: h = r * q * |q|^(n - 1), with n = 2.
+Newton-Raphson linearizes every such resistor around its current flow, as a conductance g = 1 / (n * r * |q|^(n - 1))
+in parallel with a current source q * (1 - 1 / n), and solves the resulting linear circuit until the flows settle.
+The matrix keeps the same sparsity pattern every iteration, so the ordering of its first factorization is reused
+"""
+
+import numpy as np
+from scipy import sparse
+
+from simulator.mna import MNASystem, Backend, DenseBackend, SparseBackend, DenseFactorization, SparseFactorization
+
+
+class NonlinearSolver:
+    """
+    Newton-Raphson solver for an MNA system in which some resistors follow a power law.
+
+    Exponents give the power n of every resistor, 1 for ordinary resistors. The resistances of the system are
+    the coefficients r of the power law. Every solve starts from the flows of the previous one.
+    Flows below flow_floor times the largest flow are linearized as if they were that large,
+    a flow of zero would give an infinite conductance
+    """
+
+    def __init__(self,
+                 system: MNASystem,
+                 exponents: np.ndarray,
+                 backend: Backend,
+                 tolerance: float = 1e-8,
+                 max_iterations: int = 50,
+                 flow_floor: float = 1e-6
+                 ):
+        self.system = system
+        self.exponents = np.asarray(exponents, dtype=float)
+        self.backend = backend
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.flow_floor = flow_floor
+
+        if len(self.exponents) != len(system.resistor_names) or np.any(self.exponents < 1):
+            raise Exception("Every resistor needs an exponent of at least 1")
+
+        # The matrix is linear in the conductances, so its entries are a sparse product of them plus the branches.
+        # Assembling the pattern once and only refilling its entries keeps it identical for every iteration
+        rows, columns, resistors, signs = system.conductance_stamps()
+        branch_rows, branch_columns, branch_values = system.branch_stamps()
+        all_rows = np.concatenate([rows, branch_rows])
+        all_columns = np.concatenate([columns, branch_columns])
+        # Duplicate stamps are summed into a single entry, numbering the entries tells which entry each stamp went to
+        pattern = sparse.csc_matrix((np.ones(len(all_rows)), (all_rows, all_columns)), shape=(system.size, system.size))
+        pattern.data = np.arange(pattern.nnz, dtype=float)
+        positions = np.asarray(pattern[all_rows, all_columns]).ravel().astype(np.int64)
+        self.pattern = pattern
+        self.stamp = sparse.csr_matrix(
+            (signs, (positions[:len(rows)], resistors)), shape=(pattern.nnz, len(system.resistor_names))
+        )
+        self.constant = np.zeros(pattern.nnz)
+        np.add.at(self.constant, positions[len(rows):], branch_values)
+
+        # Where the current sources of the linearized resistors go in the right-hand side
+        a, b = system.rows[system.resistor_ends].T
+        signs = np.concatenate([-np.ones(len(a)), np.ones(len(b))])
+        ends = np.concatenate([a, b])
+        elements = np.tile(np.arange(len(a)), 2)
+        keep = ends >= 0
+        self.scatter = sparse.csr_matrix(
+            (signs[keep], (ends[keep], elements[keep])), shape=(system.size, len(system.resistor_names))
+        )
+
+        self.ordering = None
+        self.currents = None
+        self.iterations = 0
+
+    def factorize(self, conductances: np.ndarray):
+        """
+        Factorize the matrix for the given conductances, reusing the ordering of the first sparse factorization.
+        Backends other than the dense one get a sparse factorization, Newton steps aren't close enough for warm starts
+        """
+        matrix = self.pattern.copy()
+        matrix.data = self.stamp @ conductances + self.constant
+
+        try:
+            if isinstance(self.backend, DenseBackend):
+                return DenseFactorization(self.backend, matrix.toarray())
+            if self.ordering is not None:
+                ordering = self.ordering
+            else:
+                ordering = self.backend.ordering if isinstance(self.backend, SparseBackend) else "COLAMD"
+            factorization = SparseFactorization(self.backend, matrix, ordering)
+        except (np.linalg.LinAlgError, ValueError, RuntimeError):
+            raise Exception("Circuit can't be solved, the MNA matrix is singular")
+
+        if self.ordering is None:
+            self.ordering = factorization.ordering()
+        return factorization
+
+    def solve(self) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Solve the circuit, returning the node voltages, resistor currents and voltage source currents like MNASystem.solve
+        """
+        system = self.system
+        n = self.exponents
+        r = system.resistances
+        conducting = r != 0
+        shorted = np.zeros(len(r), dtype=bool)
+        shorted[system.shorts] = True
+
+        # Start from the last solution, or from the solution with all resistors taken as linear
+        if self.currents is None:
+            _, self.currents, _ = system.solve()
+        q = self.currents.copy()
+
+        a, b = system.resistor_ends.T
+        rhs = system.rhs()
+        for self.iterations in range(1, self.max_iterations + 1):
+            scale = max(np.abs(q).max(initial=0), 1e-300)
+            flow = np.maximum(np.abs(q), self.flow_floor * scale)
+            conductances = np.where(conducting, 1 / (n * np.where(conducting, r, 1) * flow ** (n - 1)), 0)
+            sources = np.where(conducting, q * (1 - 1 / n), 0)
+
+            x = self.factorize(conductances).solve(rhs + self.scatter @ sources)
+
+            voltages = np.zeros(len(system.node_names))
+            free = system.rows >= 0
+            voltages[free] = x[system.rows[free]]
+            branch_currents = x[system.node_count:]
+
+            new = conductances * (voltages[a] - voltages[b]) + sources
+            new[shorted] = branch_currents[len(system.source_names):]
+            new[a == b] = 0
+
+            change = np.abs(new - q).max(initial=0)
+            q = new
+            if change <= self.tolerance * max(np.abs(q).max(initial=0), 1e-300):
+                break
+        else:
+            raise Exception(f"Nonlinear circuit didn't converge within {self.max_iterations} iterations")
+
+        self.currents = q
+        return voltages, q.copy(), -branch_currents[:len(system.source_names)]
@@ -0,0 +1,235 @@
+"""
+Finding the valve settings that give chosen pipes the currents they should have
+
+The mismatch between the currents of the chosen pipes and their targets is minimized with L-BFGS-B, which keeps every
+valve's resistance and three-way split within its bounds. Its gradient with respect to every valve comes from
+a single adjoint solve, see Circuit.sensitivities. Every circuit is optimized on a copy of its own, which isn't
+pruned, memoized or pre-reduced, so the solves and the adjoint solves share one factorization that changed valves
+only update. That system stays out of Circuit.systems, so no other circuit ever updates it. The copies are made
+and solved up front, so the optimizer can run in a thread of its own while the scene keeps using its circuits.
+Nothing is written to the components from that thread, the scene applies the settings once the optimizer is done
+"""
+
+import threading
+
+import numpy as np
+from scipy.optimize import minimize
+
+from simulator.circuit import Circuit
+from simulator.components import GateValve, ThreewayValve
+from simulator.pipe import Pipe
+from simulator.parse import pipe_circuit
+
+
+# Bounds of the resistance of every valve and of the blue part of every three-way valve, unless they're given
+resistance_range = (0.01, 1000.0)
+blue_part_range = (0.01, 0.99)
+
+
+class CircuitProblem:
+    """
+    The valves of a single circuit and the pipe currents they have to meet, on a copy of the circuit.
+    Resistances are optimized by their logarithm, valves that differ by orders of magnitude then take similar steps
+    """
+
+    def __init__(self,
+                 circuit: Circuit,
+                 valves: [GateValve | ThreewayValve],
+                 targets: [({str: float}, float)],
+                 resistance_ranges: {GateValve | ThreewayValve: (float, float)},
+                 blue_part_ranges: {ThreewayValve: (float, float)}
+                 ):
+        self.circuit = Circuit(
+            circuit.nodes_blueprint, dict(circuit.resistors_blueprint), dict(circuit.voltage_sources_blueprint),
+            circuit.backend, circuit.exponents, prune=False, prereduce=False, check_valves=circuit.check_valves,
+            memoize=False, cache=False
+        )
+        self.circuit.solve()
+        self.valves = valves
+
+        # Every target is a weighted sum of element currents, see PipeCurrent.elements
+        self.weights = [weights for weights, _ in targets]
+        self.targets = np.array([target for _, target in targets])
+        self.scale = max(np.abs(self.targets).max(initial=0), 1e-12)
+
+        # A gate valve has a resistance, a three-way valve a resistance and the part of it on the blue side
+        start, bounds = [], []
+        for valve in valves:
+            low, high = resistance_ranges.get(valve, resistance_range)
+            start.append(np.log(np.clip(valve.text_value, low, high)))
+            bounds.append((np.log(low), np.log(high)))
+            if isinstance(valve, ThreewayValve):
+                low, high = blue_part_ranges.get(valve, blue_part_range)
+                start.append(np.clip(valve.blue_part, low, high))
+                bounds.append((low, high))
+        self.start = np.array(start)
+        self.bounds = bounds
+
+        # Valves outside their bounds are brought within them here, a valve of zero ohm would have to be solved again
+        self.circuit.update_resistances(self.resistances(self.start))
+
+    def resistances(self, x: np.ndarray) -> {str: float}:
+        """
+        Return the resistances of the valves' resistors for the given variables
+        """
+        resistances = {}
+        i = 0
+        for valve in self.valves:
+            ohm = float(np.exp(x[i]))
+            if isinstance(valve, ThreewayValve):
+                blue = float(x[i + 1])
+                resistances[valve.name + ".b"] = ohm * blue
+                resistances[valve.name + ".r"] = ohm * (1 - blue)
+                i += 2
+            else:
+                resistances[valve.name] = ohm
+                i += 1
+        return resistances
+
+    def currents(self) -> np.ndarray:
+        """
+        Return the present currents of the targeted pipes
+        """
+        store = self.circuit.store
+        return np.array([
+            sum(
+                weight * (store.resistor_currents[store.resistor_index[name]] if name in store.resistor_index
+                          else store.source_currents[store.source_index[name]])
+                for name, weight in weights.items()
+            )
+            for weights in self.weights
+        ])
+
+    def objective(self, x: np.ndarray) -> (float, np.ndarray):
+        """
+        Return the sum of the squared relative mismatches and its gradient with respect to the variables.
+        The gradients of all targets are combined into a single weighted sum of currents, so it takes one adjoint solve
+        """
+        resistances = self.resistances(x)
+        changed = {
+            name: ohm for name, ohm in resistances.items()
+            if ohm != self.circuit.store.resistances[self.circuit.store.resistor_index[name]]
+        }
+        if changed:
+            self.circuit.update_resistances(changed)
+
+        mismatch = (self.currents() - self.targets) / self.scale
+        weights = {}
+        for element_weights, m in zip(self.weights, mismatch.tolist()):
+            for name, weight in element_weights.items():
+                weights[name] = weights.get(name, 0) + 2 * m * weight / self.scale
+        gradients = self.circuit.sensitivities(weights)
+
+        # Chain the derivatives by resistance to the logarithm of the resistance and the split of a three-way valve
+        gradient = np.empty(len(x))
+        i = 0
+        for valve in self.valves:
+            if isinstance(valve, ThreewayValve):
+                blue, red = resistances[valve.name + ".b"], resistances[valve.name + ".r"]
+                d_blue, d_red = gradients[valve.name + ".b"], gradients[valve.name + ".r"]
+                gradient[i] = blue * d_blue + red * d_red
+                gradient[i + 1] = (blue + red) * (d_blue - d_red)
+                i += 2
+            else:
+                gradient[i] = resistances[valve.name] * gradients[valve.name]
+                i += 1
+
+        return float(mismatch @ mismatch), gradient
+
+    def settings(self, x: np.ndarray) -> {GateValve | ThreewayValve: (float, float | None)}:
+        """
+        Return the resistance of every valve, and the blue part of the three-way valves, for the given variables
+        """
+        settings = {}
+        i = 0
+        for valve in self.valves:
+            if isinstance(valve, ThreewayValve):
+                settings[valve] = (float(np.exp(x[i])), float(x[i + 1]))
+                i += 2
+            else:
+                settings[valve] = (float(np.exp(x[i])), None)
+                i += 1
+        return settings
+
+
+class ValveOptimizer:
+    """
+    Finds the valve settings that bring the given pipes closest to their target currents, in a background thread.
+    Targets are signed along the present current of their pipe. Only the valves in the circuits of the targeted pipes
+    are changed. Once done, settings holds the resistance and blue part (None for gate valves) of every valve
+    and mismatches the relative mismatch left per circuit, or error says why it failed
+    """
+
+    def __init__(self,
+                 circuits: [Circuit],
+                 components,
+                 targets: {Pipe: float},
+                 resistance_ranges: {GateValve | ThreewayValve: (float, float)} = None,
+                 blue_part_ranges: {ThreewayValve: (float, float)} = None,
+                 max_iterations: int = 200
+                 ):
+        self.max_iterations = max_iterations
+        self.settings = {}
+        self.mismatches = []
+        self.error = None
+
+        # Group the targets by the circuit their pipe is in
+        grouped = {}
+        for pipe, target in targets.items():
+            circuit = pipe_circuit(pipe, circuits)
+            if circuit is not None:
+                grouped.setdefault(id(circuit), (circuit, []))[1].append((pipe.current.elements, target))
+
+        self.problems = []
+        for circuit, circuit_targets in grouped.values():
+            valves = [
+                c for c in components
+                if (isinstance(c, GateValve) and c.name in circuit.resistors)
+                or (isinstance(c, ThreewayValve) and c.name + ".b" in circuit.resistors)
+            ]
+            if valves:
+                self.problems.append(CircuitProblem(
+                    circuit, valves, circuit_targets, resistance_ranges or {}, blue_part_ranges or {}
+                ))
+
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        """
+        Stop optimizing, the settings found so far are kept
+        """
+        self.cancelled.set()
+        self.thread.join()
+
+    def done(self) -> bool:
+        return self.thread.ident is not None and not self.thread.is_alive()
+
+    def run(self):
+        """
+        Optimize the circuits one after the other
+        """
+        try:
+            for problem in self.problems:
+                best = [np.inf, problem.start]
+
+                def objective(x: np.ndarray) -> (float, np.ndarray):
+                    # A zero gradient makes L-BFGS-B stop right away once cancelled
+                    if self.cancelled.is_set():
+                        return best[0], np.zeros(len(x))
+                    value, gradient = problem.objective(x)
+                    if value < best[0]:
+                        best[:] = value, x.copy()
+                    return value, gradient
+
+                minimize(
+                    objective, problem.start, jac=True, method="L-BFGS-B", bounds=problem.bounds,
+                    options={"maxiter": self.max_iterations}
+                )
+                self.settings |= problem.settings(best[1])
+                self.mismatches.append(float(np.sqrt(best[0])))
+        except Exception as e:
+            self.error = str(e)
@@ -4,7 +4,7 @@ from pygame.event import Event
 
 from engine import colors, text, director, maths, debug
 
-from simulator.components import GateValve, ThreewayValve, Pump, Fitting
+from simulator.components import GateValve, ThreewayValve, Pump, Fitting, CheckValve
 
 
 # Hard coded data
@@ -34,6 +34,12 @@ data = {
             "name": "threewayvalve",
             "object": ThreewayValve
         },
+        {
+            "title": "Check Valve",
+            "description": "Only lets water through\nin the direction it points",
+            "name": "checkvalve",
+            "object": CheckValve
+        },
         {
             "title": "Pump",
             "description": "Generates pressure",
@@ -128,7 +134,7 @@ class ComponentSelector:
 
         self.images = {
             name: pygame.image.load(f"images/{name}.png").convert_alpha()
-            for name in ["gatevalve", "threewayvalve", "pump", "fitting"]
+            for name in ["gatevalve", "threewayvalve", "checkvalve", "pump", "fitting"]
         }
         self.button_rects = self.generate_button_rects()
 
@@ -136,7 +142,7 @@ class ComponentSelector:
         """
         Prepares the rects of the component buttons
         """
-        h = self.rect.h // 4
+        h = self.rect.h // len(data["components"])
         rects = {}
         for i, comp in enumerate(data["components"]):
             rect = Rect(self.rect.left, self.rect.top + h * i, h, h)
@@ -0,0 +1,98 @@
+"""
+Solving disjointed circuits side by side
+
+Disjointed circuits share no nodes, so each of them can be solved on its own core. The circuits are sent to the workers
+as their blueprints, plain dicts and lists that pickle cheaply, and only the solved voltages and currents come back.
+"""
+
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from simulator.circuit import Circuit
+from simulator.mna import Backend
+
+
+# Circuits with fewer elements than this are solved right away, sending them to a worker takes longer than solving them
+min_size = 200
+
+# "process" sidesteps the GIL, "thread" avoids starting worker processes and works when the backend releases the GIL
+mode = "process"
+workers = os.cpu_count() or 1
+
+# The pools are started on first use and kept around, starting worker processes is slow
+pools: {str: Executor} = {}
+
+
+def get_pool(pool_mode: str) -> Executor:
+    """
+    Return the shared pool of the given mode, starting it if necessary
+    """
+    if pool_mode not in pools:
+        if pool_mode == "process":
+            pools[pool_mode] = ProcessPoolExecutor(max_workers=workers)
+        elif pool_mode == "thread":
+            pools[pool_mode] = ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise Exception(f"Unknown pool mode \"{pool_mode}\", choose process or thread")
+    return pools[pool_mode]
+
+
+def shutdown():
+    """
+    Stop the workers of all pools
+    """
+    for pool in pools.values():
+        pool.shutdown(cancel_futures=True)
+    pools.clear()
+
+
+def solve_blueprint(nodes: [str],
+                    resistors: {str: (float, str, str)},
+                    voltage_sources: {str: (float, str, str)},
+                    backend: "str | Backend" = "sparse",
+                    exponents: {str: float} = None,
+                    check_valves: [str] = None
+                    ) -> (np.ndarray, np.ndarray, np.ndarray, {str}):
+    """
+    Solve a circuit given as its blueprint, returning the node voltages, resistor currents and voltage source currents,
+    and the check valves that are blocked. Runs in the workers, which keep their own cache of factorized topologies
+    """
+    circuit = Circuit(nodes, resistors, voltage_sources, backend, exponents, check_valves=check_valves)
+    circuit.solve()
+    return circuit.store.node_voltages, circuit.store.resistor_currents, circuit.store.source_currents, circuit.blocked
+
+
+def solve_circuits(circuits: [Circuit], pool_mode: str = None):
+    """
+    Solve all circuits, the large ones in the pool when there is more than one of them.
+    Circuits solved by a worker have no factorization of their own, it is made when they are first changed
+    """
+    pool_mode = pool_mode or mode
+    # Circuits with macros are solved here, the macros keep factorizations that don't go through a pipe
+    large = [
+        c for c in circuits
+        if len(c.resistors_blueprint) + len(c.voltage_sources_blueprint) >= min_size and not c.macros
+    ]
+    if workers < 2 or len(large) < 2:
+        large = []
+
+    # Send the large circuits off first, so they are being solved while the small ones are solved here
+    futures = [
+        get_pool(pool_mode).submit(
+            solve_blueprint, c.nodes_blueprint, c.resistors_blueprint, c.voltage_sources_blueprint, c.backend, c.exponents,
+            c.check_valves
+        )
+        for c in large
+    ]
+
+    for circuit in circuits:
+        if circuit not in large:
+            circuit.solve()
+
+    for circuit, future in zip(large, futures):
+        circuit.system = None
+        circuit.factorization = None
+        *solution, circuit.blocked = future.result()
+        circuit.apply_solution(*solution)
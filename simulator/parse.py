@@ -4,21 +4,35 @@ Handles parsing the drawn circuit to a format that can be solved
 
 from simulator.connectable import Connection, Connectable
 from simulator.component import Component
-from simulator.components import GateValve, Pump, Fitting, ThreewayValve
+from simulator.components import GateValve, Pump, Fitting, ThreewayValve, CheckValve
 from simulator.pipe import Pipe
 from simulator.circuit import Circuit, Node, Current
+from simulator.store import ResistorView
+from simulator.parallel import solve_circuits
+from simulator.cache import SolutionCache
 
+import math
 from itertools import chain
 from collections import defaultdict
 
 
+# How the head loss over valves grows with the flow through them, 1 for Ohm's law and 2 for quadratic losses
+valve_exponent = 1
+
+# Solutions of recently simulated circuits, so switching back to an earlier configuration needs no solving
+solutions = SolutionCache()
+
+
 class PipeCurrent:
-    def __init__(self, current: float, max_current: float, direction, voltage):
+    def __init__(self, current: float, max_current: float, direction, voltage, elements: {str: float} = None):
         self.current = current
         self.max_current = max_current
         self.direction = direction
         self.voltage = voltage
 
+        # The circuit currents that add up to this current, as element name -> weight, see Circuit.sensitivities
+        self.elements = elements or {}
+
     def __repr__(self):
         return f"[{self.current}A / {self.max_current}A -> {self.direction}]"
 
@@ -28,7 +42,7 @@ def assign_nodes(components) -> None:
     Walks through all components and pipes to separate them into nodes.
     Assigns to pipes/fittings to which node they belong, and to components to which nodes they connect
     """
-    pumps_valves = [comp for comp in components if type(comp) in [Pump, GateValve, ThreewayValve]]
+    pumps_valves = [comp for comp in components if type(comp) in [Pump, GateValve, ThreewayValve, CheckValve]]
 
     # ID's of visited Connection ID's as keys, node they belong to as value
     visited = {}
@@ -67,7 +81,7 @@ def assign_nodes(components) -> None:
 
     for o, n in visited.items():
         # For the components, register the nodes they connect to
-        if type(o.connectable) in (Pump, GateValve, ThreewayValve):
+        if type(o.connectable) in (Pump, GateValve, ThreewayValve, CheckValve):
             o.connectable.nodes[o] = n
         # For the pipes, assign which node they are a part of
         elif type(o.connectable) in [Fitting, Pipe]:
@@ -112,9 +126,17 @@ def separate_disjointed_circuits(nodes: [str], valves: {str: (float, str, str)},
     return circuits
 
 
-def parse(components) -> None:
+def threeway_resistances(three: ThreewayValve) -> (float, float):
+    """
+    Return the resistances of the blue and the red side of a threeway valve
+    """
+    return three.text_value * three.blue_part, three.text_value * (1 - three.blue_part)
+
+
+def parse(components) -> [Circuit]:
     """
-    Parse all components into a format suitable for the circuit solver, and solve the circuit
+    Parse all components into a format suitable for the circuit solver, and solve the circuit.
+    Returns the solved circuits
     """
     # Separate the pumps and the valves
     _pumps = [comp for comp in components if isinstance(comp, Pump)]
@@ -133,26 +155,33 @@ def parse(components) -> None:
         _from, _to = p.get_from_to()
         pumps[p.name] = (p.text_value, p.nodes[_from], p.nodes[_to])
 
-    # Parse the valves
-    valves = {v.name: (v.text_value, *v.nodes.values()) for v in _valves}
+    # Parse the valves, check valves from their inlet to their outlet
+    valves = {}
+    for v in _valves:
+        ends = [v.nodes[c] for c in v.get_from_to()] if isinstance(v, CheckValve) else v.nodes.values()
+        valves[v.name] = (v.text_value, *ends)
+    check_valves = [v.name for v in _valves if isinstance(v, CheckValve)]
 
     # Parse the threeway valves
     for three in _threes:
         _open, blue, red = three.open_blue_red_connections()
         o_node, b_node, r_node = [three.nodes[s] for s in (_open, blue, red)]
-        b_res, r_res = three.text_value * three.blue_part, three.text_value * (1 - three.blue_part)
+        b_res, r_res = threeway_resistances(three)
         valves[three.name + ".b"] = (b_res, o_node, b_node)
         valves[three.name + ".r"] = (r_res, o_node, r_node)
 
     # Split the nodes and components into disjointed circuits
     split_circuits = separate_disjointed_circuits(nodes, valves, pumps)
-    circuits = []
 
-    # Solve each disjointed circuit
-    for n, v, p in split_circuits:
-        circuit = Circuit(n, v, p)
-        circuit.solve()
-        circuits.append(circuit)
+    # Solve the disjointed circuits that weren't solved before, side by side where they are large enough
+    circuits = [
+        Circuit(n, v, p, exponents={name: valve_exponent for name in v}, check_valves=check_valves)
+        for n, v, p in split_circuits
+    ]
+    unsolved = [circuit for circuit in circuits if not solutions.lookup(circuit)]
+    solve_circuits(unsolved)
+    for circuit in unsolved:
+        solutions.store(circuit)
 
     # Print it (unnecessary for later)
     for circuit in circuits:
@@ -179,14 +208,92 @@ def parse(components) -> None:
             print(f"Voltage source {_v.name} (with voltage {_v.voltage}) has a current of {_v.current}")
         print("\n" + ("-" * 30))
 
+    return circuits
+
+
+def retune(component: GateValve | ThreewayValve | Pump, circuits: [Circuit]) -> bool:
+    """
+    Re-solve the circuit containing a valve or pump after its value changed, reusing the circuit's factorization.
+    Returns False if the component isn't part of any of the circuits
+    """
+    if isinstance(component, Pump):
+        for circuit in circuits:
+            if component.name in circuit.voltage_sources:
+                circuit.update_voltages({component.name: component.text_value})
+                solutions.store(circuit)
+                return True
+        return False
+
+    if isinstance(component, ThreewayValve):
+        blue, red = threeway_resistances(component)
+        resistances = {component.name + ".b": blue, component.name + ".r": red}
+    else:
+        resistances = {component.name: component.text_value}
+
+    for circuit in circuits:
+        if all(name in circuit.resistors for name in resistances):
+            circuit.update_resistances(resistances)
+            solutions.store(circuit)
+            return True
+    return False
+
+
+def pipe_circuit(pipe: Pipe, circuits: [Circuit]) -> Circuit | None:
+    """
+    Return the circuit whose elements carry the current of a pipe, None if it carries none
+    """
+    if pipe.current is None or not pipe.current.elements:
+        return None
+
+    element = next(iter(pipe.current.elements))
+    return next((c for c in circuits if element in c.resistors or element in c.voltage_sources), None)
+
+
+def valve_sensitivities(pipe: Pipe, components, circuits: [Circuit]) -> {GateValve | ThreewayValve: float}:
+    """
+    Return how fast the current through a pipe changes with the resistance of every valve in its circuit,
+    in amps per ohm, the valves with the largest effect first. A three-way valve's resistance is divided over
+    its two sides, so both sides change with it
+    """
+    circuit = pipe_circuit(pipe, circuits)
+    if circuit is None:
+        return {}
+    gradients = circuit.sensitivities(pipe.current.elements)
+
+    sensitivities = {}
+    for component in components:
+        if isinstance(component, GateValve) and component.name in gradients:
+            sensitivities[component] = gradients[component.name]
+        elif isinstance(component, ThreewayValve) and component.name + ".b" in gradients:
+            sensitivities[component] = component.blue_part * gradients[component.name + ".b"] + \
+                (1 - component.blue_part) * gradients[component.name + ".r"]
+
+    return dict(sorted(sensitivities.items(), key=lambda item: -abs(item[1])))
+
 
-def assign_pipe_current_in_node(node: Node, io: {str: [(Connectable, Current)]}):
+def contingency_table(circuits: [Circuit]) -> [(str, str, float, float)]:
     """
-    Assign current to individual pipes within a single node
+    Return what blocking every valve and pump on its own does to the rest of its circuit, for all circuits at once,
+    as (blocked element, the element whose current changes the most, its current before, its current after) rows,
+    the worst outages first. The two sides of a three-way valve are blocked one at a time
+    """
+    table = [(outage, *impact) for circuit in circuits for outage, impact in circuit.contingencies().items()]
+
+    def change(row: (str, str, float, float)) -> float:
+        amps = abs(row[3] - row[2])
+        return math.inf if math.isnan(amps) else amps
+
+    return sorted(table, key=change, reverse=True)
+
+
+def assign_pipe_current_in_node(node: Node, io: {str: [(Connectable, Current, str, float)]}):
+    """
+    Assign current to individual pipes within a single node.
+    Every current comes with the name of the circuit element it flows through, and the sign of that element's current
     """
     ins_outs = defaultdict(lambda: {"in": [], "out": [], "dir": None})
 
-    for (comp_in, curr_in) in io["in"]:
+    for (comp_in, *element_in) in io["in"]:
         conn: Connection = [c for c, n in comp_in.nodes.items() if n == node.name][0]  # pycharm tripping
 
         stack = [conn.other_comp()]
@@ -208,7 +315,7 @@ def assign_pipe_current_in_node(node: Node, io: {str: [(Connectable, Current)]})
                 stack.append(u)
 
         # For each out
-        for (comp_out, curr_out) in io["out"]:
+        for (comp_out, *element_out) in io["out"]:
             # TODO: decide if this threeway valve anomaly is worth it
             # if isinstance(comp_out, ThreewayValve):
             #     conns =
@@ -217,8 +324,8 @@ def assign_pipe_current_in_node(node: Node, io: {str: [(Connectable, Current)]})
             # Trace back through the distances to get the shortest path
             while distances[conn.other_comp()] > 1:
                 comp, _dir = conn.other_comp(), conn.opposite()
-                ins_outs[comp]["in"].append(curr_in)
-                ins_outs[comp]["out"].append(curr_out)
+                ins_outs[comp]["in"].append(tuple(element_in))
+                ins_outs[comp]["out"].append(tuple(element_out))
                 ins_outs[comp]["dir"] = _dir
 
                 conns = [c for c in comp.connections if c is not None and isinstance(c.other_comp(), (Pipe, Fitting))]
@@ -227,8 +334,8 @@ def assign_pipe_current_in_node(node: Node, io: {str: [(Connectable, Current)]})
                     key=lambda c: distances[c.other_comp()]
                 )
             comp, _dir = conn.other_comp(), conn.opposite()
-            ins_outs[comp]["in"].append(curr_in)
-            ins_outs[comp]["out"].append(curr_out)
+            ins_outs[comp]["in"].append(tuple(element_in))
+            ins_outs[comp]["out"].append(tuple(element_out))
             ins_outs[comp]["dir"] = _dir
 
     # Separate pipes from fittings
@@ -243,10 +350,15 @@ def assign_pipe_current_in_node(node: Node, io: {str: [(Connectable, Current)]})
     # Assign the smaller current of the combined ins and combined outs as the pipe's current
     # largest = 0
     for pipe, io in pipes:
-        total_in = sum([cur.amps for cur in io["in"]])
-        total_out = sum([cur.amps for cur in io["out"]])
+        total_in = sum([cur.amps for cur, _, _ in io["in"]])
+        total_out = sum([cur.amps for cur, _, _ in io["out"]])
+
+        # The elements of the smaller side, weighted so that their signed currents add up to the pipe's current
+        elements = {}
+        for _, name, sign in io["in"] if total_in <= total_out else io["out"]:
+            elements[name] = elements.get(name, 0) + sign
 
-        pipe.current = PipeCurrent(min(total_in, total_out), 0, io["dir"], node.voltage)
+        pipe.current = PipeCurrent(min(total_in, total_out), 0, io["dir"], node.voltage, elements)
         # if pipe.current.current > largest:
         #     largest = pipe.current.current
 
@@ -261,24 +373,29 @@ def assign_pipe_current(_components, _pipes):
     nodes = defaultdict(lambda: {"in": [], "out": []})
     components = [c for c in _components if isinstance(c, (Pump, GateValve, ThreewayValve))]
 
-    # Pair all components with the current going through them
-    component_current = []
+    # Pair all components with the circuit elements they stand for
+    component_element = []
     for component in components:
         if isinstance(component, Pump):
-            component_current.append((component, component.circuit_pump.current))
+            component_element.append((component, component.circuit_pump))
         elif isinstance(component, GateValve):
-            component_current.append((component, component.circuit_valve.current))
+            component_element.append((component, component.circuit_valve))
         elif isinstance(component, ThreewayValve):
-            component_current.append((component, component.circuit_red_valve.current))
-            component_current.append((component, component.circuit_blue_valve.current))
+            component_element.append((component, component.circuit_red_valve))
+            component_element.append((component, component.circuit_blue_valve))
 
-    # Filter out the components with a current of 0, and determine the strongest current
-    component_current = [(co, cu) for co, cu in component_current if cu.amps > 0]
+    # Filter out the components with a current of 0. The sign tells whether the current flows the element's own way
+    component_current = []
+    for co, element in component_element:
+        cu = element.current
+        if cu.amps > 0:
+            first = element.nodes[0] if isinstance(element, ResistorView) else element.neg_node
+            component_current.append((co, cu, element.name, 1.0 if cu.source == first else -1.0))
 
     # Divide the components into the inputs and outputs of nodes
-    for co, cu in component_current:
-        nodes[cu.source]["out"].append((co, cu))
-        nodes[cu.target]["in"].append((co, cu))
+    for co, cu, name, sign in component_current:
+        nodes[cu.source]["out"].append((co, cu, name, sign))
+        nodes[cu.target]["in"].append((co, cu, name, sign))
 
     # For each node, pathfind each input to each output
     node: Node
@@ -0,0 +1,448 @@
+"""
+Memoizing sub-circuits that repeat
+
+Large layouts repeat the same group of valves and pumps many times over, hung between the same few headers.
+The circuit is cut at its headers, the nodes with many elements attached. What hangs together between them is a piece,
+with the headers it touches as its ports. Pieces get a canonical labelling by Weisfeiler-Lehman colour refinement:
+every node starts out as a port or an interior node, then keeps taking a hash of its own colour and the elements
+and colours around it, until the colours stop splitting up. Pieces with the same colours are almost certainly the same,
+which is then made sure of by finding the mapping between them.
+Every distinct piece is reduced to its ports once, as a Macro, and its copies are placed as that macro.
+The insides of all copies of a piece are recovered from their port voltages at once, a column per copy.
+Reduced pieces are kept across circuits, so a piece that was reduced before doesn't have to be reduced again
+"""
+
+import threading
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from simulator.macro import Macro
+
+
+# Nodes with at least this many elements attached are headers, the pieces are cut at them.
+# Pieces are memoized once they occur at least min_copies times, or when they were reduced before
+header_degree = 8
+min_copies = 2
+
+
+class Piece:
+    """
+    A connected group of elements between headers. Its elements are (name, is a voltage source, value, node, node),
+    with the nodes as positions in its list of nodes. Its ports are the nodes that are headers
+    """
+
+    def __init__(self, nodes: [str], ports: [str], elements: [(str, bool, float, str, str)]):
+        self.nodes = nodes
+        self.ports = ports
+        index = {name: i for i, name in enumerate(nodes)}
+        self.elements = [(name, source, value, index[a], index[b]) for name, source, value, a, b in elements]
+
+        # Cheap to compare, pieces that differ in this can't be the same
+        self.signature = (
+            len(nodes), len(ports), tuple(sorted((source, value) for _, source, value, _, _ in self.elements))
+        )
+
+        # Made once the piece turns out to have others like it
+        self.neighbours = None
+        self.pairs = None
+        self.colors = None
+        self.discrete = False
+        self.key = None
+
+    def refine(self):
+        """
+        Colour the nodes by Weisfeiler-Lehman refinement until the colours stop splitting up.
+        Colours are hashes, so those of different pieces, and of different circuits, can be compared.
+        Two different colours could hash the same, which only makes the refinement coarser, the match is exact
+        """
+        if self.colors is not None:
+            return
+
+        # Every element seen from both its nodes, resistors work both ways, voltage sources point from their from-node
+        self.neighbours = [[] for _ in self.nodes]
+        for _, source, value, a, b in self.elements:
+            self.neighbours[a].append(((source, value, 1 if source else 0), b))
+            self.neighbours[b].append(((source, value, -1 if source else 0), a))
+
+        port_set = set(self.ports)
+        colors = [hash(name in port_set) for name in self.nodes]
+        count = len(set(colors))
+        while True:
+            colors = [
+                hash((colors[i], tuple(sorted((label, colors[j]) for label, j in around))))
+                for i, around in enumerate(self.neighbours)
+            ]
+            # Every round splits the colours of the one before or leaves them be, then they're stable
+            if len(set(colors)) == count:
+                break
+            count = len(set(colors))
+
+        self.colors = colors
+        self.discrete = count == len(self.nodes)
+        self.key = (self.signature, tuple(sorted(colors)))
+
+    def match(self, other: "Piece", budget: int = 10000) -> "([int], [(int, float)]) | None":
+        """
+        Return how this piece maps onto another piece, or None if they aren't the same: the node of the other piece
+        for every node, and the element of the other piece for every element, with -1 for resistors that are the other
+        way around. When every node has a colour of its own the colours say where it goes, otherwise the nodes
+        of the same colour are backtracked over, giving up after budget tries
+        """
+        self.refine()
+        other.refine()
+        if self.key != other.key:
+            return None
+
+        if self.discrete:
+            position = {color: i for i, color in enumerate(other.colors)}
+            mapping = [position[color] for color in self.colors]
+        else:
+            mapping = self.search(other, budget)
+            if mapping is None:
+                return None
+
+        # Pair up the elements between the mapped nodes, equal ones between the same nodes in any order.
+        # That they all pair up is what makes sure the pieces are the same
+        buckets = {}
+        for i, (_, source, value, a, b) in enumerate(other.elements):
+            buckets.setdefault((a, b, source, value), []).append((i, 1.0))
+            if not source and a != b:
+                buckets.setdefault((b, a, source, value), []).append((i, -1.0))
+        taken = set()
+        elements = []
+        for _, source, value, a, b in self.elements:
+            pair = next(
+                ((i, sign) for i, sign in buckets.get((mapping[a], mapping[b], source, value), ()) if i not in taken),
+                None
+            )
+            if pair is None:
+                return None
+            taken.add(pair[0])
+            elements.append(pair)
+
+        return mapping, elements
+
+    def search(self, other: "Piece", budget: int) -> "[int] | None":
+        """
+        Return the node of the other piece for every node, found by backtracking over the nodes of the same colour,
+        None if there is no such mapping or it takes more than budget tries to find it
+        """
+        for piece in (self, other):
+            if piece.pairs is None:
+                piece.pairs = {}
+                for a, around in enumerate(piece.neighbours):
+                    for label, b in around:
+                        piece.pairs.setdefault((a, b), []).append(label)
+                piece.pairs = {pair: sorted(labels) for pair, labels in piece.pairs.items()}
+
+        # Take the nodes in breadth-first order from the rarest colour, so every node after the first
+        # only has to be looked for among the neighbours of where the node it was reached from went
+        by_color = {}
+        for i, color in enumerate(other.colors):
+            by_color.setdefault(color, []).append(i)
+        other_neighbours = [sorted({j for _, j in around}) for around in other.neighbours]
+
+        order, parent = [], [-1] * len(self.nodes)
+        seen = [False] * len(self.nodes)
+        for start in sorted(range(len(self.nodes)), key=lambda i: len(by_color[self.colors[i]])):
+            if seen[start]:
+                continue
+            seen[start] = True
+            queue = [start]
+            for node in queue:
+                order.append(node)
+                for _, j in self.neighbours[node]:
+                    if not seen[j]:
+                        seen[j] = True
+                        parent[j] = node
+                        queue.append(j)
+
+        mapping = [-1] * len(self.nodes)
+        used = [False] * len(other.nodes)
+
+        def consistent(u: int, x: int) -> bool:
+            # The elements between u and the nodes mapped so far have to be there between x and where those went
+            for _, w in self.neighbours[u]:
+                y = x if w == u else mapping[w]
+                if y >= 0 and self.pairs[(u, w)] != other.pairs.get((x, y)):
+                    return False
+            return True
+
+        candidates = [None] * len(order)
+        k = 0
+        while 0 <= k < len(order):
+            u = order[k]
+            if candidates[k] is None:
+                pool = other_neighbours[mapping[parent[u]]] if parent[u] >= 0 else by_color[self.colors[u]]
+                candidates[k] = iter([x for x in pool if other.colors[x] == self.colors[u]])
+            else:
+                used[mapping[u]] = False
+                mapping[u] = -1
+
+            for x in candidates[k]:
+                budget -= 1
+                if budget < 0:
+                    return None
+                if not used[x] and consistent(u, x):
+                    mapping[u] = x
+                    used[x] = True
+                    k += 1
+                    break
+            else:
+                candidates[k] = None
+                k -= 1
+
+        return mapping if k >= 0 else None
+
+    def blueprints(self) -> ({str: (float, str, str)}, {str: (float, str, str)}):
+        """
+        Return the resistors and voltage sources of this piece
+        """
+        resistors, voltage_sources = {}, {}
+        for name, source, value, a, b in self.elements:
+            (voltage_sources if source else resistors)[name] = (value, self.nodes[a], self.nodes[b])
+        return resistors, voltage_sources
+
+
+class PatternReduction:
+    """
+    The pieces of a circuit that repeat, and the smaller circuit left after placing every copy as a macro of its piece.
+    The ends of the fixed resistors and nodes with currents injected into them are headers as well,
+    so only linear resistors and voltage sources end up in a piece
+    """
+
+    # Macros of the recently reduced pieces by their signature, as (piece, macro), least recently used first.
+    # Circuits are reduced on other threads too, so they're only touched with the lock held
+    macros: {tuple: [(Piece, Macro)]} = {}
+    macros_size = 64
+    macros_lock = threading.Lock()
+
+    def __init__(self,
+                 nodes: [str],
+                 resistors: {str: (float, str, str)},
+                 voltage_sources: {str: (float, str, str)},
+                 fixed: [str],
+                 injections: {str: float}
+                 ):
+        self.node_names = list(nodes)
+        self.resistor_names = list(resistors)
+        self.source_names = list(voltage_sources)
+        node_index = {name: i for i, name in enumerate(self.node_names)}
+        resistor_index = {name: i for i, name in enumerate(self.resistor_names)}
+        source_index = {name: i for i, name in enumerate(self.source_names)}
+
+        elements = [
+            *((name, False, ohm, a, b) for name, (ohm, a, b) in resistors.items()),
+            *((name, True, volt, a, b) for name, (volt, a, b) in voltage_sources.items())
+        ]
+        degrees = np.zeros(len(self.node_names), dtype=np.int64)
+        for _, _, _, a, b in elements:
+            degrees[node_index[a]] += 1
+            degrees[node_index[b]] += 1
+        headers = {name for name, degree in zip(self.node_names, degrees.tolist()) if degree >= header_degree}
+        headers |= {node for name in fixed for node in resistors[name][1:]} | set(injections)
+
+        # Group the interior nodes that are connected without passing a header, with union-find
+        parent = list(range(len(self.node_names)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for _, _, _, a, b in elements:
+            if a not in headers and b not in headers:
+                a, b = find(node_index[a]), find(node_index[b])
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+        # Every element with an interior node belongs to the piece of that node, those between headers to none
+        grouped = {}
+        for element in elements:
+            _, _, _, a, b = element
+            interior = b if a in headers else a
+            if interior not in headers:
+                grouped.setdefault(find(node_index[interior]), []).append(element)
+        pieces = []
+        for group in grouped.values():
+            ends = {node for _, _, _, a, b in group for node in (a, b)}
+            piece_nodes = sorted(ends, key=node_index.get)
+            ports = [node for node in piece_nodes if node in headers]
+            if ports:
+                pieces.append(Piece(piece_nodes, ports, group))
+
+        # Only pieces of which there are more, or that were reduced before, are worth the colouring
+        counts = {}
+        for piece in pieces:
+            counts[piece.signature] = counts.get(piece.signature, 0) + 1
+
+        # Every piece is matched against the known pieces of its signature, as [piece, macro, copies],
+        # starting with those that were reduced before. A piece that matches none of them is a new one
+        candidates = {}
+        for piece in pieces:
+            if piece.signature not in candidates:
+                with PatternReduction.macros_lock:
+                    known = PatternReduction.macros.get(piece.signature)
+                    if known is not None:
+                        # Reinsert as the most recently used
+                        PatternReduction.macros[piece.signature] = PatternReduction.macros.pop(piece.signature)
+                        known = list(known)
+                if counts[piece.signature] < min_copies and known is None:
+                    continue
+                candidates[piece.signature] = [[original, macro, []] for original, macro in known or []]
+
+            for original, _, copies in candidates[piece.signature]:
+                match = original.match(piece)
+                if match is not None:
+                    copies.append((piece, *match))
+                    break
+            else:
+                identity = list(range(len(piece.nodes))), [(i, 1.0) for i in range(len(piece.elements))]
+                candidates[piece.signature].append([piece, None, [(piece, *identity)]])
+        patterns = [pattern for known in candidates.values() for pattern in known if pattern[2]]
+
+        # Reduce every new piece that repeats. One that can't be reduced is left in the circuit as it is
+        self.patterns = []
+        for original, macro, copies in patterns:
+            if macro is None:
+                if len(copies) < min_copies:
+                    continue
+                try:
+                    macro = Macro(original.nodes, *original.blueprints(), original.ports)
+                except Exception:
+                    continue
+                with PatternReduction.macros_lock:
+                    PatternReduction.macros.setdefault(original.signature, []).append((original, macro))
+                    while len(PatternReduction.macros) > PatternReduction.macros_size:
+                        del PatternReduction.macros[next(iter(PatternReduction.macros))]
+            self.patterns.append((original, macro, copies))
+
+        # The circuit left over: what isn't inside a copy, then the resistors that stand in for the copies
+        inside_nodes = set()
+        self.inside = set()
+        for original, _, copies in self.patterns:
+            for piece, _, _ in copies:
+                inside_nodes |= {node for node in piece.nodes if node not in headers}
+                self.inside |= {name for name, _, _, _, _ in piece.elements}
+        self.nodes = [name for name in self.node_names if name not in inside_nodes]
+        self.kept_node_index = np.array([node_index[name] for name in self.nodes], dtype=np.int64)
+        self.kept_resistors = [name for name in self.resistor_names if name not in self.inside]
+        self.kept_resistor_index = np.array([resistor_index[name] for name in self.kept_resistors], dtype=np.int64)
+        self.kept_sources = [name for name in self.source_names if name not in self.inside]
+        self.kept_source_index = np.array([source_index[name] for name in self.kept_sources], dtype=np.int64)
+        reduced_index = {name: i for i, name in enumerate(self.nodes)}
+
+        # Voltages are measured from a grounded node in every connected part, which may be inside a copy.
+        # The expanded voltages are measured from the node the whole circuit would have grounded instead,
+        # the from-node of its first voltage source or else its first node, see MNASystem.find_grounds
+        ends = np.array([node_index[node] for _, _, _, a, b in elements for node in (a, b)], dtype=np.int64)
+        ends = ends.reshape(-1, 2)
+        count = len(self.node_names)
+        graph = sparse.csr_matrix((np.ones(len(ends)), (ends[:, 0], ends[:, 1])), shape=(count, count))
+        parts = connected_components(graph, directed=False)[1]
+        grounds = np.full(parts.max(initial=-1) + 1, count, dtype=np.int64)
+        np.minimum.at(grounds, parts, np.arange(count))
+        froms = ends[len(resistors):, 0]
+        _, first = np.unique(parts[froms], return_index=True)
+        grounds[parts[froms[first]]] = froms[first]
+        self.references = grounds[parts]
+
+        # Where every copy finds its ports in the reduced circuit, and where its insides go in the whole circuit,
+        # in the order of its macro's nodes, resistors and voltage sources
+        self.placed = {}
+        self.injections = {}
+        self.links = {}
+        self.placements = []
+        for p, (original, macro, copies) in enumerate(self.patterns):
+            positions = {name: i for i, name in enumerate(original.nodes)}
+            ports = [positions[port] for port in macro.ports]
+            resistor_slots = [i for i, (_, source, _, _, _) in enumerate(original.elements) if not source]
+            source_slots = [i for i, (_, source, _, _, _) in enumerate(original.elements) if source]
+
+            port_positions, node_indices, resistor_indices, signs, source_indices = [], [], [], [], []
+            for c, (piece, mapping, element_map) in enumerate(copies):
+                port_nodes = {port: piece.nodes[mapping[i]] for port, i in zip(macro.ports, ports)}
+                instance = f"Pattern{p}#{c}"
+                resistors_placed, injected = macro.place(instance, port_nodes)
+                self.placed |= resistors_placed
+                for node, amps in injected.items():
+                    self.injections[node] = self.injections.get(node, 0) + amps
+                if np.any(macro.injections):
+                    first = port_nodes[macro.ports[0]]
+                    self.links |= {f"{instance}:{port}": (0, first, port_nodes[port]) for port in macro.ports[1:]}
+
+                port_positions.append([reduced_index[port_nodes[port]] for port in macro.ports])
+                node_indices.append([node_index[piece.nodes[mapping[i]]] for i in range(len(original.nodes))])
+                resistor_indices.append([resistor_index[piece.elements[element_map[i][0]][0]] for i in resistor_slots])
+                signs.append([element_map[i][1] for i in resistor_slots])
+                source_indices.append([source_index[piece.elements[element_map[i][0]][0]] for i in source_slots])
+
+            self.placements.append((
+                macro,
+                np.array(port_positions, dtype=np.int64),
+                np.array(node_indices, dtype=np.int64),
+                np.array(resistor_indices, dtype=np.int64).reshape(len(copies), -1),
+                np.array(signs, dtype=float).reshape(len(copies), -1),
+                np.array(source_indices, dtype=np.int64).reshape(len(copies), -1)
+            ))
+
+    def useful(self) -> bool:
+        """
+        Return whether any piece was memoized at all
+        """
+        return len(self.patterns) > 0
+
+    def reduced_resistors(self, resistors: {str: (float, str, str)}) -> {str: (float, str, str)}:
+        """
+        Return the blueprint of the resistors outside the copies, followed by those standing in for the copies
+        """
+        return {name: resistors[name] for name in self.kept_resistors} | self.placed
+
+    def reduced_voltage_sources(self, voltage_sources: {str: (float, str, str)}) -> {str: (float, str, str)}:
+        """
+        Return the blueprint of the voltage sources outside the copies
+        """
+        return {name: voltage_sources[name] for name in self.kept_sources}
+
+    def matches(self, resistors: {str: (float, str, str)}, voltage_sources: {str: (float, str, str)}) -> bool:
+        """
+        Return whether every copy still has the values of its piece, the copies were found with the values they had
+        """
+        resistances = np.array([ohm for ohm, _, _ in resistors.values()])
+        voltages = np.array([volt for volt, _, _ in voltage_sources.values()])
+        return all(
+            np.array_equal(resistances[resistor_index], np.broadcast_to(macro.system.resistances, resistor_index.shape))
+            and np.array_equal(voltages[source_index], np.broadcast_to(macro.system.voltages, source_index.shape))
+            for macro, _, _, resistor_index, _, source_index in self.placements
+        )
+
+    def expand(self, voltages: np.ndarray, resistor_currents: np.ndarray, source_currents: np.ndarray
+               ) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Expand the solution of the reduced circuit to all nodes, resistors and voltage sources.
+        The insides of all copies of a piece are solved for at once. Takes a solution per column as well,
+        like MNASystem.unpack
+        """
+        columns = voltages.shape[1:]
+        v = np.zeros((len(self.node_names),) + columns)
+        v[self.kept_node_index] = voltages
+        currents = np.zeros((len(self.resistor_names),) + columns)
+        currents[self.kept_resistor_index] = resistor_currents[:len(self.kept_resistors)]
+        sources = np.zeros((len(self.source_names),) + columns)
+        sources[self.kept_source_index] = source_currents
+
+        for macro, port_positions, node_index, resistor_index, signs, source_index in self.placements:
+            # The port voltages of every copy (and column) side by side
+            copies = (len(port_positions),) + columns
+            port_voltages = np.moveaxis(voltages[port_positions], 0, 1).reshape(len(macro.ports), -1)
+            inside = [
+                np.moveaxis(values.reshape((len(values),) + copies), 0, 1) for values in macro.internal(port_voltages)
+            ]
+            v[node_index] = inside[0]
+            currents[resistor_index] = inside[1] * signs.reshape(signs.shape + (1,) * len(columns))
+            sources[source_index] = inside[2]
+
+        return v - v[self.references], currents, sources
@@ -0,0 +1,152 @@
+"""
+Pruning the parts of a circuit that can't carry any flow
+
+A pump only drives flow around the loops it is part of, and every loop lies within a single biconnected block of the
+circuit, the pieces left when the circuit is cut at every node whose removal would split it. Resistors in a block
+without a pump carry no flow, whether the block is a subtree hanging off the network, a bridge or a loop of its own.
+Such resistors have no voltage drop either, so the nodes they connect are merged into one node (with union-find)
+and only the rest of the circuit reaches the solver
+"""
+
+import numpy as np
+
+
+class Pruning:
+    """
+    The blocks of a circuit, and the smaller circuit that is left after merging the nodes of every block without a pump.
+    Voltage sources are always kept, a pump in a block of its own carries no flow but still sets a voltage
+    """
+
+    def __init__(self, nodes: [str], resistors: {str: (float, str, str)}, voltage_sources: {str: (float, str, str)}):
+        node_index = {name: i for i, name in enumerate(nodes)}
+        ends = np.array(
+            [node_index[n] for _, a, b in [*resistors.values(), *voltage_sources.values()] for n in (a, b)], dtype=np.int64
+        ).reshape(-1, 2)
+
+        # Every element is an edge, resistors first. A resistor from a node to itself is in no block at all
+        blocks = biconnected_blocks(len(nodes), ends)
+        pumped = np.zeros(blocks.max(initial=-1) + 1, dtype=bool)
+        pumped[blocks[len(resistors):]] = True
+        resistor_blocks = blocks[:len(resistors)]
+        flowing = (resistor_blocks >= 0) & pumped[np.maximum(resistor_blocks, 0)]
+
+        # Merge the ends of every resistor without flow, the first node of every group stands in for the others
+        parent = list(range(len(nodes)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for a, b in ends[:len(resistors)][~flowing].tolist():
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        representatives = np.array([find(i) for i in range(len(nodes))], dtype=np.int64)
+
+        self.node_names = list(nodes)
+        self.flowing = flowing
+        self.flowing_index = np.flatnonzero(flowing)
+        self.pruned = {name for name, f in zip(resistors, flowing.tolist()) if not f}
+        kept = np.flatnonzero(representatives == np.arange(len(nodes)))
+        self.nodes = [self.node_names[i] for i in kept.tolist()]
+
+        # Where every original node reads its voltage in the solution of the pruned circuit
+        position = np.full(len(nodes), -1, dtype=np.int64)
+        position[kept] = np.arange(len(kept))
+        self.node_positions = position[representatives]
+        self.representative = {name: self.node_names[r] for name, r in zip(self.node_names, representatives.tolist())}
+
+    def useful(self) -> bool:
+        """
+        Return whether anything was pruned at all
+        """
+        return len(self.pruned) > 0
+
+    def pruned_resistors(self, resistors: {str: (float, str, str)}) -> {str: (float, str, str)}:
+        """
+        Return the blueprint of the resistors that can carry flow, connected to the nodes that are left
+        """
+        return {
+            name: (ohm, self.representative[a], self.representative[b])
+            for (name, (ohm, a, b)), flowing in zip(resistors.items(), self.flowing.tolist()) if flowing
+        }
+
+    def pruned_voltage_sources(self, voltage_sources: {str: (float, str, str)}) -> {str: (float, str, str)}:
+        """
+        Return the blueprint of the voltage sources, connected to the nodes that are left
+        """
+        return {
+            name: (volt, self.representative[_from], self.representative[_to])
+            for name, (volt, _from, _to) in voltage_sources.items()
+        }
+
+    def expand(self, voltages: np.ndarray, resistor_currents: np.ndarray, source_currents: np.ndarray
+               ) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Expand the solution of the pruned circuit to all nodes and resistors, the pruned resistors carry nothing.
+        Takes a solution per column as well, like MNASystem.unpack
+        """
+        currents = np.zeros((len(self.flowing_index) + len(self.pruned),) + resistor_currents.shape[1:])
+        currents[self.flowing_index] = resistor_currents
+        return voltages[self.node_positions], currents, source_currents
+
+
+def biconnected_blocks(node_count: int, ends: np.ndarray) -> np.ndarray:
+    """
+    Return the block every edge belongs to, numbered from 0, and -1 for edges from a node to itself.
+    Tarjan's depth-first search, without recursion, keeps the edges of the block it is in on a stack and
+    closes the block when it backs up to a node the block can't reach past
+    """
+    neighbours = [[] for _ in range(node_count)]
+    for k, (a, b) in enumerate(ends.tolist()):
+        if a != b:
+            neighbours[a].append((b, k))
+            neighbours[b].append((a, k))
+
+    blocks = np.full(len(ends), -1, dtype=np.int64)
+    discovered = [-1] * node_count
+    low = [0] * node_count
+    edges = []
+    block_count = 0
+    time = 0
+
+    for root in range(node_count):
+        if discovered[root] >= 0:
+            continue
+        discovered[root] = low[root] = time
+        time += 1
+
+        # Node, the edge it was reached by, and how far along its neighbours the search is
+        stack = [(root, -1, iter(neighbours[root]))]
+        while stack:
+            node, via, remaining = stack[-1]
+            for other, k in remaining:
+                if k == via:
+                    continue
+                if discovered[other] < 0:
+                    discovered[other] = low[other] = time
+                    time += 1
+                    edges.append(k)
+                    stack.append((other, k, iter(neighbours[other])))
+                    break
+                if discovered[other] < discovered[node]:
+                    # An edge back up the tree
+                    edges.append(k)
+                    low[node] = min(low[node], discovered[other])
+            else:
+                stack.pop()
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                    if low[node] >= discovered[parent]:
+                        # Nothing below this node reaches above its parent, so the block ends at the parent
+                        while True:
+                            k = edges.pop()
+                            blocks[k] = block_count
+                            if k == via:
+                                break
+                        block_count += 1
+
+    return blocks
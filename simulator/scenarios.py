@@ -0,0 +1,137 @@
+"""
+Stepping through every open/closed combination of a chosen set of valves
+
+The combinations are visited in Gray-code order, so every step opens or closes a single valve. Closing a valve takes
+most of its conductance out of the matrix, which is a rank-1 change, and Sherman-Morrison carries the solution over
+from the previous step. All changes stay within the span of the valves' incidence, so the whole state is kept
+in terms of the valves: with W = M^-1 U solved once for their incidence U, the solution is x0 + W t, and every step
+only updates small matrices the size of the number of valves. The circuit itself is never rebuilt or refactorized.
+The updates are recomputed from scratch every so often, so rounding errors can't pile up over millions of steps.
+Results are written to a CSV file a chunk of combinations at a time, so the memory taken doesn't grow with them
+"""
+
+import numpy as np
+
+from simulator.circuit import Circuit
+
+
+# How many combinations are written to the file at once, and after how many steps the state is computed afresh
+chunk = 4096
+refresh = 4096
+
+
+class ValveScenarios:
+    """
+    All open/closed combinations of the given valves (resistor names) of a linear circuit, starting with all of them
+    open at their present resistance. A closed valve still leaks like a blocked check valve does, see Circuit,
+    which keeps whatever is behind it connected. Every flow is a weighted sum of resistor and voltage source currents,
+    as {flow name: {element name: weight}}, the current of every resistor and voltage source by default
+    """
+
+    def __init__(self, circuit: Circuit, valves: [str], flows: {str: {str: float}} = None):
+        if circuit.exponents or circuit.check_valves:
+            raise Exception("Valve scenarios can only be enumerated for linear circuits without check valves")
+        if len(valves) > 30:
+            raise Exception("Too many valves to step through all their combinations")
+        if np.isnan(circuit.store.node_voltages).any():
+            raise Exception("Circuit has not been solved yet")
+
+        self.valves = list(valves)
+        if flows is None:
+            flows = {name: {name: 1.0} for name in [*circuit.resistors_blueprint, *circuit.voltage_sources_blueprint]}
+        self.flow_names = list(flows)
+
+        system = circuit.network_system()
+        valve_index = np.array([system.resistor_index[name] for name in self.valves], dtype=np.int64)
+        if np.any(system.resistances[valve_index] == 0):
+            raise Exception("Valves of zero ohm have no conductance to take out when closing them")
+        self.conductances = 1 / system.resistances[valve_index]
+        self.leak = Circuit.check_valve_leak
+
+        # The present solution and the valves' incidence solved against the same factorization
+        x0 = system.apply_updates(system.factorization.solve(system.rhs()))
+        w = system.apply_updates(system.factorization.solve(system.incidence(valve_index.tolist())))
+        a, b = system.rows[system.resistor_ends[valve_index]].T
+        padded = np.vstack([np.column_stack([x0, w]), np.zeros(1 + len(self.valves))])
+        across = padded[a] - padded[b]
+        self.y0 = across[:, 0]
+        self.z = across[:, 1:]
+
+        # A row of weights per flow over the system's resistor currents followed by its voltage source currents.
+        # The valves change conductance, so their own currents are weighed separately, by their voltage
+        weights = np.zeros((len(self.flow_names), len(system.resistor_names) + len(system.source_names)))
+        for row, element_weights in enumerate(flows.values()):
+            for name, weight in element_weights.items():
+                if name in system.resistor_index:
+                    weights[row, system.resistor_index[name]] += weight
+                else:
+                    weights[row, len(system.resistor_names) + system.source_index[name]] += weight
+        self.valve_weights = weights[:, valve_index].copy()
+        weights[:, valve_index] = 0
+
+        _, resistor_currents, source_currents = system.unpack(np.column_stack([x0, w]))
+        currents = weights @ np.vstack([resistor_currents, source_currents])
+        self.f0 = currents[:, 0]
+        self.fw = currents[:, 1:]
+
+    def count(self) -> int:
+        return 2 ** len(self.valves)
+
+    def state(self, closed: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        """
+        Return the state with the given valves closed, computed from scratch by the Woodbury identity:
+        with D the conductance every valve lost, T = (I + D Z)^-1 so that W T = (M + U D U')^-1 U,
+        the solution x0 + W t, and P = Z T and y = U'x for the next updates
+        """
+        lost = np.where(closed, -(1 - self.leak) * self.conductances, 0)
+        t_matrix = np.linalg.inv(np.eye(len(self.valves)) + lost[:, None] * self.z)
+        t = -t_matrix @ (lost * self.y0)
+        return t_matrix, t, self.z @ t_matrix, self.y0 + self.z @ t
+
+    def run(self, path: str, count: int = None):
+        """
+        Step through the first count combinations, all of them by default, and write a row per combination
+        to a CSV file at path: the step, whether every valve is open (1) or closed (0), then every flow.
+        The valves' columns are named "<valve> open", the flows' columns after the flows, which are often
+        named after the valves too. Yields the number of combinations written so far after every chunk
+        """
+        count = self.count() if count is None else min(count, self.count())
+        closed = np.zeros(len(self.valves), dtype=bool)
+        t_matrix, t, p, y = self.state(closed)
+
+        with open(path, "w") as file:
+            file.write(",".join(["step", *(f"{valve} open" for valve in self.valves), *self.flow_names]) + "\n")
+
+            for start in range(0, count, chunk):
+                steps = np.arange(start, min(start + chunk, count))
+                ts = np.empty((len(steps), len(self.valves)))
+                ys = np.empty((len(steps), len(self.valves)))
+                states = np.empty((len(steps), len(self.valves)), dtype=bool)
+
+                for k, step in enumerate(steps.tolist()):
+                    if step:
+                        # Gray code: step i toggles the valve of the lowest bit set in i
+                        j = (step & -step).bit_length() - 1
+                        delta = (1 - self.leak) * self.conductances[j] * (1 if closed[j] else -1)
+                        closed[j] = not closed[j]
+                        if step % refresh == 0:
+                            t_matrix, t, p, y = self.state(closed)
+                        else:
+                            # P is symmetric, its row stands in for its column
+                            scale = delta / (1 + delta * p[j, j])
+                            column, row, y_j = scale * t_matrix[:, j], p[j].copy(), y[j]
+                            t -= y_j * column
+                            y -= (scale * y_j) * row
+                            t_matrix -= column[:, None] * row
+                            p -= (scale * row)[:, None] * row
+                    ts[k], ys[k], states[k] = t, y, closed
+
+                # The flows of all the chunk's combinations at once, closed valves only carry their leak
+                valve_currents = ys * self.conductances * np.where(states, self.leak, 1)
+                flows = self.f0 + ts @ self.fw.T + valve_currents @ self.valve_weights.T
+                rows = np.column_stack([steps, ~states, flows])
+                np.savetxt(
+                    file, rows, delimiter=",",
+                    fmt=["%d"] * (1 + len(self.valves)) + ["%.9g"] * len(self.flow_names)
+                )
+                yield int(steps[-1]) + 1
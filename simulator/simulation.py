@@ -1,4 +1,5 @@
 import sys
+import threading
 
 import pygame
 import pygame.freetype
@@ -12,7 +13,12 @@ from engine import text
 from simulator.panel import Panel
 from simulator.pipe import PipeLayer
 from simulator.inspectable import Inspectable
+from simulator.components import GateValve, ThreewayValve, Pump, CheckValve
 from simulator import parse
+from simulator.transient import Transient, ramp
+from simulator.optimize import ValveOptimizer
+from simulator.montecarlo import MonteCarlo
+from simulator.scenarios import ValveScenarios
 
 
 class SimulationScene(Scene):
@@ -36,6 +42,17 @@ class SimulationScene(Scene):
         # The component inspector
         self.inspect_focus = None
 
+        # The pipe whose current the valves are ranked by in inspect mode, with how fast it changes with every valve
+        self.sensitivity_pipe = None
+        self.sensitivities = {}
+
+        # The currents chosen pipes should get, and the optimizer looking for the valve settings that give them
+        self.flow_targets = {}
+        self.optimizer = None
+
+        # The 5th, 50th and 95th percentile of every pipe's current when the valves and pumps are off by their tolerance
+        self.tolerance_results = {}
+
         # The camera, for moving around the scene
         self.camera = Camera(
             pos=(0, 0),
@@ -50,12 +67,16 @@ class SimulationScene(Scene):
         self.conn_particles = particle.ParticleManager()
 
         self.simulating = False
+        self.circuits = []
+        self.transients = []
+        self.transient_end = 0
         self.frame = 0
 
         # TODO: remove debug
         self.pump_count = 0
         self.gate_count = 0
         self.thre_count = 0
+        self.check_count = 0
         self.fitt_count = 0
         self.draw_nodes = False
 
@@ -108,6 +129,30 @@ class SimulationScene(Scene):
                     sys.exit()
                 elif event.key == pygame.K_n:
                     self.draw_nodes = not self.draw_nodes
+                elif event.key == pygame.K_t and self.simulating:
+                    self.start_transients()
+                elif event.key == pygame.K_g and self.simulating and self.panel.mode == "inspect":
+                    # Rank the valves by their effect on the pipe under the mouse, or stop ranking them
+                    hovered = [pipe for pipe in self.pipes if pipe.rect.collidepoint(*mouse)]
+                    self.sensitivity_pipe = hovered[0] if hovered else None
+                    self.update_sensitivities()
+                elif event.key in (pygame.K_f, pygame.K_UP, pygame.K_DOWN) and self.simulating and self.panel.mode == "inspect":
+                    # Set a target at the current of the pipe under the mouse or drop it, and raise or lower it
+                    for pipe in [pipe for pipe in self.pipes if pipe.rect.collidepoint(*mouse)][:1]:
+                        if event.key == pygame.K_f and pipe in self.flow_targets:
+                            del self.flow_targets[pipe]
+                        elif event.key == pygame.K_f and pipe.current is not None:
+                            self.flow_targets[pipe] = pipe.current.current
+                        elif pipe in self.flow_targets:
+                            self.flow_targets[pipe] *= 1.1 if event.key == pygame.K_UP else 1 / 1.1
+                elif event.key == pygame.K_o and self.simulating and self.flow_targets:
+                    self.start_optimizer()
+                elif event.key == pygame.K_m and self.simulating:
+                    self.start_tolerance_analysis()
+                elif event.key == pygame.K_c and self.simulating and not self.transients:
+                    self.print_contingencies()
+                elif event.key == pygame.K_e and self.simulating and not self.transients:
+                    self.start_scenarios()
                 elif event.key == pygame.K_BACKQUOTE:
                     if debug.is_active():
                         debug.disable()
@@ -134,9 +179,18 @@ class SimulationScene(Scene):
 
         debug.debug("components", self.components)
         debug.debug("pipes", self.pipes)
+        debug.debug("solution cache", parse.solutions.stats())
 
         self.components.early_update()
 
+        # Apply the valve settings once the optimizer has found them
+        if self.optimizer is not None and self.optimizer.done():
+            self.apply_optimizer()
+
+        # Step the running transient simulations by one frame
+        if self.transients:
+            self.step_transients(1 / 60)
+
         # Update the sprite groups
         show_connectors = len(self.floating_components) > 0 or self.panel.mode == "pipe"
         self.floating_components.update(self.camera, show_connectors=show_connectors)
@@ -159,6 +213,11 @@ class SimulationScene(Scene):
             self.draw_focus_border(surface)
         self.pipes.draw(surface)
 
+        if self.simulating and self.panel.mode == "inspect" and self.sensitivity_pipe is not None:
+            self.draw_sensitivities(surface)
+        if self.simulating and self.panel.mode == "inspect" and (self.flow_targets or self.optimizer is not None):
+            self.draw_flow_targets(surface)
+
         if self.draw_nodes:
             for comp in self.components:
                 if comp.__class__.__name__ == "Fitting" and comp.node is not None:
@@ -180,7 +239,7 @@ class SimulationScene(Scene):
 
         if self.simulating:
             for component in [*self.components, *self.pipes]:
-                if component.__class__.__name__ in ["Pipe", "GateValve", "ThreewayValve", "Pump"]:
+                if component.__class__.__name__ in ["Pipe", "GateValve", "CheckValve", "ThreewayValve", "Pump"]:
                     if component.rect.collidepoint(mouse := pygame.mouse.get_pos()):
                         surf = None
 
@@ -188,15 +247,21 @@ class SimulationScene(Scene):
                             case "Pipe":
                                 s, r = text.render(f"Current: {component.current.current:.3f}A", colors.black, "Arial", 14)
                                 vs, vr = text.render(f"Voltage: {component.current.voltage:.3f}V", colors.black, "Arial", 14)
-                                surf = pygame.Surface((max(r.w, vr.w) + 15, r.h + vr.h + 15))
+                                low, median, high = self.tolerance_results.get(component, (None, None, None))
+                                tolerance = "" if low is None else f"5-95%: {low:.3f}A to {high:.3f}A ({median:.3f}A)"
+                                ts, tr = text.render(tolerance, colors.black, "Arial", 14) if tolerance else (None, pygame.Rect(0, 0, 0, 0))
+                                surf = pygame.Surface((max(r.w, vr.w, tr.w) + 15, r.h + vr.h + tr.h + 15))
                                 rect = surf.get_rect()
                                 surf.fill(colors.gainsboro)
                                 pygame.draw.rect(surf, colors.dark_gray, rect, 3)
-                                r.centerx = vr.centerx = rect.centerx
+                                r.centerx = vr.centerx = tr.centerx = rect.centerx
                                 r.top = 7
                                 vr.top = r.bottom + 1
+                                tr.top = vr.bottom + 1
                                 surf.blit(s, r)
                                 surf.blit(vs, vr)
+                                if tolerance:
+                                    surf.blit(ts, tr)
                             case "Pump":
                                 vs, vr = text.render(f"Volts: {component.circuit_pump.voltage: .3f}V", colors.black, "Arial", 14)
                                 cs, cr = text.render(f"Current: {component.circuit_pump.current.amps: .3f}A", colors.black, "Arial", 14)
@@ -209,20 +274,29 @@ class SimulationScene(Scene):
                                 cr.top = vr.bottom + 1
                                 surf.blit(vs, vr)
                                 surf.blit(cs, cr)
-                            case "GateValve":
+                            case "GateValve" | "CheckValve":
                                 rs, rr = text.render(f"Resistance: {component.circuit_valve.resistance: .3f}Ω", colors.black,
                                                      "Arial", 14)
                                 cs, cr = text.render(f"Current: {component.circuit_valve.current.amps: .3f}A",
                                                      colors.black, "Arial", 14)
-                                surf = pygame.Surface((max(rr.w, cr.w) + 15, rr.h + cr.h + 15))
+                                # Whether a check valve lets water through right now
+                                state = ""
+                                if isinstance(component, CheckValve):
+                                    blocked = any(component.name in circuit.blocked for circuit in self.circuits)
+                                    state = "Blocked" if blocked else "Open"
+                                ss, sr = text.render(state, colors.black, "Arial", 14) if state else (None, pygame.Rect(0, 0, 0, 0))
+                                surf = pygame.Surface((max(rr.w, cr.w, sr.w) + 15, rr.h + cr.h + sr.h + 15))
                                 rect = surf.get_rect()
                                 surf.fill(colors.gainsboro)
                                 pygame.draw.rect(surf, colors.dark_gray, rect, 3)
-                                rr.centerx = cr.centerx = rect.centerx
+                                rr.centerx = cr.centerx = sr.centerx = rect.centerx
                                 rr.top = 7
                                 cr.top = rr.bottom + 1
+                                sr.top = cr.bottom + 1
                                 surf.blit(rs, rr)
                                 surf.blit(cs, cr)
+                                if state:
+                                    surf.blit(ss, sr)
 
                         if surf is not None:
                             surface.blit(surf, mouse)
@@ -239,6 +313,9 @@ class SimulationScene(Scene):
         elif comp.__class__.__name__ == "GateValve":
             self.gate_count += 1
             comp.name = f"Gate {self.gate_count}"
+        elif comp.__class__.__name__ == "CheckValve":
+            self.check_count += 1
+            comp.name = f"Check {self.check_count}"
         elif comp.__class__.__name__ == "ThreewayValve":
             self.thre_count += 1
             comp.name = f"Thre {self.thre_count}"
@@ -256,9 +333,228 @@ class SimulationScene(Scene):
         scaled = pygame.transform.smoothscale(border_surf, self.inspect_focus.rect.size)
         surface.blit(scaled, self.inspect_focus.rect)
 
+    def draw_sensitivities(self, surface: pygame.Surface):
+        """
+        Outline the pipe the valves are ranked by, and label every valve with its rank and its effect on that pipe
+        """
+        pygame.draw.rect(surface, colors.orange, self.sensitivity_pipe.rect, 2)
+
+        for rank, (valve, gradient) in enumerate(self.sensitivities.items(), 1):
+            surf, rect = text.render(f"#{rank} {gradient:+.3g}A/Ω", colors.black, "Arial", 14)
+            label = pygame.Surface((rect.w + 8, rect.h + 4))
+            label.fill(colors.gainsboro)
+            pygame.draw.rect(label, colors.orange if rank == 1 else colors.dark_gray, label.get_rect(), 2)
+            label.blit(surf, (4, 2))
+            surface.blit(label, label.get_rect(midbottom=valve.rect.midtop))
+
+    def draw_flow_targets(self, surface: pygame.Surface):
+        """
+        Label every pipe that has a target with its target and present current, and show when the optimizer is running
+        """
+        for pipe, target in self.flow_targets.items():
+            if not self.pipes.has(pipe):
+                continue
+            current = f"{pipe.current.current:.3f}A" if pipe.current is not None else "-"
+            surf, rect = text.render(f"Target {target:.3f}A, now {current}", colors.black, "Arial", 14)
+            label = pygame.Surface((rect.w + 8, rect.h + 4))
+            label.fill(colors.gainsboro)
+            pygame.draw.rect(label, colors.dodger_blue, label.get_rect(), 2)
+            label.blit(surf, (4, 2))
+            surface.blit(label, label.get_rect(midtop=pipe.rect.midbottom))
+
+        if self.optimizer is not None:
+            surf, rect = text.render("Optimizing valves...", colors.black, "Arial", 18, bold=True)
+            rect.midtop = surface.get_rect().centerx, 10
+            surface.blit(surf, rect)
+
     def parse_circuit(self):
+        self.transients = []
+        self.tolerance_results = {}
         for pipe in self.pipes:
             pipe.current = None
         parse.assign_nodes(self.components)
-        parse.parse(self.components)
+        self.circuits = parse.parse(self.components)
+        parse.assign_pipe_current(self.components, self.pipes)
+        self.update_sensitivities()
+
+    def retune(self, component: Inspectable):
+        """
+        Update the simulation after the value of an inspected component changed
+        """
+        self.transients = []
+        self.tolerance_results = {}
+        if not isinstance(component, (GateValve, ThreewayValve, Pump)) or not parse.retune(component, self.circuits):
+            self.parse_circuit()
+            return
+
+        for pipe in self.pipes:
+            pipe.current = None
+        parse.assign_pipe_current(self.components, self.pipes)
+        self.update_sensitivities()
+
+    def update_sensitivities(self):
+        """
+        Rank the valves by how fast the current through the chosen pipe changes with their resistance,
+        with a single extra solve of its circuit
+        """
+        self.sensitivities = {}
+        if self.sensitivity_pipe is not None and self.pipes.has(self.sensitivity_pipe):
+            self.sensitivities = parse.valve_sensitivities(self.sensitivity_pipe, self.components, self.circuits)
+
+    def start_optimizer(self):
+        """
+        Look for the valve settings that give the pipes their target currents, in the background
+        """
+        if self.optimizer is not None:
+            self.optimizer.cancel()
+        targets = {pipe: target for pipe, target in self.flow_targets.items() if self.pipes.has(pipe)}
+        self.optimizer = ValveOptimizer(self.circuits, self.components, targets)
+        self.optimizer.start()
+
+    def apply_optimizer(self):
+        """
+        Write the settings the optimizer found to the valves and re-solve their circuits
+        """
+        optimizer, self.optimizer = self.optimizer, None
+        if optimizer.error is not None:
+            print(f"Optimizing the valves failed: {optimizer.error}")
+            return
+        print(f"Optimized valves, relative mismatch left per circuit: {optimizer.mismatches}")
+
+        self.transients = []
+        self.tolerance_results = {}
+        retuned = True
+        for valve, (resistance, blue_part) in optimizer.settings.items():
+            valve.text_value = resistance
+            valve.input.text = f"{resistance:.3f}"
+            if blue_part is not None:
+                valve.blue_part = blue_part
+            retuned = parse.retune(valve, self.circuits) and retuned
+
+        if not retuned:
+            self.parse_circuit()
+            return
+        for pipe in self.pipes:
+            pipe.current = None
+        parse.assign_pipe_current(self.components, self.pipes)
+        self.update_sensitivities()
+
+    def start_tolerance_analysis(self):
+        """
+        Sample the gate valves and pumps within their tolerance and gather the spread of every pipe's current,
+        in the background. The percentiles are updated every time another batch of samples is in
+        """
+        gates = {component.name for component in self.components if isinstance(component, GateValve)}
+        runs = []
+        for circuit in self.circuits:
+            pipes = [pipe for pipe in self.pipes if parse.pipe_circuit(pipe, [circuit]) is circuit]
+            if pipes:
+                flows = [pipe.current.elements for pipe in pipes]
+                runs.append((MonteCarlo(circuit, flows, [name for name in circuit.resistors if name in gates]), pipes))
+
+        # A new analysis or a new parse replaces the results, older runs keep filling their own
+        results = {}
+        self.tolerance_results = results
+
+        def run():
+            for monte_carlo, pipes in runs:
+                for summary in monte_carlo.run():
+                    # Signed along the pipe's current, which is what is shown
+                    for pipe, percentiles in zip(pipes, summary.percentiles([5, 50, 95]).tolist()):
+                        results[pipe] = tuple(percentiles)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def print_contingencies(self):
+        """
+        Print what blocking every valve and pump on its own does to the flows, the worst outages first
+        """
+        table = parse.contingency_table(self.circuits)
+        print(f"{'Blocked':<16}{'Worst hit':<16}{'Before':>12}{'After':>12}{'Change':>12}")
+        for outage, element, before, after in table:
+            print(f"{outage:<16}{element:<16}{before:>11.3f}A{after:>11.3f}A{after - before:>+11.3f}A")
+        print("\n" + ("-" * 30))
+
+    def start_scenarios(self, max_valves: int = 20):
+        """
+        Step through every open/closed combination of the gate valves of every circuit, in the background,
+        writing the current of every pipe to a CSV file per circuit. Circuits with more valves than max_valves
+        are skipped, and so are those the valves can't be stepped through in, see ValveScenarios
+        """
+        runs = []
+        for circuit in self.circuits:
+            valves = [
+                c.name for c in self.components
+                if isinstance(c, GateValve) and not isinstance(c, CheckValve) and c.name in circuit.resistors
+            ]
+            pipes = [pipe for pipe in self.pipes if parse.pipe_circuit(pipe, [circuit]) is circuit]
+            if not valves or not pipes:
+                continue
+            if len(valves) > max_valves:
+                print(f"Skipping a circuit with {len(valves)} valves, more than {max_valves}")
+                continue
+            flows = {f"Pipe {i}": pipe.current.elements for i, pipe in enumerate(pipes, 1)}
+            try:
+                runs.append(ValveScenarios(circuit, valves, flows))
+            except Exception as e:
+                print(f"Skipping a circuit: {e}")
+
+        def run():
+            for i, scenarios in enumerate(runs, 1):
+                path = f"scenarios {i}.csv"
+                for _ in scenarios.run(path):
+                    pass
+                print(f"Wrote {scenarios.count()} valve scenarios to {path}")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def start_transients(self, duration: float = 2.0):
+        """
+        Start the pumps from standstill, ramping them up to their voltage over the given duration.
+        Check valves stay open or blocked like they are in the steady state. Nonlinear valves and macros
+        can't be stepped through time, circuits with them keep showing their steady state
+        """
+        self.end_transients()
+        for circuit in self.circuits:
+            if circuit.exponents or circuit.macros:
+                print("Skipping a circuit: transients can only be simulated for linear circuits without macros")
+                continue
+            transient = Transient(
+                circuit.nodes_blueprint, circuit.all_resistors(), circuit.voltage_sources_blueprint,
+                schedules={name: ramp(0, volt, duration) for name, (volt, _, _) in circuit.voltage_sources_blueprint.items()},
+                timestep=1e-3
+            )
+            steady = circuit.store.node_voltages, circuit.store.resistor_currents, circuit.store.source_currents
+            self.transients.append((circuit, transient, steady))
+        self.transient_end = duration
+
+    def step_transients(self, duration: float):
+        """
+        Advance the transient simulations and show their state on the pipes
+        """
+        for circuit, transient, _ in self.transients:
+            _, voltages, resistor_currents, source_currents, _ = transient.advance(duration)
+            circuit.apply_solution(voltages, resistor_currents, source_currents)
+
+        # Once all pumps are up to speed the circuits are back at their steady state
+        if all(transient.t >= self.transient_end for _, transient, _ in self.transients):
+            self.end_transients()
+            return
+
+        for pipe in self.pipes:
+            pipe.current = None
+        parse.assign_pipe_current(self.components, self.pipes)
+
+    def end_transients(self):
+        """
+        Stop the transient simulations, putting the steady state they started from back on the circuits and pipes
+        """
+        if not self.transients:
+            return
+        for circuit, _, steady in self.transients:
+            circuit.apply_solution(*steady)
+        self.transients = []
+
+        for pipe in self.pipes:
+            pipe.current = None
         parse.assign_pipe_current(self.components, self.pipes)
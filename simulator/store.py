@@ -0,0 +1,223 @@
+"""
+Array storage of a circuit
+
+All nodes, resistors and voltage sources of a circuit live in a handful of NumPy arrays, indexed by their position in the
+blueprint. The solver's results are kept as the arrays it returned, without copying them.
+Object-style access (circuit.resistors["A"].current.amps) goes through small views on these arrays,
+which are only made for the elements that are actually looked at
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class Current:
+    __slots__ = ("amps", "source", "target")
+
+    def __init__(self, amps: float, source: "Node", target: "Node"):
+        self.amps = amps
+        self.source = source
+        self.target = target
+
+    def __repr__(self):
+        return f"({self.amps}A {self.source.name} -> {self.target.name})"
+
+
+class CircuitStore:
+    """
+    The nodes, resistors and voltage sources of a circuit as arrays.
+
+    Resistor currents are signed from node1 to node2, voltage source currents from their from-node to their to-node.
+    Before the circuit is solved all results are NaN
+    """
+
+    __slots__ = (
+        "node_names", "node_index", "resistor_names", "resistor_index", "source_names", "source_index",
+        "resistor_ends", "source_ends", "resistances", "voltages",
+        "node_voltages", "resistor_currents", "source_currents",
+        "nodes", "resistors", "voltage_sources"
+    )
+
+    def __init__(self, nodes: [str], resistors: {str: (float, str, str)}, voltage_sources: {str: (float, str, str)}):
+        self.node_names = list(nodes)
+        self.node_index = {name: i for i, name in enumerate(self.node_names)}
+        self.resistor_names = list(resistors)
+        self.resistor_index = {name: i for i, name in enumerate(self.resistor_names)}
+        self.source_names = list(voltage_sources)
+        self.source_index = {name: i for i, name in enumerate(self.source_names)}
+
+        # Endpoints as node indices, (node1, node2) for resistors and (from, to) for voltage sources
+        self.resistor_ends = self.index_ends(resistors)
+        self.source_ends = self.index_ends(voltage_sources)
+        self.resistances = np.fromiter((r for r, _, _ in resistors.values()), dtype=float, count=len(resistors))
+        self.voltages = np.fromiter((v for v, _, _ in voltage_sources.values()), dtype=float, count=len(voltage_sources))
+
+        self.node_voltages = np.full(len(self.node_names), np.nan)
+        self.resistor_currents = np.full(len(self.resistor_names), np.nan)
+        self.source_currents = np.full(len(self.source_names), np.nan)
+
+        # Name -> view mappings, for object-style access
+        self.nodes = Views(self, self.node_names, self.node_index, NodeView)
+        self.resistors = Views(self, self.resistor_names, self.resistor_index, ResistorView)
+        self.voltage_sources = Views(self, self.source_names, self.source_index, VoltageSourceView)
+
+    def index_ends(self, elements: {str: (float, str, str)}) -> np.ndarray:
+        """
+        Return the two endpoints of every element as node indices, in an array of elements x 2
+        """
+        ends = np.fromiter(
+            (self.node_index[n] for _, a, b in elements.values() for n in (a, b)), dtype=np.int64, count=2 * len(elements)
+        )
+        return ends.reshape(-1, 2)
+
+    def set_results(self, voltages: np.ndarray, resistor_currents: np.ndarray, source_currents: np.ndarray):
+        """
+        Keep the solved node voltages, resistor currents and voltage source currents, in blueprint order
+        """
+        self.node_voltages = voltages
+        self.resistor_currents = resistor_currents
+        self.source_currents = source_currents
+
+    def current(self, amps: float, node1: int, node2: int) -> Current | None:
+        """
+        Return a signed current from node1 to node2 as a Current object, None if it hasn't been solved
+        """
+        if amps != amps:
+            return None
+        if amps >= 0:
+            return Current(amps, self.nodes[self.node_names[node1]], self.nodes[self.node_names[node2]])
+        return Current(-amps, self.nodes[self.node_names[node2]], self.nodes[self.node_names[node1]])
+
+
+class Views(Mapping):
+    """
+    Maps names to views of a single kind of element, making the views on first access
+    """
+
+    __slots__ = ("store", "names", "index", "view", "made")
+
+    def __init__(self, store: CircuitStore, names: [str], index: {str: int}, view: type):
+        self.store = store
+        self.names = names
+        self.index = index
+        self.view = view
+        self.made = {}
+
+    def __getitem__(self, name: str):
+        if name not in self.made:
+            self.made[name] = self.view(self.store, self.index[name])
+        return self.made[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+"""
+Views
+"""
+
+
+class ElementView:
+    __slots__ = ("store", "i")
+
+    def __init__(self, store: CircuitStore, i: int):
+        self.store = store
+        self.i = i
+
+    def __eq__(self, other):
+        return self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __lt__(self, other):
+        return hash(self) < hash(other)
+
+
+class NodeView(ElementView):
+    __slots__ = ()
+
+    @property
+    def name(self) -> str:
+        return self.store.node_names[self.i]
+
+    @property
+    def voltage(self) -> float | None:
+        voltage = float(self.store.node_voltages[self.i])
+        return None if voltage != voltage else voltage
+
+    def __repr__(self):
+        return f"Node<{self.name}{'' if self.voltage is None else f', {self.voltage}V'}>"
+
+
+class ResistorView(ElementView):
+    __slots__ = ()
+
+    @property
+    def name(self) -> str:
+        return self.store.resistor_names[self.i]
+
+    @property
+    def resistance(self) -> float:
+        return float(self.store.resistances[self.i])
+
+    @resistance.setter
+    def resistance(self, resistance: float):
+        self.store.resistances[self.i] = resistance
+
+    @property
+    def nodes(self) -> (NodeView, NodeView):
+        a, b = self.store.resistor_ends[self.i].tolist()
+        return self.store.nodes[self.store.node_names[a]], self.store.nodes[self.store.node_names[b]]
+
+    @property
+    def current(self) -> Current | None:
+        a, b = self.store.resistor_ends[self.i].tolist()
+        return self.store.current(float(self.store.resistor_currents[self.i]), a, b)
+
+    @property
+    def voltage_drop(self) -> float | None:
+        amps = float(self.store.resistor_currents[self.i])
+        return None if amps != amps else abs(amps) * self.resistance
+
+    def __repr__(self):
+        return f"Resistor<{self.name}, {self.resistance}Ω, ({', '.join(n.name for n in self.nodes)})>"
+
+
+class VoltageSourceView(ElementView):
+    __slots__ = ()
+
+    @property
+    def name(self) -> str:
+        return self.store.source_names[self.i]
+
+    @property
+    def voltage(self) -> float:
+        return float(self.store.voltages[self.i])
+
+    @voltage.setter
+    def voltage(self, voltage: float):
+        self.store.voltages[self.i] = voltage
+
+    @property
+    def neg_node(self) -> NodeView:
+        return self.store.nodes[self.store.node_names[self.store.source_ends[self.i, 0]]]
+
+    @property
+    def pos_node(self) -> NodeView:
+        return self.store.nodes[self.store.node_names[self.store.source_ends[self.i, 1]]]
+
+    @property
+    def current(self) -> Current | None:
+        neg, pos = self.store.source_ends[self.i].tolist()
+        return self.store.current(float(self.store.source_currents[self.i]), neg, pos)
+
+    def __repr__(self):
+        return f"VoltageSource<{self.name}, {self.voltage}V, {self.pos_node.name} → {self.neg_node.name}>"
@@ -0,0 +1,193 @@
+"""
+Time-domain (transient) simulation of a circuit
+
+Accumulators store fluid like capacitors store charge, and the inertia of the fluid in long lines acts like an inductor.
+Every timestep both are replaced by a companion model: a conductance in parallel with a current source that only
+depends on the previous timestep. With a fixed timestep the conductances never change,
+so the matrix is factorized once and every step is a single solve against the same factorization
+"""
+
+from typing import Callable
+
+import numpy as np
+from scipy import sparse
+
+from simulator.mna import MNASystem, Backend, get_backend
+
+
+def ramp(start: float, end: float, duration: float, delay: float = 0) -> Callable[[float], float]:
+    """
+    Return a schedule going linearly from start to end over the given duration, after an optional delay
+    """
+    def schedule(t: float) -> float:
+        progress = min(max((t - delay) / duration, 0), 1) if duration > 0 else float(t >= delay)
+        return start + (end - start) * progress
+    return schedule
+
+
+class Transient:
+    """
+    A circuit stepped through time with a fixed timestep.
+
+    Capacitors (accumulators) and inductors (inertive lines) are given as {name: (value, node1, node2)},
+    their currents flow from node1 to node2. Schedules map the name of a resistor or voltage source
+    to a function of time, giving its resistance or voltage at that time
+    """
+
+    def __init__(self,
+                 nodes: [str],
+                 resistors: {str: (float, str, str)},
+                 voltage_sources: {str: (float, str, str)},
+                 capacitors: {str: (float, str, str)} = None,
+                 inductors: {str: (float, str, str)} = None,
+                 schedules: {str: Callable[[float], float]} = None,
+                 timestep: float = 1e-3,
+                 method: str = "trapezoidal",
+                 backend: "str | Backend" = "sparse",
+                 initial: str = "rest"
+                 ):
+        self.capacitors = capacitors or {}
+        self.inductors = inductors or {}
+        self.schedules = schedules or {}
+        self.timestep = timestep
+        self.method = method
+        self.backend = get_backend(backend)
+
+        if method not in ("trapezoidal", "backward_euler"):
+            raise Exception(f"Unknown integration method \"{method}\", choose trapezoidal or backward_euler")
+        if len({*resistors, *voltage_sources, *self.capacitors, *self.inductors}) != \
+                len(resistors) + len(voltage_sources) + len(self.capacitors) + len(self.inductors):
+            raise Exception("Names of resistors, voltage sources, capacitors and inductors have to be unique")
+        for name in self.schedules:
+            if name not in resistors and name not in voltage_sources:
+                raise Exception(f"Schedule for \"{name}\", which is not a resistor or voltage source")
+
+        self.resistors_blueprint = dict(resistors)
+        self.voltage_sources_blueprint = dict(voltage_sources)
+
+        # Companion conductances, the trapezoidal rule doubles the weight of the new timestep
+        factor = 2 if method == "trapezoidal" else 1
+        capacitances = np.array([c for c, _, _ in self.capacitors.values()], dtype=float)
+        inductances = np.array([ind for ind, _, _ in self.inductors.values()], dtype=float)
+        self.conductances = np.concatenate([factor * capacitances / timestep, timestep / (factor * inductances)])
+        self.is_capacitor = np.arange(len(self.conductances)) < len(self.capacitors)
+
+        # The companion conductances are stamped as ordinary resistors, after the circuit's own
+        companions = {
+            name: (1 / g, a, b)
+            for (name, (_, a, b)), g in zip([*self.capacitors.items(), *self.inductors.items()], self.conductances)
+        }
+        self.system = MNASystem(nodes, self.resistors_blueprint | companions, self.voltage_sources_blueprint)
+        self.system.factorize(self.backend)
+
+        self.node_names = self.system.node_names
+        self.resistor_names = list(resistors)
+        self.source_names = self.system.source_names
+        self.element_names = list(companions)
+
+        # Matrix rows of the companion ends, -1 for grounded nodes reads the zero appended to every solution
+        ends = self.system.resistor_ends[len(resistors):]
+        self.element_rows = self.system.rows[ends]
+        scatter_rows = self.element_rows.ravel()
+        signs = np.tile([1.0, -1.0], len(ends))
+        columns = np.repeat(np.arange(len(ends)), 2)
+        keep = scatter_rows >= 0
+        self.scatter = sparse.csr_matrix(
+            (signs[keep], (scatter_rows[keep], columns[keep])), shape=(self.system.size, len(ends))
+        )
+
+        self.t = 0.0
+        self.x = np.zeros(self.system.size)
+        self.element_voltages = np.zeros(len(ends))
+        self.element_currents = np.zeros(len(ends))
+        if initial == "steady":
+            self.start_steady()
+        elif initial != "rest":
+            raise Exception(f"Unknown initial state \"{initial}\", choose rest or steady")
+
+    def start_steady(self):
+        """
+        Start from the DC steady state at t=0, capacitors carrying no current and inductors carrying no voltage
+        """
+        resistors, voltage_sources = self.scheduled_values(0.0)
+        shorts = {name: (0.0, a, b) for name, (_, a, b) in self.inductors.items()}
+        system = MNASystem(self.node_names, resistors | shorts, voltage_sources)
+        voltages, resistor_currents, _ = system.solve(self.backend)
+
+        ends = self.system.resistor_ends[len(self.resistor_names):]
+        self.element_voltages = voltages[ends[:, 0]] - voltages[ends[:, 1]]
+        self.element_currents = np.concatenate([
+            np.zeros(len(self.capacitors)), resistor_currents[len(resistors):]
+        ])
+
+    def scheduled_values(self, t: float) -> ({str: (float, str, str)}, {str: (float, str, str)}):
+        """
+        Return the resistor and voltage source blueprints with all schedules applied for the given time
+        """
+        resistors, voltage_sources = dict(self.resistors_blueprint), dict(self.voltage_sources_blueprint)
+        for name, schedule in self.schedules.items():
+            elements = resistors if name in resistors else voltage_sources
+            _, a, b = elements[name]
+            elements[name] = (schedule(t), a, b)
+        return resistors, voltage_sources
+
+    def step(self):
+        """
+        Advance the simulation by a single timestep
+        """
+        self.t += self.timestep
+
+        # Scheduled values, changed resistances become low-rank updates of the factorization
+        changes = {}
+        for name, schedule in self.schedules.items():
+            value = schedule(self.t)
+            if name in self.system.source_index:
+                self.system.voltages[self.system.source_index[name]] = value
+            elif value != self.system.resistances[self.system.resistor_index[name]]:
+                changes[name] = value
+        if changes and not self.system.update_resistances(changes, max_rank=max(16, len(self.schedules))):
+            raise Exception("Scheduled resistances can't go to or come from zero during a transient simulation")
+
+        # Companion current sources, from the previous timestep
+        g = self.conductances
+        if self.method == "trapezoidal":
+            sources = np.where(
+                self.is_capacitor,
+                g * self.element_voltages + self.element_currents,
+                -(self.element_currents + g * self.element_voltages)
+            )
+        else:
+            sources = np.where(self.is_capacitor, g * self.element_voltages, -self.element_currents)
+
+        rhs = self.scatter @ sources
+        rhs[self.system.node_count:self.system.node_count + len(self.source_names)] += self.system.voltages
+        self.x = self.system.apply_updates(self.system.factorization.solve(rhs))
+
+        x = np.append(self.x, 0.0)
+        self.element_voltages = x[self.element_rows[:, 0]] - x[self.element_rows[:, 1]]
+        self.element_currents = g * self.element_voltages - sources
+
+    def state(self) -> (float, np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        """
+        Return the time, node voltages, resistor currents, voltage source currents,
+        and the currents through the capacitors and inductors of the last timestep
+        """
+        voltages, resistor_currents, source_currents = self.system.unpack(self.x)
+        return self.t, voltages, resistor_currents[:len(self.resistor_names)], source_currents, self.element_currents.copy()
+
+    def advance(self, duration: float) -> (float, np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        """
+        Step through the given duration, returning the state at its end
+        """
+        for _ in range(max(round(duration / self.timestep), 1)):
+            self.step()
+        return self.state()
+
+    def run(self, duration: float, every: int = 1):
+        """
+        Step through the given duration, yielding the state every given number of steps
+        """
+        for i in range(1, round(duration / self.timestep) + 1):
+            self.step()
+            if i % every == 0:
+                yield self.state()
@@ -0,0 +1,137 @@
+"""
+An independent reference for the solver, and circuits to check it on
+
+The reference writes Kirchhoff's laws out one equation at a time and solves them by least squares, so it shares no
+code with simulator.mna: no grounding, no pruning, no reduction and no factorization to update. Node voltages are
+only fixed up to a constant per connected part, so solutions are compared by their currents and voltage drops
+"""
+
+import numpy as np
+
+
+def solve_reference(nodes: [str],
+                    resistors: {str: (float, str, str)},
+                    voltage_sources: {str: (float, str, str)}
+                    ) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Return the node voltages, resistor currents (node1 to node2) and voltage source currents (from to to)
+    of a linear circuit. Resistors of zero ohm and voltage sources get a current of their own as unknown
+    """
+    index = {name: i for i, name in enumerate(nodes)}
+    zeros = [name for name, (ohm, a, b) in resistors.items() if ohm == 0 and a != b]
+    n, m = len(nodes), len(voltage_sources)
+    size = n + m + len(zeros)
+    equations, rhs = [], []
+
+    # Every node: the currents leaving through resistors and zero resistors equal those arriving through sources
+    kcl = np.zeros((n, size))
+    for name, (ohm, a, b) in resistors.items():
+        if ohm != 0 and a != b:
+            i, j = index[a], index[b]
+            kcl[i, i] += 1 / ohm
+            kcl[i, j] -= 1 / ohm
+            kcl[j, j] += 1 / ohm
+            kcl[j, i] -= 1 / ohm
+    for k, (_, _from, _to) in enumerate(voltage_sources.values()):
+        kcl[index[_from], n + k] += 1
+        kcl[index[_to], n + k] -= 1
+    for k, name in enumerate(zeros):
+        _, a, b = resistors[name]
+        kcl[index[a], n + m + k] += 1
+        kcl[index[b], n + m + k] -= 1
+    equations.append(kcl)
+    rhs.append(np.zeros(n))
+
+    # Every voltage source raises its to node above its from node, every zero resistor keeps its ends level
+    for k, (volt, _from, _to) in enumerate(voltage_sources.values()):
+        row = np.zeros(size)
+        row[index[_to]], row[index[_from]] = 1, -1
+        equations.append(row[None])
+        rhs.append(np.array([volt]))
+    for name in zeros:
+        _, a, b = resistors[name]
+        row = np.zeros(size)
+        row[index[a]], row[index[b]] = 1, -1
+        equations.append(row[None])
+        rhs.append(np.zeros(1))
+
+    x = np.linalg.lstsq(np.vstack(equations), np.concatenate(rhs), rcond=None)[0]
+    voltages = x[:n]
+    currents = np.array([
+        0.0 if a == b else x[n + m + zeros.index(name)] if ohm == 0 else (voltages[index[a]] - voltages[index[b]]) / ohm
+        for name, (ohm, a, b) in resistors.items()
+    ])
+    return voltages, currents, x[n:n + m]
+
+
+def drops(nodes: [str], elements: {str: (float, str, str)}, voltages: np.ndarray) -> np.ndarray:
+    """
+    Return the voltage across every element, from its first node to its second
+    """
+    index = {name: i for i, name in enumerate(nodes)}
+    return np.array([voltages[index[a]] - voltages[index[b]] for _, a, b in elements.values()])
+
+
+def assert_matches(circuit, resistors: {str: (float, str, str)} = None, tolerance: float = 1e-9):
+    """
+    Check the solution stored on a circuit against the reference, for the given resistances if they differ
+    from the circuit's own, like those of blocked check valves
+    """
+    resistors = circuit.resistors_blueprint if resistors is None else resistors
+    nodes, voltage_sources = circuit.nodes_blueprint, circuit.voltage_sources_blueprint
+    voltages, resistor_currents, source_currents = solve_reference(nodes, resistors, voltage_sources)
+    store = circuit.store
+
+    scale = max(np.abs(resistor_currents).max(initial=0), np.abs(source_currents).max(initial=0), 1)
+    np.testing.assert_allclose(store.resistor_currents, resistor_currents, rtol=0, atol=tolerance * scale)
+    np.testing.assert_allclose(store.source_currents, source_currents, rtol=0, atol=tolerance * scale)
+
+    elements = resistors | voltage_sources
+    span = max(np.abs(drops(nodes, elements, voltages)).max(initial=0), 1)
+    np.testing.assert_allclose(
+        drops(nodes, elements, store.node_voltages), drops(nodes, elements, voltages), rtol=0, atol=tolerance * span
+    )
+
+
+def grid(rows: int, columns: int, seed: int = 0, pumps: int = 2, zero: bool = False, dead_end: bool = False
+         ) -> ([str], {str: (float, str, str)}, {str: (float, str, str)}):
+    """
+    Return a grid of resistors with random resistances and pumps between random nodes, optionally with a resistor
+    of zero ohm and a dead end hanging off it
+    """
+    rng = np.random.default_rng(seed)
+    nodes = [f"n{i}_{j}" for i in range(rows) for j in range(columns)]
+    resistors = {}
+    for i in range(rows):
+        for j in range(columns):
+            if i + 1 < rows:
+                resistors[f"v{i}_{j}"] = (float(rng.uniform(1, 10)), f"n{i}_{j}", f"n{i + 1}_{j}")
+            if j + 1 < columns:
+                resistors[f"h{i}_{j}"] = (float(rng.uniform(1, 10)), f"n{i}_{j}", f"n{i}_{j + 1}")
+    if zero:
+        resistors["h0_0"] = (0.0, *resistors["h0_0"][1:])
+    if dead_end:
+        nodes += ["dead", "tip"]
+        resistors["d1"] = (2.0, "n0_0", "dead")
+        resistors["d2"] = (3.0, "dead", "tip")
+
+    # Every pump gets nodes of its own, pumps in a loop can't be solved
+    ends = rng.choice(len(nodes) - 2 * dead_end, 2 * pumps, replace=False).tolist()
+    voltage_sources = {
+        f"P{k}": (float(rng.uniform(1, 10)), nodes[ends[2 * k]], nodes[ends[2 * k + 1]]) for k in range(pumps)
+    }
+    return nodes, resistors, voltage_sources
+
+
+def ladder(rungs: int, seed: int = 0) -> ([str], {str: (float, str, str)}, {str: (float, str, str)}):
+    """
+    Return a ladder of resistors driven by a single pump, which pre-reduction collapses almost entirely
+    """
+    rng = np.random.default_rng(seed)
+    nodes = ["g"] + [f"t{i}" for i in range(rungs + 1)] + [f"m{i}" for i in range(rungs)]
+    resistors = {}
+    for i in range(rungs):
+        resistors[f"a{i}"] = (float(rng.uniform(1, 10)), f"t{i}", f"m{i}")
+        resistors[f"b{i}"] = (float(rng.uniform(1, 10)), f"m{i}", f"t{i + 1}")
+        resistors[f"c{i}"] = (float(rng.uniform(1, 10)), f"t{i + 1}", "g")
+    return nodes, resistors, {"V": (10.0, "g", "t0")}
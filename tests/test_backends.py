@@ -0,0 +1,75 @@
+"""
+Every backend, with and without pruning, memoization and pre-reduction, against the reference
+"""
+
+import numpy as np
+import pytest
+
+from simulator.circuit import Circuit
+from simulator.mna import DecompositionBackend, DenseBackend, IterativeBackend, SparseBackend
+from tests.reference import assert_matches, grid, ladder, solve_reference
+
+
+backends = {
+    "dense": (DenseBackend, {}, 1e-9),
+    "sparse": (SparseBackend, {}, 1e-9),
+    "rcm": (SparseBackend, {"ordering": "rcm"}, 1e-9),
+    "pcg": (IterativeBackend, {"tolerance": 1e-12}, 1e-7),
+    "pcg-ic": (IterativeBackend, {"preconditioner": "ic", "tolerance": 1e-12}, 1e-7),
+    "schur": (DecompositionBackend, {"parts": 3, "mode": "serial", "min_size": 0}, 1e-9),
+}
+
+circuits = {
+    "grid": lambda: grid(5, 6, seed=1),
+    "zero and dead end": lambda: grid(4, 5, seed=2, zero=True, dead_end=True),
+    "one pump": lambda: grid(6, 4, seed=3, pumps=1),
+    "ladder": lambda: ladder(20, seed=4),
+}
+
+flags = {
+    "plain": {"prune": False, "prereduce": False, "memoize": False},
+    "pruned": {"prereduce": False, "memoize": False},
+    "all": {},
+}
+
+
+@pytest.mark.parametrize("backend", backends)
+@pytest.mark.parametrize("circuit", circuits)
+@pytest.mark.parametrize("flag", flags)
+def test_backend_matches_reference(backend, circuit, flag):
+    cls, options, tolerance = backends[backend]
+    nodes, resistors, voltage_sources = circuits[circuit]()
+
+    circuit = Circuit(nodes, resistors, voltage_sources, backend=cls(**options), cache=False, **flags[flag])
+    circuit.solve()
+    assert_matches(circuit, tolerance=tolerance)
+
+
+def test_tiny_circuit_with_more_parts_than_unknowns():
+    nodes, resistors, voltage_sources = grid(2, 2, seed=5, pumps=1)
+    for min_size in (0, 1000):
+        circuit = Circuit(
+            nodes, resistors, voltage_sources, backend=DecompositionBackend(parts=8, mode="serial", min_size=min_size),
+            prune=False, prereduce=False, cache=False
+        )
+        circuit.solve()
+        assert_matches(circuit)
+
+
+def test_batch_matches_reference():
+    nodes, resistors, voltage_sources = grid(4, 4, seed=6)
+    circuit = Circuit(nodes, resistors, voltage_sources, cache=False)
+    circuit.solve()
+
+    scale = 1 + 0.5 * np.random.default_rng(7).uniform(-1, 1, (5, len(resistors)))
+    resistances = np.array([ohm for ohm, _, _ in resistors.values()]) * scale
+    voltages = np.tile([volt for volt, _, _ in voltage_sources.values()], (5, 1)) * scale[:, :len(voltage_sources)]
+    _, resistor_currents, source_currents = circuit.solve_batch(resistances, voltages)
+
+    for k in range(5):
+        expected = solve_reference(
+            nodes, {name: (ohm, a, b) for ohm, (name, (_, a, b)) in zip(resistances[k], resistors.items())},
+            {name: (volt, a, b) for volt, (name, (_, a, b)) in zip(voltages[k], voltage_sources.items())}
+        )
+        np.testing.assert_allclose(resistor_currents[k], expected[1], atol=1e-9)
+        np.testing.assert_allclose(source_currents[k], expected[2], atol=1e-9)
@@ -0,0 +1,87 @@
+"""
+Check valves, against the reference with the blocked ones at their leak resistance
+"""
+
+import numpy as np
+import pytest
+
+from simulator import parallel
+from simulator.cache import SolutionCache
+from simulator.circuit import Circuit
+from tests.reference import assert_matches, grid
+
+
+def check_valve_circuit(seed: int) -> ([str], {str: (float, str, str)}, {str: (float, str, str)}, [str]):
+    nodes, resistors, voltage_sources = grid(5, 5, seed=seed, pumps=3)
+    valves = [name for name in resistors if name.startswith("v")][::3]
+    return nodes, resistors, voltage_sources, valves
+
+
+def assert_valid(circuit: Circuit):
+    """
+    Check the solution against the reference, and that every valve is in the state its solution asks for:
+    open ones carry current forwards, blocked ones have pressure backwards across them
+    """
+    resistors = {
+        name: (circuit.valve_resistance(name), a, b) for name, (_, a, b) in circuit.resistors_blueprint.items()
+    }
+    assert_matches(circuit, resistors)
+
+    store = circuit.store
+    scale = max(np.abs(store.resistor_currents).max(), 1)
+    for name in circuit.check_valves:
+        _, a, b = circuit.resistors_blueprint[name]
+        current = store.resistor_currents[store.resistor_index[name]]
+        if name in circuit.blocked:
+            drop = store.node_voltages[store.node_index[a]] - store.node_voltages[store.node_index[b]]
+            assert drop <= 1e-9 * scale, name
+        else:
+            assert current >= -1e-9 * scale, name
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("prereduce", (False, True))
+def test_active_set_matches_reference(seed, prereduce):
+    nodes, resistors, voltage_sources, valves = check_valve_circuit(seed)
+    circuit = Circuit(
+        nodes, dict(resistors), dict(voltage_sources), check_valves=valves, prereduce=prereduce, cache=False
+    )
+    circuit.solve()
+    assert_valid(circuit)
+
+    # Turning pumps around and changing resistances flips valves, starting from the blocked ones of the last solve
+    rng = np.random.default_rng(seed)
+    for _ in range(4):
+        circuit.update_voltages({name: float(rng.uniform(-10, 10)) for name in voltage_sources})
+        assert_valid(circuit)
+        circuit.update_resistances({name: float(rng.uniform(1, 10)) for name in rng.choice(valves, 2).tolist()})
+        assert_valid(circuit)
+
+
+def test_blocked_valves_come_back_from_the_cache():
+    nodes, resistors, voltage_sources, valves = check_valve_circuit(20)
+    solved = Circuit(nodes, dict(resistors), dict(voltage_sources), check_valves=valves)
+    solved.solve()
+    assert solved.blocked
+
+    cache = SolutionCache()
+    cache.store(solved)
+    looked_up = Circuit(nodes, dict(resistors), dict(voltage_sources), check_valves=valves)
+    assert cache.lookup(looked_up)
+    assert looked_up.blocked == solved.blocked
+    assert_valid(looked_up)
+
+    looked_up.update_resistances({valves[0]: 2.0})
+    assert_valid(looked_up)
+
+
+def test_blocked_valves_come_back_from_the_workers(monkeypatch):
+    monkeypatch.setattr(parallel, "min_size", 0)
+    monkeypatch.setattr(parallel, "workers", 2)
+    nodes, resistors, voltage_sources, valves = check_valve_circuit(21)
+    circuits = [Circuit(nodes, dict(resistors), dict(voltage_sources), check_valves=valves) for _ in range(2)]
+    parallel.solve_circuits(circuits, "thread")
+
+    for circuit in circuits:
+        assert circuit.blocked
+        assert_valid(circuit)
@@ -0,0 +1,48 @@
+"""
+Blocking every element on its own, against a reference solve of the circuit without it
+"""
+
+import numpy as np
+import pytest
+
+from simulator.circuit import Circuit
+from tests.reference import grid, solve_reference
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("prereduce", (False, True))
+def test_contingencies_match_re_solves(seed, prereduce):
+    nodes, resistors, voltage_sources = grid(4, 5, seed=seed, pumps=2, dead_end=True)
+    circuit = Circuit(nodes, resistors, voltage_sources, prereduce=prereduce, cache=False)
+    circuit.solve()
+    impacts = circuit.contingencies(chunk=7)
+
+    names = [*resistors, *voltage_sources]
+    assert set(impacts) == set(names)
+    _, resistor_currents, source_currents = solve_reference(nodes, resistors, voltage_sources)
+    before = np.concatenate([resistor_currents, source_currents])
+
+    checked = 0
+    for blocked, (element, current_before, current_after) in impacts.items():
+        if np.isnan(current_after):
+            continue
+        # A blocked resistor is gone, a blocked pump is an open pipe carrying nothing
+        _, resistor_currents, source_currents = solve_reference(
+            nodes, {name: value for name, value in resistors.items() if name != blocked},
+            {name: value for name, value in voltage_sources.items() if name != blocked}
+        )
+        after = np.insert(
+            np.concatenate([resistor_currents, source_currents]), names.index(blocked), before[names.index(blocked)]
+        )
+        changes = np.abs(after - before)
+        changes[names.index(blocked)] = 0
+
+        assert current_before == pytest.approx(before[names.index(element)], abs=1e-9)
+        assert current_after == pytest.approx(after[names.index(element)], abs=1e-9)
+        assert abs(current_after - current_before) == pytest.approx(changes.max(), abs=1e-9)
+        checked += 1
+    assert checked > len(names) // 2
+
+    # The largest changes come first
+    magnitudes = [abs(after - before) for _, before, after in impacts.values() if not np.isnan(after)]
+    assert magnitudes == sorted(magnitudes, reverse=True)
@@ -0,0 +1,53 @@
+"""
+The factorizations the subdomain workers keep for decomposed systems
+"""
+
+import gc
+
+import pytest
+
+from simulator import mna
+from simulator.circuit import Circuit
+from simulator.mna import DecompositionBackend
+from tests.reference import assert_matches, grid
+
+
+@pytest.mark.parametrize("mode", ("serial", "thread"))
+def test_more_live_systems_than_workers_used_to_keep(mode):
+    backend = DecompositionBackend(parts=2, mode=mode, min_size=0)
+    circuits = []
+    for seed in range(24):
+        nodes, resistors, voltage_sources = grid(4, 5, seed=seed)
+        circuit = Circuit(
+            nodes, dict(resistors), voltage_sources, backend=backend, prune=False, prereduce=False, cache=False
+        )
+        circuit.solve()
+        circuits.append(circuit)
+
+    # The first ones are still solved against their own factorization
+    for circuit in circuits[:3]:
+        circuit.update_resistances({"h1_1": 9.0})
+        assert_matches(circuit)
+
+    # Their entries go when the factorizations do
+    keys = {circuit.factorization.key for circuit in circuits}
+    del circuits, circuit
+    gc.collect()
+    if mode == "thread":
+        for worker in mna.domain_workers["thread"]:
+            worker.submit(lambda: None).result()
+    assert not keys & {key for key, _ in mna.subdomains}
+
+
+def test_released_subdomains_are_factorized_again():
+    nodes, resistors, voltage_sources = grid(4, 5, seed=30)
+    backend = DecompositionBackend(parts=3, mode="serial", min_size=0)
+    circuit = Circuit(
+        nodes, dict(resistors), dict(voltage_sources), backend=backend, prune=False, prereduce=False, cache=False
+    )
+    circuit.solve()
+    circuit.factorization.release()
+    assert not {key for key, _ in mna.subdomains} & {circuit.factorization.key}
+
+    circuit.update_voltages({"P0": 4.0})
+    assert_matches(circuit)
@@ -0,0 +1,54 @@
+"""
+Memoized pieces, against the reference, also when circuits are reduced on several threads at once
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from simulator.circuit import Circuit
+from simulator.patterns import PatternReduction
+from tests.reference import assert_matches
+
+
+def bridges(copies: int, length: int) -> ([str], {str: (float, str, str)}, {str: (float, str, str)}):
+    """
+    Return copies of a chain of length resistors with a resistor across every pair of them, between two headers
+    """
+    nodes, resistors = ["A", "B"], {}
+    for i in range(copies):
+        chain = ["A", *(f"x{i}_{j}" for j in range(length - 1)), "B"]
+        nodes += chain[1:-1]
+        for j, (a, b) in enumerate(zip(chain, chain[1:])):
+            resistors[f"r{i}_{j}"] = (1.0 + j + i % 2, a, b)
+        for j, (a, b) in enumerate(zip(chain, chain[2:])):
+            resistors[f"s{i}_{j}"] = (2.0 + j, a, b)
+    return nodes, resistors, {"P": (10.0, "A", "B")}
+
+
+def test_memoized_pieces_match_reference():
+    nodes, resistors, voltage_sources = bridges(6, 4)
+    circuit = Circuit(nodes, dict(resistors), voltage_sources, cache=False)
+    circuit.solve()
+    assert circuit.patterns is not None
+    assert_matches(circuit)
+
+    # Changing the inside of a copy makes it a piece of its own
+    circuit.update_resistances({"r0_1": 7.0})
+    assert_matches(circuit)
+
+
+def test_pieces_reduced_on_many_threads(monkeypatch):
+    monkeypatch.setattr(PatternReduction, "macros", {})
+    monkeypatch.setattr(PatternReduction, "macros_size", 3)
+
+    def solve(length: int) -> Circuit:
+        nodes, resistors, voltage_sources = bridges(5, length)
+        circuit = Circuit(nodes, resistors, voltage_sources, cache=False)
+        circuit.solve()
+        return circuit
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        circuits = list(pool.map(solve, [2 + i % 9 for i in range(120)]))
+    for circuit in circuits:
+        assert circuit.patterns is not None
+        assert_matches(circuit)
+    assert len(PatternReduction.macros) <= 3
@@ -0,0 +1,46 @@
+"""
+Valve scenarios written by ValveScenarios.run, against a reference solve of every combination
+"""
+
+import csv
+
+import pytest
+
+from simulator.circuit import Circuit
+from simulator.scenarios import ValveScenarios
+from tests.reference import grid, solve_reference
+
+
+def test_scenarios_match_re_solves(tmp_path):
+    nodes, resistors, voltage_sources = grid(4, 4, seed=40, dead_end=True)
+    circuit = Circuit(nodes, resistors, voltage_sources, cache=False)
+    circuit.solve()
+
+    # The dead end's first resistor is a bridge, closing it only leaves its leak
+    valves = ["v0_1", "h1_1", "d1", "h2_2", "v2_3"]
+    scenarios = ValveScenarios(circuit, valves)
+    path = tmp_path / "scenarios.csv"
+    assert list(scenarios.run(str(path))) == [scenarios.count()]
+
+    with open(path) as file:
+        header = next(csv.reader(file))
+        file.seek(0)
+        rows = list(csv.DictReader(file))
+    assert len(header) == len(set(header)) == 1 + len(valves) + len(resistors) + len(voltage_sources)
+    assert len(rows) == scenarios.count()
+
+    # Every step opens or closes a single valve
+    states = [tuple(row[f"{valve} open"] for valve in valves) for row in rows]
+    assert len(set(states)) == len(states)
+    assert all(sum(a != b for a, b in zip(first, second)) == 1 for first, second in zip(states, states[1:]))
+
+    for row in rows[::3]:
+        closed = {valve for valve in valves if row[f"{valve} open"] == "0"}
+        changed = {
+            name: (ohm * (1 / Circuit.check_valve_leak if name in closed else 1), a, b)
+            for name, (ohm, a, b) in resistors.items()
+        }
+        _, resistor_currents, source_currents = solve_reference(nodes, changed, voltage_sources)
+        expected = dict(zip([*resistors, *voltage_sources], [*resistor_currents, *source_currents]))
+        for name, amps in expected.items():
+            assert float(row[name]) == pytest.approx(amps, rel=1e-7, abs=1e-9), (row["step"], name)
@@ -0,0 +1,99 @@
+"""
+Changed resistances and voltages, applied as updates of a factorization, against the reference
+"""
+
+import numpy as np
+import pytest
+
+from simulator.circuit import Circuit
+from simulator.mna import DecompositionBackend, DenseBackend, SparseBackend
+from tests.reference import assert_matches, grid, solve_reference
+
+
+backends = {
+    "dense": lambda: DenseBackend(),
+    "sparse": lambda: SparseBackend(),
+    "schur": lambda: DecompositionBackend(parts=2, mode="serial", min_size=0),
+}
+
+flags = {
+    "plain": {"prune": False, "prereduce": False, "memoize": False},
+    "all": {},
+}
+
+
+@pytest.mark.parametrize("backend", backends)
+@pytest.mark.parametrize("flag", flags)
+def test_resistance_updates(backend, flag):
+    nodes, resistors, voltage_sources = grid(5, 5, seed=10, dead_end=True)
+    circuit = Circuit(nodes, dict(resistors), voltage_sources, backend=backends[backend](), cache=False, **flags[flag])
+    circuit.solve()
+
+    rng = np.random.default_rng(11)
+    names = list(resistors)
+    # A few at a time are low-rank updates, many at once refactorize, zero ohm changes what is collapsed
+    for count in (1, 3, 1, 40, 2):
+        changed = rng.choice(names, count, replace=False).tolist()
+        circuit.update_resistances({name: float(rng.uniform(1, 10)) for name in changed})
+        assert_matches(circuit)
+    circuit.update_resistances({names[0]: 0.0})
+    assert_matches(circuit)
+    circuit.update_resistances({names[0]: 4.0})
+    assert_matches(circuit)
+
+
+@pytest.mark.parametrize("backend", backends)
+@pytest.mark.parametrize("flag", flags)
+def test_voltage_updates(backend, flag):
+    nodes, resistors, voltage_sources = grid(4, 5, seed=12)
+    circuit = Circuit(nodes, resistors, dict(voltage_sources), backend=backends[backend](), cache=False, **flags[flag])
+    circuit.solve()
+
+    for volt in (0.5, -3.0, 12.0):
+        circuit.update_voltages({"P0": volt})
+        assert_matches(circuit)
+    circuit.update_resistances({"h1_1": 7.5})
+    circuit.update_voltages({"P1": 2.0})
+    assert_matches(circuit)
+
+
+@pytest.mark.parametrize("flag", flags)
+def test_circuits_of_the_same_topology_keep_their_own_system(flag):
+    nodes, resistors, voltage_sources = grid(3, 4, seed=13)
+    Circuit.systems.clear()
+    first = Circuit(nodes, dict(resistors), dict(voltage_sources), **flags[flag])
+    first.solve()
+    second = Circuit(nodes, dict(resistors) | {"h0_0": (100.0, "n0_0", "n0_1")}, dict(voltage_sources), **flags[flag])
+    second.solve()
+
+    # Both update a system that started out as the same cached one
+    first.update_resistances({"v0_1": 20.0})
+    assert_matches(first)
+    second.update_resistances({"v1_2": 0.5})
+    assert_matches(second)
+    first.update_voltages({"P0": 1.0})
+    assert_matches(first)
+    assert_matches(second)
+
+    # A third one solved from the cache doesn't see what the other two changed
+    third = Circuit(nodes, dict(resistors), dict(voltage_sources), **flags[flag])
+    third.solve()
+    assert_matches(third)
+
+
+def test_sensitivities_match_a_re_solve():
+    nodes, resistors, voltage_sources = grid(4, 4, seed=14)
+    circuit = Circuit(nodes, resistors, voltage_sources, cache=False)
+    circuit.solve()
+    weights = {"h1_1": 1.0, "P0": -0.5}
+    sensitivities = circuit.sensitivities(weights)
+
+    def weighted(changed: {str: (float, str, str)}) -> float:
+        _, resistor_currents, source_currents = solve_reference(nodes, changed, voltage_sources)
+        return resistor_currents[list(resistors).index("h1_1")] - 0.5 * source_currents[0]
+
+    for name in ("h1_1", "v0_2", "h3_0"):
+        ohm, a, b = resistors[name]
+        step = 1e-6 * ohm
+        difference = weighted(resistors | {name: (ohm + step, a, b)}) - weighted(resistors | {name: (ohm - step, a, b)})
+        assert sensitivities[name] == pytest.approx(difference / (2 * step), rel=1e-5, abs=1e-9)